@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import unittest
+from django.core.cache import caches
+from varapp.common.db_utils import service_key
+from varapp.annotation.genomic_range import GenomicRange
+from varapp.annotation.location_index import *
+from varapp.common import masking
+from varapp.data_models.variants import Variant
+from varapp.filters.filters import FiltersCollection
+from varapp.filters.genotype_filters import GenotypesFilterActive
+from varapp.filters.variant_filters import LocationFilter, GeneFilter
+from varapp.samples.samples_factory import samples_selection_factory
+from varapp.constants.tests import NVAR
+
+
+class TestLocationIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = LocationIndex('test')
+        self.variants = list(Variant.objects.using('test').values_list('variant_id', 'chrom', 'start', 'end', 'gene_symbol'))
+
+    def ids(self, mask):
+        return (masking.to_indices(masking.unpack(mask, NVAR)) + 1).tolist()
+
+    def test_location_index(self):
+        self.assertIsInstance(location_index('test'), LocationIndex)
+        self.assertIs(location_index('test'), location_index('test'))
+        caches['location_index'].delete(service_key('test'))
+
+    def test_find(self):
+        """Same as the LocationFilter SQL condition."""
+        v = self.variants
+        ranges = [GenomicRange(v[0][1], v[0][2]+1, v[20][3]),   # start of a chromosome
+                  GenomicRange(v[50][1], v[50][2]+1, v[50][3]),  # a single variant
+                  GenomicRange(v[50][1], v[50][2]+2, v[50][3]),  # nothing
+                  GenomicRange('chrZ', 1, 10**9)]                # unknown chromosome
+        for loc in ranges:
+            f = LocationFilter(val='', db='test')
+            f.val = [loc]
+            expected = sorted(Variant.objects.using('test').filter(f.django_condition()).values_list('variant_id', flat=True))
+            self.assertEqual(self.ids(self.index.find([loc], NVAR)), expected, loc)
+        self.assertEqual(len(self.ids(self.index.find(ranges[1:2], NVAR))), 1)
+        # Several ranges
+        f.val = ranges
+        expected = sorted(Variant.objects.using('test').filter(f.django_condition()).values_list('variant_id', flat=True))
+        self.assertEqual(self.ids(self.index.find(ranges, NVAR)), expected)
+
+    def test_find_genes(self):
+        """Same as the GeneFilter SQL condition."""
+        genes = sorted(set(v[4] for v in self.variants if v[4]))[:5]
+        f = GeneFilter(val=','.join(g.upper() for g in genes))
+        expected = sorted(Variant.objects.using('test').filter(f.django_condition()).values_list('variant_id', flat=True))
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(self.ids(self.index.find_genes(f.val, NVAR)), expected)
+        self.assertEqual(self.ids(self.index.find_genes(['no_such_gene'], NVAR)), [])
+
+    def test_apply_many_locations(self):
+        """More than 300 locations can be used in FiltersCollection.apply."""
+        ranges = ','.join('{}:{}-{}'.format(chrom, start+1, end) for _,chrom,start,end,_ in self.variants)
+        f = LocationFilter(val=ranges, db='test')
+        self.assertTrue(len(f.val) > 300)
+        with self.assertRaises(ValueError):
+            f.django_condition()
+        ss = samples_selection_factory(db='test')
+        result = FiltersCollection([f, GenotypesFilterActive(ss, db='test')]).apply(db='test')
+        active = set(GenotypesFilterActive(ss, db='test').apply(db='test').ids)
+        self.assertEqual(result.n_filtered, len([v for v in self.variants if v[0] in active]))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import unittest
+import json
+import pickle
+import shutil
+import numpy as np
+from io import StringIO
+from os.path import join
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from varapp.common.artifacts import *
+from varapp.common.cache import single_flight
+from varapp.common.db_utils import file_hash, get_db_hash, set_db_hash, add_db_to_settings, remove_db_from_settings, DB_HASHES, service_key
+from varapp.common.manage_dbs import update_db, prepare_new_version
+from varapp.common.generations import generations
+from varapp.models.users import VariantsDb
+from varapp.annotation.annotation_service import GeneSummaryService
+from varapp.stats.stats_service import GlobalStatsService, MasksMatrix
+from varapp.variants.genotypes_service import GenotypesService
+from tests.test_utils import TempDirSettings
+
+
+class TestArtifacts(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TempDirSettings({'ARTIFACTS_PATH': ''}, SIDECAR_DBS=False)
+        self.tmpdir.enable()
+
+    def tearDown(self):
+        caches['stats_masks'].delete(service_key('test'))
+        self.tmpdir.disable()
+
+    def test_no_hash(self):
+        DB_HASHES.pop('test', None)
+        self.assertIsNone(build_bundle('test'))
+        self.assertIsNone(load_bundle('test'))
+
+    def test_build_bundle(self):
+        set_db_hash('test', 'artifactstest')
+        self.assertIsNone(load_bundle('test'))  # not built yet
+        steps = []
+        path = build_bundle('test', workers=2, progress=lambda db, step, done, total, t: steps.append((step, done, total)))
+        self.assertEqual(path, bundle_path('artifactstest'))
+        self.assertEqual(sorted(s[0] for s in steps),
+                         ['gene_summary', 'genotypes', 'sidecar', 'stats', 'variant_keys', 'versions'])
+        self.assertEqual(sorted(s[1] for s in steps), [1, 2, 3, 4, 5, 6])
+        with open(join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['hash'], 'artifactstest')
+        self.assertEqual(set(manifest['artifacts']), {
+            'genotypes', 'chrX', 'gene_batches_genes', 'gene_batches_ids', 'gene_batches_offsets',
+            'masks_matrix', 'masks_index', 'global_stats', 'binned_codes', 'binned_breaks', 'gene_summary',
+            'variant_keys', 'gts_digests', 'samples', 'field_digests'})
+        bundle = load_bundle('test')
+        self.assertIn('genotypes', bundle)
+        # Large arrays are memory-mapped
+        for name in ('genotypes', 'gene_batches_ids', 'masks_matrix', 'binned_codes'):
+            self.assertIsInstance(bundle.load(name), np.memmap)
+        # Idempotent
+        self.assertEqual(build_bundle('test', progress=lambda *args: self.fail("rebuilt")), path)
+
+    def test_services_load_bundle(self):
+        """Services read from the bundle the same structures as they build."""
+        set_db_hash('test', 'artifactstest')
+        gs = GenotypesService('test')
+        stats = GlobalStatsService('test')
+        genes = GeneSummaryService('test')
+        build_bundle('test')
+        caches['stats_masks'].delete(service_key('test'))
+        gs2 = GenotypesService('test')
+        self.assertIsInstance(gs2.genotypes, np.memmap)
+        self.assertTrue(np.array_equal(gs2.genotypes, gs.genotypes))
+        self.assertTrue(np.array_equal(gs2.chrX, gs.chrX))
+        batches = gs.variant_ids_batches_by_gene
+        self.assertEqual(set(gs2.variant_ids_batches_by_gene), set(batches))
+        self.assertTrue(all(np.array_equal(ids, batches[g]) for g, ids in gs2.variant_ids_batches_by_gene.items()))
+        stats2 = GlobalStatsService('test')
+        self.assertEqual(stats2.get_global_stats().expose(), stats.get_global_stats().expose())
+        self.assertTrue(np.array_equal(stats2.masks_matrix().matrix, stats.masks_matrix().matrix))
+        self.assertTrue(np.array_equal(stats2.binned_columns().codes, stats.binned_columns().codes))
+        self.assertEqual(stats2.make_stats(variant_ids=[1, 2, 3]).expose(), stats.make_stats(variant_ids=[1, 2, 3]).expose())
+        genes2 = GeneSummaryService('test')
+        self.assertEqual(genes2.gene_names(), genes.gene_names())
+
+    def test_matching_rows(self):
+        keys = np.array([5, 3, 8, 1], dtype=np.uint64)
+        digests = np.array([50, 30, 80, 10], dtype=np.uint64)
+        old_keys = np.array([1, 3, 5, 7], dtype=np.uint64)
+        old_digests = np.array([10, 31, 50, 70], dtype=np.uint64)
+        new_idx, old_idx = matching_rows(keys, digests, old_keys, old_digests)
+        self.assertEqual(new_idx.tolist(), [0, 3])  # key 3 has another digest, key 8 is new
+        self.assertEqual(old_idx.tolist(), [2, 0])
+        self.assertEqual(len(matching_rows(keys, digests, old_keys[:0], old_digests[:0])[0]), 0)
+
+    def test_build_from_parent(self):
+        """What did not change is copied from the bundle of the previous version."""
+        set_db_hash('test', 'artifactsparent')
+        parent_path = build_bundle('test')
+        expected = load_bundle('test')
+        genotypes = np.array(expected.load('genotypes'))  # a copy, not a memory map of the file
+        masks = MasksMatrix.from_arrays(np.array(expected.load('masks_matrix')), expected.load('masks_index')).to_dict()
+        # Alter the parent's genotypes and masks, to see where they are reused
+        np.save(join(parent_path, 'genotypes.npy'), np.full(genotypes.shape, 255, dtype=np.uint8))
+        digests = np.array(expected.load('gts_digests'))
+        digests[0] += 1  # as if the genotypes of the first variant changed
+        np.save(join(parent_path, 'gts_digests.npy'), digests)
+        field_digests = expected.load('field_digests')
+        field_digests['impact'] = 'changed'
+        with open(join(parent_path, 'field_digests.pickle'), 'wb') as f:
+            pickle.dump(field_digests, f)
+        np.save(join(parent_path, 'masks_matrix.npy'), np.zeros(expected.load('masks_matrix').shape, dtype=np.uint8))
+
+        set_db_hash('test', 'artifactschild')
+        path = build_bundle('test', parent_sha='artifactsparent')
+        bundle = load_bundle('test')
+        self.assertEqual(bundle.manifest['parent'], 'artifactsparent')
+        child = bundle.load('genotypes')
+        self.assertTrue(np.array_equal(child[0], genotypes[0]))  # decoded again
+        self.assertTrue((child[1:] == 255).all())                # copied
+        child_masks = MasksMatrix.from_arrays(bundle.load('masks_matrix'), bundle.load('masks_index')).to_dict()
+        for val, m in child_masks['impact'].items():             # built again
+            self.assertTrue(np.array_equal(m, masks['impact'][val]))
+        for val, m in child_masks['polyphen_pred'].items():      # copied
+            self.assertFalse(m.any())
+
+    def test_update_db(self):
+        """When a db is replaced, the bundle of the new version is built from that of the parent."""
+        parent = VariantsDb.objects.create(name='asdf', filename=settings.DB_TEST, hash='artifactsparent', is_active=1)
+        add_db_to_settings('asdf', settings.DB_TEST, sha='artifactsparent')
+        try:
+            build_bundle('asdf')
+            newdb = VariantsDb.objects.create(name='asdf', filename=settings.DB_TEST, hash='artifactschild', is_active=1)
+            update_db(parent, newdb, prepare=False)
+            self.assertEqual(get_db_hash('asdf'), 'artifactsparent')
+            # Prepared in the background, e.g. once the transaction is committed
+            prepare_new_version(parent, newdb)
+            generations().join()
+            self.assertIn('asdf', settings.DATABASES)
+            self.assertEqual(get_db_hash('asdf'), 'artifactschild')
+            bundle = bundle_at('artifactschild')
+            self.assertIsNotNone(bundle)
+            self.assertEqual(bundle.manifest['parent'], 'artifactsparent')
+        finally:
+            remove_db_from_settings('asdf')
+            VariantsDb.objects.filter(name='asdf').delete()
+
+    def test_ingest_command(self):
+        set_db_hash('test', 'artifactstest')
+        out = StringIO()
+        call_command('ingest', 'test', workers=1, stdout=out)
+        self.assertIn("Db 'test' ingested", out.getvalue())
+        self.assertIsNotNone(load_bundle('test'))
+        self.assertEqual(single_flight.BUILD_WAIT, single_flight.default_wait())  # not changed
+
+    def test_ingest_file(self):
+        """A db file is ingested before it is released."""
+        path = join(self.tmpdir.name, 'new.db')
+        shutil.copy(join(settings.GEMINI_DB_PATH, settings.DB_TEST), path)
+        out = StringIO()
+        call_command('ingest', path, workers=1, stdout=out)
+        self.assertIsNotNone(bundle_at(file_hash(path)))
+        self.assertEqual([db for db in settings.DATABASES if db.startswith('v_')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
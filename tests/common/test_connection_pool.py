@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import unittest
+import sqlite3
+import threading
+import time
+import django.db.utils
+from varapp.common.connection_pool import *
+
+
+def connect():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+def ping(conn):
+    conn.execute('SELECT 1')
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = ConnectionPool(connect, ping, max_size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        stats = pool.stats()
+        self.assertEqual((stats['created'], stats['reused'], stats['in_use'], stats['idle']), (1, 1, 1, 0))
+
+    def test_broken(self):
+        """A connection that does not pass the health check is replaced."""
+        pool = ConnectionPool(connect, ping, max_size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.close()
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_max_age(self):
+        pool = ConnectionPool(connect, ping, max_size=2, max_age=0)
+        conn = pool.acquire()
+        time.sleep(0.01)
+        pool.release(conn)
+        self.assertEqual(pool.stats()['size'], 0)
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_rollback_on_release(self):
+        pool = ConnectionPool(connect, ping, max_size=1)
+        conn = pool.acquire()
+        conn.execute('CREATE TABLE t (x INT)')
+        conn.commit()
+        conn.execute('INSERT INTO t VALUES (1)')
+        pool.release(conn)
+        conn = pool.acquire()
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 0)
+
+    def test_wait_and_timeout(self):
+        pool = ConnectionPool(connect, ping, max_size=1, timeout=0.05)
+        conn = pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        with self.assertRaises(django.db.utils.OperationalError):  # as if the db was unreachable
+            pool.acquire()
+        self.assertEqual(pool.stats()['timeouts'], 2)
+        # Released by another thread while waiting
+        pool.timeout = 5
+        threading.Timer(0.05, pool.release, [conn]).start()
+        self.assertIs(pool.acquire(), conn)
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['wait_time'], 0)
+
+    def test_connection_pool(self):
+        pool = connection_pool('test_pool', connect, ping, max_size=3)
+        self.assertIs(connection_pool('test_pool', connect), pool)
+        self.assertEqual(pools_stats()['test_pool']['max_size'], 3)
+        pool.release(pool.acquire())
+        close_idle_pools()
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
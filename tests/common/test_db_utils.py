@@ -45,30 +45,114 @@ class TestDbUtils(django.test.TestCase):
         self.assertNotIn('asdf', settings.DATABASES)
         self.assertNotIn('asdf', connections.databases)
 
-    def test_remove_db_from_cache(self):
+    def test_gemini_sqlite_connection(self):
+        """Gemini dbs are opened read-only, from the file or from an in-memory copy."""
+        from varapp.backends.gemini_sqlite.base import memory_db_uri, release_memory_db, _memory_dbs
+        nvariants = connections['test'].cursor().execute("SELECT COUNT(*) FROM variants").fetchone()[0]
+        for dbname, in_memory in [('profiled', 0), ('profiled_memory', 10**9)]:
+            add_db_to_settings(dbname, DB_TEST, TEST_DB_PATH)
+            self.assertEqual(settings.DATABASES[dbname]['ENGINE'], 'varapp.backends.gemini_sqlite')
+            settings.DATABASES[dbname]['PROFILE']['IN_MEMORY_MAX_BYTES'] = in_memory
+            try:
+                cursor = connections[dbname].cursor()
+                self.assertEqual(cursor.execute("SELECT COUNT(*) FROM variants").fetchone()[0], nvariants)
+                self.assertEqual(cursor.execute("PRAGMA query_only").fetchone()[0], 1)
+                with self.assertRaises(django.db.utils.OperationalError):
+                    cursor.execute("DELETE FROM variants")
+            finally:
+                connections[dbname].close()
+                remove_db_from_settings(dbname)
+        # The in-memory copy is made once
+        path = join(TEST_DB_PATH, DB_TEST)
+        try:
+            self.assertEqual(memory_db_uri(path), memory_db_uri(path))
+        finally:
+            release_memory_db(path)
+        self.assertNotIn(path, _memory_dbs)
+
+    def test_sqlite_profile(self):
+        with self.settings(GEMINI_SQLITE_PROFILE={'MMAP_SIZE': 1, 'CACHE_SIZE_KB': 2},
+                           GEMINI_SQLITE_PROFILES={'small': {'CACHE_SIZE_KB': 3}}):
+            self.assertEqual(sqlite_profile('big'), {'MMAP_SIZE': 1, 'CACHE_SIZE_KB': 2})
+            self.assertEqual(sqlite_profile('small'), {'MMAP_SIZE': 1, 'CACHE_SIZE_KB': 3})
+
+    def test_db_hash(self):
+        """The hash of a db is known as long as it is connected."""
+        add_db_to_settings('asdf', 'asdf.db', 'dir', sha='abc')
+        self.assertEqual(get_db_hash('asdf'), 'abc')
+        set_db_hash('asdf', 'def')
+        self.assertEqual(get_db_hash('asdf'), 'def')
+        remove_db_from_settings('asdf')
+        self.assertIsNone(get_db_hash('asdf'))
+
+    def test_cache_namespace(self):
+        """The namespace of Redis keys changes with the db hash and the cache generation."""
+        set_db_hash('xx', 'abc')
+        ns = cache_namespace('xx')
+        self.assertEqual(ns, 'xx:abc:{}'.format(cache_generation('xx')))
+        set_db_hash('xx', 'def')
+        self.assertNotEqual(cache_namespace('xx'), ns)
+        g = cache_generation('xx')
+        self.assertEqual(bump_cache_generation('xx'), g + 1)
+        self.assertEqual(cache_generation('xx'), g + 1)
+        remove_db_from_settings('xx')
+
+    def test_cache_generation_ttl(self):
+        """The generation is read from Redis at most every GENERATION_TTL: a bump from another process
+        is seen after that delay."""
+        from varapp.common import db_utils
+        g = cache_generation('xx')
         cache = caches['redis']
+        cache.client.get_client(write=True).incr(cache.make_key('generation:xx'))  # another process
+        self.assertEqual(cache_generation('xx'), g)
+        generation, read = db_utils._generations['xx']
+        db_utils._generations['xx'] = (generation, read - GENERATION_TTL)
+        self.assertEqual(cache_generation('xx'), g + 1)
+
+    def test_remove_db_from_cache(self):
+        """The services of all versions are dropped."""
         gen_service_cache = caches['genotypes_service']
-        cache.set('stats:xx:test:1', 22)
-        cache.set('gen:xx:test:1', 22)
-        gen_service_cache.set('xx', 22)
-        self.assertIn('stats:xx:test:1', cache.keys('stats:*'))
-        self.assertIn('gen:xx:test:1', cache.keys('gen:*'))
-        self.assertIn('xx', gen_service_cache)
+        gen_service_cache.set('xx:aaa', 22)
+        gen_service_cache.set('xx:bbb', 22)
+        gen_service_cache.set('xxx:aaa', 22)
+        ns = cache_namespace('xx')
         remove_db_from_cache('xx')
-        self.assertNotIn('stats:xx:test:1', cache.keys('stats:*'))
-        self.assertNotIn('gen:xx:test:1', cache.keys('gen:*'))
-        self.assertNotIn('xx', gen_service_cache)
+        self.assertNotEqual(cache_namespace('xx'), ns)
+        self.assertNotIn('xx:aaa', gen_service_cache)
+        self.assertNotIn('xx:bbb', gen_service_cache)
+        self.assertIn('xxx:aaa', gen_service_cache)
+        gen_service_cache.delete('xxx:aaa')
+
+    def test_remove_version_from_cache(self):
+        gen_service_cache = caches['genotypes_service']
+        gen_service_cache.set('xx:aaa', 22)
+        gen_service_cache.set('xx:bbb', 22)
+        remove_version_from_cache('xx', 'aaa')
+        self.assertNotIn('xx:aaa', gen_service_cache)
+        self.assertIn('xx:bbb', gen_service_cache)
+        gen_service_cache.delete('xx:bbb')
+
+    def test_read_version(self):
+        """A thread reads the version it was given, whatever is served meanwhile."""
+        set_db_hash('xx', 'aaa')
+        with read_version('xx', 'aaa'):
+            set_db_hash('xx', 'bbb')
+            self.assertEqual(get_db_hash('xx'), 'aaa')
+            self.assertEqual(service_key('xx'), 'xx:aaa')
+            self.assertEqual(served_db_hash('xx'), 'bbb')
+        self.assertEqual(get_db_hash('xx'), 'bbb')
+        self.assertEqual(service_key('xx'), 'xx:bbb')
+        DB_HASHES.pop('xx', None)
 
     def test_remove_db(self):
         vdb = VariantsDb.objects.create(name='fff', filename='fff.db', location=TEST_DB_PATH, is_active=1)
-        cache = caches['redis']
-        cache.set('stats:fff:test:2', 33)
+        ns = cache_namespace('fff')
         settings.DATABASES[vdb.name] = 33
         connections.databases[vdb.name] = 33
         remove_db(vdb)
         self.assertNotIn('fff', settings.DATABASES)
         self.assertNotIn('fff', connections.databases)
-        self.assertEqual(len(cache.keys('stats:fff:test:*')), 0)
+        self.assertNotEqual(cache_namespace('fff'), ns)
 
     def test_is_test_vdb(self):
         vdb = VariantsDb.objects.get(filename=DB_TEST, is_active=1)
@@ -106,6 +190,18 @@ class TestDbUtils(django.test.TestCase):
             assert os.path.exists(target.name)
             self.assertIs(is_valid_vdb(vdb, target.name), False)
 
+    def test_file_hash(self):
+        self.assertIsNone(file_hash(join(TEST_DB_PATH, 'does_not_exist.db')))
+        with TempSqliteContext('fff.db', TEST_DB_PATH) as path:
+            signature = file_signature(path)
+            self.assertEqual(len(signature), 3)
+            self.assertEqual(file_hash(path), sha1sum(path))
+            # Found in cache for the same version of the file
+            key = 'filehash:{}:{}'.format(normpath(path), ':'.join(map(str, signature)))
+            caches['redis'].set(key, 'cached')
+            self.assertEqual(file_hash(path), 'cached')
+            caches['redis'].delete(key)
+
     def test_is_hash_changed(self):
         vdb = VariantsDb.objects.create(name='fff', filename='fff.db', location=TEST_DB_PATH)
         self.assertFalse(is_hash_changed(vdb))
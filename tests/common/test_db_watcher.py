@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+from varapp.common.db_watcher import *
+from varapp.common.db_utils import db_name_from_filename, get_db_hash
+from varapp.common.generations import version_path, generations
+from varapp.common.utils import random_string
+from varapp.models.users import VariantsDb
+from tests.test_utils import TempSqliteContext, TempDirSettings, create_dummy_db
+from django.conf import settings
+import django.test
+import os
+import unittest
+from unittest import mock
+
+TEST_DB_PATH = settings.GEMINI_DB_PATH
+
+
+class TestDbWatcher(django.test.TestCase):
+    def setUp(self):
+        self.tmpdir = TempDirSettings({'ARTIFACTS_PATH': '', 'SIDECAR_DB_PATH': ''})
+        self.tmpdir.enable()
+        self.watcher = DbWatcher(TEST_DB_PATH, interval=1)
+        self.watcher.publish(self.watcher.active_states())
+        self.watcher.poll()  # record the current files
+        self.watcher.poll()
+        self.filename = 'tmp'+random_string(10)+'.db'
+        self.dbname = db_name_from_filename(self.filename)
+
+    def tearDown(self):
+        self.tmpdir.disable()
+
+    def test_db_watcher_disabled(self):
+        self.assertIsNone(db_watcher())
+
+    def test_poll_new_db(self):
+        """A new file is added once it did not change for a whole interval."""
+        with TempSqliteContext(self.filename, TEST_DB_PATH):
+            self.assertEqual(self.watcher.poll(), [])
+            self.assertEqual(self.watcher.poll(), [self.dbname])
+            self.assertTrue(VariantsDb.objects.filter(name=self.dbname, is_active=1).exists())
+            self.assertEqual(self.watcher.generation, 1)
+            # Its version is pinned
+            sha = VariantsDb.objects.get(name=self.dbname, is_active=1).hash
+            self.assertTrue(os.path.exists(version_path(sha)))
+        # Removed
+        self.watcher.poll()
+        self.assertEqual(self.watcher.poll(), [self.dbname])
+        self.assertFalse(VariantsDb.objects.filter(name=self.dbname, is_active=1).exists())
+
+    def test_poll_replaced_db(self):
+        with TempSqliteContext(self.filename, TEST_DB_PATH):
+            self.watcher.poll()
+            self.watcher.poll()
+            old_hash = VariantsDb.objects.get(name=self.dbname, is_active=1).hash
+            create_dummy_db(self.filename, TEST_DB_PATH, overwrite=True)
+            self.watcher.poll()
+            self.assertEqual(self.watcher.poll(), [self.dbname])
+            new_hash = VariantsDb.objects.get(name=self.dbname, is_active=1).hash
+            self.assertNotEqual(new_hash, old_hash)
+            # The new version is served, from its pin, once prepared in the background
+            generations().join()
+            self.assertEqual(get_db_hash(self.dbname), new_hash)
+            self.assertEqual(settings.DATABASES[self.dbname]['NAME'], version_path(new_hash))
+
+    def test_poll_sync_failed(self):
+        """Settled files are synced again at the next poll if the sync failed."""
+        with TempSqliteContext(self.filename, TEST_DB_PATH):
+            self.watcher.poll()
+            with mock.patch.object(self.watcher, 'sync', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    self.watcher.poll()
+            self.assertEqual(self.watcher.poll(), [self.dbname])
+
+    def test_poll_unchanged(self):
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.generation, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
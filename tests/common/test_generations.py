@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import mock
+import os
+import shutil
+from os.path import join
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from varapp.common.generations import *
+from varapp.common.artifacts import bundle_at
+from varapp.common.db_utils import file_hash, get_db_hash, service_key, add_db_to_settings, remove_db_from_settings
+from tests.test_utils import TempDirSettings
+
+
+class TestPins(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TempDirSettings({'DB_VERSIONS_PATH': 'versions', 'SIDECAR_DB_PATH': 'sidecars',
+                                       'ARTIFACTS_PATH': 'artifacts'})
+        self.tmpdir.enable()
+
+    def tearDown(self):
+        self.tmpdir.disable()
+
+    def test_pin_version(self):
+        path = join(self.tmpdir.name, 'asdf.db')
+        shutil.copy(join(settings.GEMINI_DB_PATH, settings.DB_TEST), path)
+        sha = file_hash(path)
+        pin = pin_version(path, sha)
+        self.assertEqual(pin, version_path(sha))
+        self.assertFalse(os.path.samefile(pin, path))
+        self.assertEqual(file_hash(pin), sha)
+        # Not that version
+        self.assertIsNone(pin_version(path, 'asdf'))
+        # The pin keeps the content when the file is replaced
+        os.remove(path)
+        self.assertEqual(pin_version(path, sha), pin)
+        self.assertEqual(file_hash(pin), sha)
+
+    def test_pin_rewritten_in_place(self):
+        """The pin keeps the content when the file is overwritten in place (`cp new.db old.db`)."""
+        path = join(self.tmpdir.name, 'asdf.db')
+        shutil.copy(join(settings.GEMINI_DB_PATH, settings.DB_TEST), path)
+        sha = file_hash(path)
+        inode = os.stat(path).st_ino
+        pin = pin_version(path, sha)
+        with open(path, 'r+b') as f:
+            f.seek(200)
+            f.write(b'rewritten')
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertNotEqual(file_hash(path), sha)
+        self.assertEqual(file_hash(pin), sha)
+        self.assertEqual(pin_version(path, sha), pin)
+
+    def test_pin_served(self):
+        """The version being served is pinned and read from there, except the test db."""
+        path = join(self.tmpdir.name, 'asdf.db')
+        shutil.copy(join(settings.GEMINI_DB_PATH, settings.DB_TEST), path)
+        sha = file_hash(path)
+        add_db_to_settings('asdf', 'asdf.db', gemini_path=self.tmpdir.name, sha=sha)
+        generations = Generations(background=False)
+        try:
+            pin = generations.pin_served('asdf')
+            self.assertEqual(pin, version_path(sha))
+            self.assertEqual(settings.DATABASES['asdf']['NAME'], pin)
+            self.assertEqual(generations.pin_served('asdf'), pin)
+            self.assertIsNone(generations.pin_served('test'))
+        finally:
+            remove_db_from_settings('asdf')
+
+    def test_prepare_from_pin(self):
+        """Without a watcher, the version pinned by the warm-up (maybe of another process) is served
+        while the new one is prepared, even if its file was rewritten in place."""
+        path = join(self.tmpdir.name, 'asdf.db')
+        shutil.copy(join(settings.GEMINI_DB_PATH, settings.DB_TEST), path)
+        sha = file_hash(path)
+        add_db_to_settings('asdf', 'asdf.db', gemini_path=self.tmpdir.name, sha=sha)
+        pin = pin_version(path, sha)
+        with open(path, 'r+b') as f:
+            f.seek(200)
+            f.write(b'rewritten')
+        served = []
+        def build(*args, **kwargs):
+            served.append((get_db_hash('asdf'), settings.DATABASES['asdf']['NAME']))
+        try:
+            with mock.patch('varapp.common.generations.build_file_bundle', side_effect=build), \
+                    mock.patch('varapp.common.versioning.add_versions'):
+                Generations(background=False).prepare('asdf', 'asdf.db', 'generation2')
+            self.assertEqual(served, [(sha, pin)])
+            self.assertEqual(get_db_hash('asdf'), 'generation2')
+        finally:
+            remove_db_from_settings('asdf')
+
+    def test_prune_versions(self):
+        os.makedirs(versions_dir())
+        for sha in ('aaa', 'bbb'):
+            open(version_path(sha), 'w').close()
+        # Marked the first time it is seen inactive, deleted after the retention
+        self.assertEqual(prune_versions({'aaa'}, retention=-1), [])
+        self.assertTrue(os.path.exists(version_path('bbb')))
+        self.assertEqual(prune_versions({'aaa'}, retention=-1), ['bbb'])
+        self.assertFalse(os.path.exists(version_path('bbb')))
+        self.assertTrue(os.path.exists(version_path('aaa')))
+        # Kept during the retention
+        self.assertEqual(prune_versions(set()), [])
+        self.assertEqual(prune_versions(set()), [])
+        self.assertTrue(os.path.exists(version_path('aaa')))
+
+    def test_prune_unpinned(self):
+        """Sidecars and bundles of versions that were never pinned are deleted too."""
+        from varapp.common.sidecar import sidecar_path, sidecar_dir
+        from varapp.common.artifacts import bundle_path
+        os.makedirs(sidecar_dir())
+        open(sidecar_path('ccc'), 'w').close()
+        os.makedirs(bundle_path('ddd'))
+        self.assertEqual(version_hashes(), {'ccc', 'ddd'})
+        self.assertEqual(prune_versions({'ddd'}, retention=-1), [])
+        self.assertEqual(prune_versions({'ddd'}, retention=-1), ['ccc'])
+        self.assertFalse(os.path.exists(sidecar_path('ccc')))
+        self.assertTrue(os.path.exists(bundle_path('ddd')))
+
+
+class TestGenerations(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TempDirSettings({'ARTIFACTS_PATH': ''}, SIDECAR_DBS=False)
+        self.tmpdir.enable()
+        self.generations = Generations(background=False)
+        add_db_to_settings('asdf', settings.DB_TEST, sha='generation1')
+
+    def tearDown(self):
+        remove_db_from_settings('asdf')
+        self.tmpdir.disable()
+
+    def test_drain(self):
+        """The previous version is released when the last request that used it is done."""
+        path = settings.DATABASES['asdf']['NAME']
+        sha = self.generations.enter('asdf')
+        self.assertEqual(sha, 'generation1')
+        self.assertEqual(self.generations.inflight('asdf', sha), 1)
+        self.generations.swap('asdf', 'generation2', path)
+        self.assertEqual(get_db_hash('asdf'), 'generation2')
+        self.assertIn(('asdf', 'generation1'), self.generations._retired)
+        # New requests use the new version
+        self.assertEqual(self.generations.enter('asdf'), 'generation2')
+        self.generations.leave('asdf', 'generation2')
+        self.assertIn(('asdf', 'generation1'), self.generations._retired)
+        self.generations.leave('asdf', sha)
+        self.assertEqual(self.generations.inflight('asdf', sha), 0)
+        self.assertNotIn(('asdf', 'generation1'), self.generations._retired)
+
+    def test_serving(self):
+        """A request reads the version it started with until it is done, then its services are dropped."""
+        path = settings.DATABASES['asdf']['NAME']
+        new_path = join(self.tmpdir.name, 'asdf.db')
+        with self.generations.serving('asdf') as sha:
+            self.assertEqual(sha, 'generation1')
+            caches['sort_service'].set(service_key('asdf'), 22)
+            self.generations.swap('asdf', 'generation2', new_path)
+            self.assertEqual(get_db_hash('asdf'), 'generation1')
+            self.assertEqual(service_key('asdf'), 'asdf:generation1')
+            self.assertEqual(connections['asdf'].settings_dict['NAME'], path)
+        self.assertEqual(get_db_hash('asdf'), 'generation2')
+        self.assertEqual(connections['asdf'].settings_dict['NAME'], new_path)
+        self.assertNotIn('asdf:generation1', caches['sort_service'])
+
+    def test_prepare(self):
+        self.assertIsNone(self.generations.prepare('asdf', settings.DB_TEST, 'generation1'))  # already served
+        self.generations.prepare('asdf', settings.DB_TEST, 'generation2')
+        self.assertEqual(get_db_hash('asdf'), 'generation2')
+        bundle = bundle_at('generation2')
+        self.assertIsNotNone(bundle)
+        self.assertIn('genotypes', bundle)
+        # The temporary alias is gone
+        self.assertEqual([db for db in settings.DATABASES if db.startswith('asdf__')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import unittest
+import sys
+import threading
+import numpy as np
+from varapp.common.cache.locmem_cache import *
+
+
+class Service:
+    def __init__(self, n):
+        self.array = np.zeros(n, dtype=np.uint8)
+        self.index = {'a': np.zeros(n, dtype=np.uint8)}
+
+
+class TestLocMemNoPickleCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LocMemNoPickleCache('test_lru', {'OPTIONS': {'MAX_BYTES': 10000}})
+        self.cache.clear()
+
+    def test_sizeof(self):
+        s = Service(1000)
+        self.assertGreaterEqual(sizeof(s), 2000)
+        self.assertLess(sizeof(s), 3000)
+        s.sizeof = lambda: 7
+        self.assertEqual(entry_size(s), 7)
+        self.assertEqual(sizeof([s]), sys.getsizeof([s]) + 7)
+
+    def test_timeout(self):
+        """TIMEOUT None: entries never expire."""
+        cache = LocMemNoPickleCache('test_timeout', {'TIMEOUT': None})
+        cache.set('a', 1)
+        cache.set('b', 2, timeout=0)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        cache.clear()
+
+    def test_lru_budget(self):
+        """The least recently used entries are evicted to stay within the byte budget."""
+        before = self.cache.info()
+        self.cache.set('a', Service(2000))
+        self.cache.set('b', Service(2000))
+        self.assertIsNotNone(self.cache.get('a'))  # now 'b' is the least recently used
+        self.cache.set('c', Service(2000))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+        info = self.cache.info()
+        self.assertEqual(set(info['sizes']), {':1:a', ':1:c'})
+        self.assertLessEqual(info['bytes'], 10000)
+        self.assertEqual(info['evictions'] - before['evictions'], 1)
+        self.assertEqual(info['hits'] - before['hits'], 3)
+        self.assertEqual(info['misses'] - before['misses'], 1)
+
+    def test_too_large(self):
+        """An entry larger than the budget is still kept, alone."""
+        self.cache.set('a', Service(100))
+        self.cache.set('b', Service(10000))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+
+    def test_entries_grow(self):
+        """Entries that grew are accounted for once measured again."""
+        s = Service(100)
+        self.cache.set('a', s)
+        s.array = np.zeros(9900, dtype=np.uint8)
+        self.cache.set('b', Service(100))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertGreater(self.cache.measure('a'), 10000)  # evicting 'b' alone cannot fit the budget
+        self.cache.set('c', Service(100))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_info_concurrent_reads(self):
+        """`info` can be called while other threads read."""
+        for k in range(100):
+            self.cache.set(k, k)
+        stop = threading.Event()
+        def read():
+            while not stop.is_set():
+                for k in range(100):
+                    self.cache.get(k)
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for t in threads: t.start()
+        try:
+            for _ in range(200):
+                self.assertEqual(len(self.cache.info()['sizes']), 100)
+        finally:
+            stop.set()
+            for t in threads: t.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ import django.test
 import tempfile
 import unittest
 import datetime
+from contextlib import contextmanager
+from unittest import mock
 
 DB_TEST = settings.DB_TEST
 TEST_DB_PATH = settings.GEMINI_DB_PATH
@@ -138,15 +140,12 @@ class TestManageDbs(django.test.TestCase):
         old_vdb = VariantsDb.objects.create(name='asdf', filename='asdf.db', location=TEST_DB_PATH, is_active=1)
         new_vdb = VariantsDb.objects.create(name='xxxx', filename='xxxx.db', location=TEST_DB_PATH, is_active=1)
         DbAccess.objects.create(variants_db=old_vdb, user_id=1, is_active=1)
-        cache = caches['redis']
         gen_service_cache = caches['genotypes_service']
-        cache.set('stats:asdf:test:1', 22)
-        cache.set('gen:asdf:test:1', 22)
-        gen_service_cache.set('asdf', 22)
+        ns = cache_namespace('asdf')
+        gen_service_cache.set(service_key('asdf'), 22)
         update_db(old_vdb, new_vdb)
-        self.assertNotIn('stats:asdf:test:1', cache.keys('stats:*'))
-        self.assertNotIn('gen:asdf:test:1', cache.keys('gen:*'))
-        self.assertNotIn('asdf', gen_service_cache)
+        self.assertNotEqual(cache_namespace('asdf'), ns)
+        self.assertNotIn(service_key('asdf'), gen_service_cache)
 
     def test_diff_disk_VariantsDb(self):
         """Add a new empty sqlite artificially. It should be added to settings and VariantsDb."""
@@ -156,6 +155,30 @@ class TestManageDbs(django.test.TestCase):
             dbs = VariantsDb.objects.values_list('filename', flat=True)
             self.assertIn(filename, dbs)
 
+    def test_diff_disk_VariantsDb_hash_first(self):
+        """New files are hashed before the rows are locked."""
+        from django.db import transaction
+        from varapp.common import db_utils
+        filename = 'tmp'+random_string(10)+'.db'
+        locked = []
+        hashed_when_locked = []
+        @contextmanager
+        def atomic():
+            locked.append(True)
+            with transaction.atomic():
+                yield
+        sha1sum = db_utils.sha1sum
+        def sha1sum_spy(path):
+            hashed_when_locked.append(bool(locked))
+            return sha1sum(path)
+        with TempSqliteContext(filename, TEST_DB_PATH), \
+                mock.patch('varapp.common.manage_dbs.transaction', mock.Mock(atomic=atomic)), \
+                mock.patch.object(db_utils, 'sha1sum', sha1sum_spy):
+            diff_disk_VariantsDb(path=TEST_DB_PATH)
+            self.assertTrue(VariantsDb.objects.filter(filename=filename).exists())
+        self.assertTrue(hashed_when_locked)
+        self.assertNotIn(True, hashed_when_locked)
+
     def test_update_if_db_changed_testdb(self):
         testdb = VariantsDb.objects.get(filename=DB_TEST)
         changed = update_if_db_changed(testdb)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy as np
+from varapp.common.masking import *
+
+
+class TestMasking(unittest.TestCase):
+    def test_factorize(self):
+        uniques, codes = factorize(['b', None, 'a', 'b', None])
+        self.assertEqual(uniques, ['a', 'b', None])
+        self.assertEqual(codes.tolist(), [1, 2, 0, 1, 2])
+        uniques, codes = factorize([1, 0, 1])
+        self.assertEqual(uniques, [0, 1])
+        self.assertIsInstance(uniques[0], int)
+        uniques, codes = factorize([None])
+        self.assertEqual(uniques, [None])
+        self.assertEqual(factorize([])[0], [])
+
+    def test_value_masks(self):
+        ids = [3, 1, 2, 5]
+        uniques, codes = factorize(['x', 'y', 'x', None])
+        masks = value_masks(ids, codes, len(uniques), 6)
+        self.assertEqual(len(masks), 3)
+        self.assertEqual(unpack(masks[0], 6).tolist(), [0, 1, 1, 0, 0, 0])  # 'x'
+        self.assertEqual(unpack(masks[1], 6).tolist(), [1, 0, 0, 0, 0, 0])  # 'y'
+        self.assertEqual(unpack(masks[2], 6).tolist(), [0, 0, 0, 0, 1, 0])  # None
+
+    def test_popcount(self):
+        a = np.random.randint(0, 2, 1000).astype(np.bool_)
+        self.assertEqual(popcount(pack(a)), np.count_nonzero(a))
+        matrix = np.vstack([pack(a), pack(~a), pack(np.ones(1000, dtype=np.bool_))])
+        self.assertEqual(popcount_rows(matrix, pack(a), block=2).tolist(), [np.count_nonzero(a), 0, np.count_nonzero(a)])
+
+    def test_binary_not(self):
+        a = pack(np.array([1, 0, 1, 1, 0, 0, 0, 0, 1, 0], dtype=np.bool_))
+        self.assertEqual(unpack(binary_not(a, 10), 16).tolist(), [0, 1, 0, 0, 1, 1, 1, 1, 0, 1] + [0]*6)
+
+    def test_first_in_order(self):
+        a = np.array([1, 0, 1, 1, 0, 1], dtype=np.bool_)
+        self.assertEqual(first_in_order([6, 5, 4, 3, 2, 1], a, 3, chunk=2).tolist(), [6, 4, 3])
+        self.assertEqual(first_in_order([6, 5, 4, 3, 2, 1], a, 10).tolist(), [6, 4, 3, 1])
+        # Same on the packed array
+        self.assertEqual(first_in_order([6, 5, 4, 3, 2, 1], pack(a), 3, chunk=2, size=6).tolist(), [6, 4, 3])
+        self.assertEqual(first_in_order([9, 6, 5, 4, 3, 2, 1], pack(a), 10, size=6).tolist(), [6, 4, 3, 1])
+
+    def test_pack_indices(self):
+        for size in [1, 8, 13, 100]:
+            ids = np.unique(np.random.randint(1, size+1, size // 2 + 1))
+            self.assertEqual(pack_indices(ids, size).tolist(), pack(to_binary_array(ids, size)).tolist())
+            self.assertEqual(is_set(pack_indices(ids, size), np.arange(1, size+1)).tolist(),
+                             to_binary_array(ids, size).tolist())
+        self.assertEqual(pack_indices([], 10).tolist(), [0, 0])
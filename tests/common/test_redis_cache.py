@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import unittest
+from varapp.common.cache.redis import *
+
+
+class TestBatchedRedisCache(unittest.TestCase):
+    def setUp(self):
+        self.rcache = BatchedRedisCache('redis', refresh_interval=60)
+        self.keys = ['test:batched:a', 'test:batched:b', 'test:batched:c']
+        self.rcache.cache.delete_many(self.keys)
+
+    def tearDown(self):
+        self.rcache.cache.delete_many(self.keys)
+
+    def test_batched_cache(self):
+        self.assertIs(batched_cache('redis'), batched_cache('redis'))
+
+    def test_get_many_exists_many(self):
+        a,b,c = self.keys
+        self.rcache.set_many({a: 1, b: [2]}, timeout=100)
+        self.assertEqual(self.rcache.get_many(self.keys), {a: 1, b: [2]})
+        self.assertEqual(self.rcache.exists_many(self.keys), {a: True, b: True, c: False})
+        self.assertEqual(self.rcache.exists_many([]), {})
+        self.assertEqual(self.rcache.get(a, timeout=100), 1)
+        self.assertIsNone(self.rcache.get(c, timeout=100))
+
+    def test_touch(self):
+        """The TTL is refreshed at most once per interval."""
+        a,b,c = self.keys
+        self.rcache.cache.set(a, 1, timeout=10)
+        self.rcache.cache.set(b, 1, timeout=10)
+        self.assertEqual(self.rcache.touch([a, b], 1000), 2)
+        self.assertGreater(self.rcache.cache.ttl(a), 10)
+        self.assertGreater(self.rcache.cache.ttl(b), 10)
+        self.assertEqual(self.rcache.touch([a, b], 1000), 0)
+        # Keys that were just set are not refreshed
+        self.rcache.set(c, 1, timeout=10)
+        self.assertEqual(self.rcache.touch([c], 1000), 0)
+        self.rcache.forget([c])
+        self.assertEqual(self.rcache.touch([c], 1000), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy as np
+from django.core.cache import caches
+from varapp.annotation.location_index import location_index
+from varapp.common.cache.resident import *
+from varapp.common.db_utils import service_key
+
+
+class Big:
+    def __init__(self, n):
+        self.array = np.zeros(n, dtype=np.uint8)
+
+
+class TestResidentDbs(unittest.TestCase):
+    def tearDown(self):
+        caches['sort_service'].delete(service_key('other'))
+
+    def test_resident_dbs(self):
+        self.assertIs(resident_dbs(), resident_dbs())
+
+    def test_report(self):
+        location_index('test')
+        rd = ResidentDbs()
+        rd.touch('test')
+        rd.loaded('test')
+        report = rd.report()
+        self.assertGreater(report['test']['caches']['location_index'], 0)
+        self.assertEqual(report['test']['bytes'], sum(report['test']['caches'].values()))
+        self.assertIsNotNone(report['test']['last_access'])
+
+    def test_evict_least_recently_used(self):
+        """When over budget, the least recently used dbs are dropped from all service caches."""
+        rd = ResidentDbs(max_bytes=10**6)
+        rd.touch('other')
+        caches['sort_service'].set(service_key('other'), Big(2 * 10**6))  # loaded by the view
+        self.assertNotIn('other', rd.loaded('other'))  # over budget alone, but being used
+        self.assertIsNotNone(caches['sort_service'].get(service_key('other')))
+        rd.touch('test')
+        index = location_index('test')
+        self.assertEqual(rd.loaded('test'), ['other'])  # counted as soon as the view loaded it
+        self.assertIsNone(caches['sort_service'].get(service_key('other')))
+        self.assertIs(caches['location_index'].get(service_key('test')), index)
+        self.assertGreaterEqual(rd.evictions, 1)
+        self.assertNotIn('other', rd.report())
+
+    def test_no_budget(self):
+        rd = ResidentDbs(max_bytes=0)
+        caches['sort_service'].set(service_key('other'), Big(2 * 10**6))
+        rd.touch('other')
+        rd.loaded('other')
+        rd.touch('test')
+        rd.loaded('test')
+        self.assertIsNotNone(caches['sort_service'].get(service_key('other')))
+
+    def test_measured_once_per_interval(self):
+        """Sizes are kept between two measures of the same db."""
+        rd = ResidentDbs()
+        caches['sort_service'].set(service_key('other'), Big(1000))
+        rd.touch('other')
+        rd.loaded('other')
+        caches['sort_service'].get(service_key('other')).array = np.zeros(5000, dtype=np.uint8)
+        rd.loaded('other')
+        self.assertLess(rd.report()['other']['caches']['sort_service'], 5000)
+        rd._measured['other'] -= MEASURE_INTERVAL
+        rd.loaded('other')
+        self.assertGreaterEqual(rd.report()['other']['caches']['sort_service'], 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
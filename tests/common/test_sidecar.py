@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import unittest
+import sqlite3
+from django.db import connections
+from varapp.common import sidecar
+from varapp.common.sidecar import *
+from varapp.common.db_utils import set_db_hash, DB_HASHES
+from varapp.filters.filters import FiltersCollection
+from varapp.filters.variant_filters import QualityFilter, ImpactFilter
+from varapp.filters.genotype_filters import GenotypesFilterActive
+from varapp.filters.filters_factory import expression_filter_factory
+from varapp.samples.samples_factory import samples_selection_factory
+from tests.test_utils import TempDirSettings
+
+
+class TestSidecar(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TempDirSettings({'SIDECAR_DB_PATH': ''})
+        self.tmpdir.enable()
+
+    def tearDown(self):
+        sidecar._aliases.pop('test', None)
+        sidecar._missing.clear()
+        self.tmpdir.disable()
+
+    def test_no_hash(self):
+        DB_HASHES.pop('test', None)
+        self.assertIsNone(build_sidecar('test'))
+        self.assertEqual(index_db('test'), 'test')
+
+    def test_build_sidecar(self):
+        set_db_hash('test', 'sidecartest')
+        self.assertEqual(index_db('test'), 'test')  # not built yet
+        self.assertIn('sidecartest', sidecar._missing)
+        path = build_sidecar('test')
+        self.assertNotIn('sidecartest', sidecar._missing)
+        self.assertNotEqual(index_db('test'), 'test')
+        self.assertEqual(path, sidecar_path('sidecartest'))
+        conn = sqlite3.connect(path)
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(variants)")]
+        indexes = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        conn.close()
+        self.assertNotIn('gts', columns)
+        self.assertIn('polyphen_pred', columns)
+        self.assertIn('polyphen_pred_idx', indexes)
+        self.assertIn('location_idx', indexes)
+        # Idempotent
+        self.assertEqual(build_sidecar('test'), path)
+
+    def test_missing_recheck(self):
+        """A missing sidecar is not looked for again until MISSING_RECHECK, unless built here."""
+        set_db_hash('test', 'sidecarmissing')
+        self.assertEqual(index_db('test'), 'test')
+        open(sidecar_path('sidecarmissing'), 'w').close()  # as if built by another process
+        self.assertEqual(index_db('test'), 'test')
+        sidecar._missing['sidecarmissing'] -= MISSING_RECHECK
+        self.assertEqual(index_db('test'), index_alias('test', 'sidecarmissing'))
+        release_index_db('test', 'sidecarmissing')
+
+    def test_filters_on_sidecar(self):
+        """Filtering on the sidecar gives the same result as on the Gemini db."""
+        ss = samples_selection_factory(db='test', groups={'affected': ['09818', '09819']})
+        fc = FiltersCollection([QualityFilter(op='>=', val='100'), ImpactFilter(val='missense_variant,synonymous_variant'),
+                                GenotypesFilterActive(ss)])
+        expected = fc.apply(db='test', sort_by='cadd_raw', limit=20)
+        set_db_hash('test', 'sidecartest')
+        build_sidecar('test')
+        alias = index_db('test')
+        self.assertNotEqual(alias, 'test')
+        result = fc.apply(db='test', sort_by='cadd_raw', limit=20)
+        self.assertGreater(expected.n_filtered, 0)
+        self.assertEqual(result.n_filtered, expected.n_filtered)
+        self.assertEqual([v.variant_id for v in result.variants], [v.variant_id for v in expected.variants])
+        self.assertEqual(result.variants[0].gt_types_blob, expected.variants[0].gt_types_blob)  # rows from the Gemini db
+        connections[alias].close()
+
+    def test_not_on_sidecar(self):
+        """The subquery of a NOT expression runs on the sidecar too."""
+        fc = FiltersCollection([expression_filter_factory('NOT in_dbsnp', db='test')])
+        expected = fc.apply(db='test', limit=5)
+        set_db_hash('test', 'sidecarnot')
+        build_sidecar('test')
+        alias = index_db('test')
+        self.assertNotEqual(alias, 'test')
+        result = fc.apply(db='test', limit=5)
+        self.assertGreater(expected.n_filtered, 0)
+        self.assertEqual(result.n_filtered, expected.n_filtered)
+        self.assertEqual([v.variant_id for v in result.variants], [v.variant_id for v in expected.variants])
+        connections[alias].close()
+        release_index_db('test', 'sidecarnot')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import unittest
+import threading
+import time
+from unittest import mock
+from varapp.common.cache import single_flight
+from varapp.common.cache.single_flight import *
+
+
+class TestSingleFlight(unittest.TestCase):
+    def hold(self, lock_context, seconds):
+        """Hold a lock in another thread for that many seconds. Return when it is held."""
+        held = threading.Event()
+        def run():
+            with lock_context:
+                held.set()
+                time.sleep(seconds)
+        t = threading.Thread(target=run)
+        t.start()
+        held.wait()
+        return t
+
+    def test_build_lock(self):
+        """A second builder gives up after waiting *wait* seconds."""
+        t = self.hold(build_lock('test:single_flight'), 0.5)
+        with self.assertRaises(CacheWarming):
+            with build_lock('test:single_flight', wait=0.1):
+                pass
+        with build_lock('test:single_flight', wait=2):  # waits for the first one
+            self.assertFalse(t.is_alive())
+        t.join()
+
+    def test_build_wait(self):
+        """The default wait is changed in this thread and context only."""
+        with build_wait(BUILD_LOCK_TIMEOUT):
+            self.assertEqual(default_wait(), BUILD_LOCK_TIMEOUT)
+            other = []
+            t = threading.Thread(target=lambda: other.append(default_wait()))
+            t.start()
+            t.join()
+            self.assertEqual(other, [single_flight.BUILD_WAIT])
+        self.assertEqual(default_wait(), single_flight.BUILD_WAIT)
+
+    def test_build_lock_release_unavailable(self):
+        """If Redis went away meanwhile, the lock is left to expire."""
+        from redis.lock import Lock
+        from redis.exceptions import ConnectionError
+        with mock.patch.object(Lock, 'release', side_effect=ConnectionError):
+            with build_lock('test:single_flight:release', timeout=1):
+                pass
+
+    def test_file_lock(self):
+        t = self.hold(file_lock('test:single_flight'), 0.5)
+        with self.assertRaises(CacheWarming):
+            with file_lock('test:single_flight', wait=0.1):
+                pass
+        with file_lock('test:single_flight', wait=2):
+            self.assertFalse(t.is_alive())
+        t.join()
+
+    def test_single_builder(self):
+        """With double-checking, concurrent builders build only once."""
+        built = []
+        def build():
+            if not built:
+                with build_lock('test:single_flight'):
+                    if not built:
+                        time.sleep(0.1)
+                        built.append(1)
+        threads = [threading.Thread(target=build) for _ in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(built), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
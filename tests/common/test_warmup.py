@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import unittest
+from varapp.common import warmup
+from varapp.common.warmup import *
+
+
+class TestWarmup(unittest.TestCase):
+    def test_usage_order(self):
+        warmup._last_usage_records.clear()
+        record_usage('db_a')
+        time.sleep(0.01)
+        record_usage('db_b')
+        self.assertEqual(usage_order(['db_a', 'never_used', 'db_b']), ['db_b', 'db_a', 'never_used'])
+
+    def test_warmup_inline(self):
+        scheduler = WarmupScheduler(workers=0).start(['test'])
+        self.assertEqual(scheduler.status('test')['state'], READY)
+        self.assertTrue(scheduler.is_done())
+        self.assertIsNone(scheduler.status('unknown'))
+
+    def test_warmup_failed(self):
+        """A failing db does not prevent the others to be warmed up."""
+        scheduler = WarmupScheduler(workers=0).start(['does_not_exist', 'test'])
+        self.assertEqual(scheduler.status('does_not_exist')['state'], FAILED)
+        self.assertIsNotNone(scheduler.status('does_not_exist')['error'])
+        self.assertEqual(scheduler.status('test')['state'], READY)
+        self.assertTrue(scheduler.is_done())
+
+    def test_warmup_pool(self):
+        """Dbs are built in worker processes, in the background."""
+        scheduler = WarmupScheduler(workers=2).start(['test'])
+        scheduler._thread.join(60)
+        self.assertEqual(scheduler.status('test')['state'], READY)
+        self.assertTrue(scheduler.is_done())
+
+    def test_warmup_inline_with_workers(self):
+        scheduler = WarmupScheduler(workers=2).start(['test'], inline=True)
+        self.assertIsNone(scheduler._thread)
+        self.assertEqual(scheduler.status('test')['state'], READY)
+
+    def test_preload(self):
+        """Everything is loaded in local memory, and shared arrays are read-only."""
+        from varapp.variants.genotypes_service import genotypes_service
+        preload(['test'])
+        gs = genotypes_service('test')
+        self.assertIsNotNone(gs._chrX)
+        self.assertIsNotNone(gs._gene_batches)
+        self.assertFalse(gs.genotypes.flags.writeable)
+        self.assertFalse(gs.chrX.flags.writeable)
+        self.assertTrue(all(not ids.flags.writeable for ids in gs.variant_ids_batches_by_gene.values()))
+        self.assertIs(gs.chrX, gs.chrX)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ Django conf file for Jenkins. The test db is an sqlite, and users and variants c
 """
 from varmed.settings.base import *
 from os.path import join
-import os, sys, logging
+import os, sys, logging, tempfile
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(message)s')
 logging.info("\n-----------  << RESTART >> -----------\n")
 logging.info("// TEST // settings file (env.py): " + os.path.basename(__file__))
@@ -23,6 +23,9 @@ GEMINI_DB_PATH = './resources/db/test'
 DB_TEST = 'testdb_0036.db'
 WARMUP_STATS_CACHE = True
 WARMUP_GENOTYPES_CACHE = True
+WARMUP_WORKERS = 0
+DB_WATCH_INTERVAL = 0
+DB_VERSIONS_PATH = tempfile.mkdtemp(prefix='varapp-versions-')  # keep pins of test dbs out of the repository
 
 ## Users db
 DB_USERS = 'testdb_0036.db'
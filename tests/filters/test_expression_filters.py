@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import unittest
+from django.test.client import RequestFactory
+from varapp.common import masking
+from varapp.data_models.variants import Variant
+from varapp.filters.expression_filters import *
+from varapp.filters.filters import FiltersCollection
+from varapp.filters.filters_factory import expression_filter_factory, variant_filters_from_request
+from varapp.filters.genotype_filters import GenotypesFilterActive
+from varapp.samples.samples_factory import samples_selection_factory
+from varapp.variants.variants_factory import namedtuples
+from varapp.constants.tests import NVAR
+
+EXPRESSIONS = [
+    "(impact_severity=HIGH OR cadd_scaled>=25) AND NOT in_dbsnp",
+    "NOT (sift_pred=deleterious OR type=indel)",
+    "in_exac and (quality>=100 or not is_coding)",
+    "NOT impact=missense_variant AND NOT sift_score<=0.05",
+]
+
+
+class TestParseExpression(unittest.TestCase):
+    def test_precedence(self):
+        """AND has precedence over OR, NOT over AND."""
+        tree = parse_expression("a OR NOT b AND c", lambda t: t)
+        self.assertEqual(tree, (OR, ['a', (AND, [(NOT, 'b'), 'c'])]))
+
+    def test_parentheses(self):
+        tree = parse_expression("(a or b) and not (c)", lambda t: t)
+        self.assertEqual(tree, (AND, [(OR, ['a', 'b']), (NOT, 'c')]))
+        tree = parse_expression("((a))", lambda t: t)
+        self.assertEqual(tree, 'a')
+
+    def test_terms(self):
+        """Terms are kept whole, with their operator and value."""
+        tree = parse_expression("quality>=100 AND impact=a,b", lambda t: t)
+        self.assertEqual(tree, (AND, ['quality>=100', 'impact=a,b']))
+
+    def test_invalid(self):
+        for expr in ["", "a AND", "(a OR b", "a b", "a OR )", "NOT"]:
+            with self.assertRaises(ValueError):
+                parse_expression(expr, lambda t: t)
+
+
+class TestExpressionFilter(unittest.TestCase):
+    def setUp(self):
+        self.N = Variant.objects.using('test').count()
+
+    def test_factory(self):
+        f = expression_filter_factory(EXPRESSIONS[0], db='test')
+        self.assertIsInstance(f, ExpressionFilter)
+        self.assertEqual([x.name for x in f.leaves], ['impact_severity', 'cadd_scaled', 'in_dbsnp'])
+        self.assertEqual(f.val, EXPRESSIONS[0])
+
+    def test_genotype_leaf(self):
+        with self.assertRaises(ValueError):
+            expression_filter_factory("quality>=100 OR genotype=active", db='test')
+
+    def test_mask_same_as_sql_and_condition(self):
+        """The three ways of evaluating an expression give the same variants."""
+        variants = namedtuples(Variant.objects.using('test'))
+        for expr in EXPRESSIONS:
+            f = expression_filter_factory(expr, db='test')
+            from_mask = masking.to_indices(masking.unpack(f.mask(self.N), self.N)) + 1
+            from_sql = Variant.objects.using('test').filter(f.django_condition()).values_list('variant_id', flat=True)
+            from_condition = [v.variant_id for v in variants if f.condition(v)]
+            self.assertEqual(from_mask.tolist(), sorted(from_sql), expr)
+            self.assertEqual(from_mask.tolist(), sorted(from_condition), expr)
+            self.assertTrue(0 < len(from_mask) < NVAR, expr)
+
+    def test_not_is_complement(self):
+        f = expression_filter_factory("cadd_scaled>=25", db='test')
+        nf = expression_filter_factory("NOT cadd_scaled>=25", db='test')
+        n1 = Variant.objects.using('test').filter(f.django_condition()).count()
+        n2 = Variant.objects.using('test').filter(nf.django_condition()).count()
+        self.assertEqual(n1 + n2, NVAR)
+        self.assertEqual(masking.popcount(f.mask(self.N)) + masking.popcount(nf.mask(self.N)), NVAR)
+
+    def test_apply_with_genotype_filter(self):
+        """In FiltersCollection.apply, the expression is evaluated as a mask."""
+        ss = samples_selection_factory(db='test')
+        f = expression_filter_factory(EXPRESSIONS[0], db='test')
+        fc = FiltersCollection([f, GenotypesFilterActive(ss, db='test')])
+        result = fc.apply(db='test', sort_by='quality', limit=10)
+        active = set(GenotypesFilterActive(ss, db='test').apply(db='test').ids)
+        expected = [x for x in Variant.objects.using('test').filter(f.django_condition())
+                    .order_by('quality', 'variant_id').values_list('variant_id', flat=True) if x in active]
+        self.assertEqual(result.n_filtered, len(expected))
+        self.assertEqual(result.variants.ids, expected[:10])
+
+    def test_from_request(self):
+        request = RequestFactory().get('', [('filter', 'quality>=100'), ('expr', EXPRESSIONS[0]), ('expr', EXPRESSIONS[1])])
+        fc = variant_filters_from_request(request, db='test')
+        self.assertEqual(len(fc), 2)
+        f = fc['expression']
+        self.assertIsInstance(f, ExpressionFilter)
+        self.assertEqual(f.tree[0], AND)
+        self.assertEqual(len(f.leaves), 5)
@@ -164,6 +164,36 @@ class TestApplyFiltersCollection(unittest.TestCase):
         self.assertNotEqual(r2.variants.ids, r4.variants.ids, "the ordering changed before subsetting")
         self.assertEqual(r4.variants.ids, r3.variants.ids[2:4], "the subset is the right one")
 
+    def test_apply_with_cursor(self):
+        """Resuming from the cursor of a page gives the same variants as the next offset."""
+        fc = FiltersCollection([self.qfilter])
+        for sort_by, reverse in [(None, False), ('quality', False), ('quality', True)]:
+            r1 = fc.apply(db='test', sort_by=sort_by, reverse=reverse, limit=3)
+            self.assertIsNotNone(r1.cursor)
+            r2 = fc.apply(db='test', sort_by=sort_by, reverse=reverse, limit=3, cursor=r1.cursor)
+            r3 = fc.apply(db='test', sort_by=sort_by, reverse=reverse, limit=3, offset=3)
+            self.assertEqual(r2.variants.ids, r3.variants.ids)
+            self.assertEqual(r2.n_filtered, r1.n_filtered)
+
+    def test_apply_with_gf_and_cursor(self):
+        """Same with a genotype filter, where the page is extracted from the ordered ids."""
+        fc = FiltersCollection([self.qfilter, self.dominant])
+        r1 = fc.apply(db='test', sort_by='quality', limit=2)
+        r2 = fc.apply(db='test', sort_by='quality', limit=2, cursor=r1.cursor)
+        r3 = fc.apply(db='test', sort_by='quality', limit=2, offset=2)
+        self.assertEqual(r2.variants.ids, r3.variants.ids)
+
+    def test_apply_top_k(self):
+        """With a limit, the count and the ids are still those of the whole filtered set."""
+        fc = FiltersCollection([self.qfilter, self.dominant])
+        r0 = fc.apply(db='test', sort_by='quality')
+        r1 = fc.apply(db='test', sort_by='quality', limit=5, offset=3)
+        self.assertIsNotNone(r1.mask)
+        self.assertEqual(r1.n_filtered, r0.n_filtered)
+        self.assertEqual(r1.n_filtered, len(r1.ids))
+        self.assertEqual(set(r1.ids), set(r0.ids))
+        self.assertEqual(r1.variants.ids, r0.variants.ids[3:8])
+
     def test_apply_with_only_genotype_filter(self):
         fc = FiltersCollection([self.dominant])
         result = fc.apply(db='test')
@@ -214,6 +244,18 @@ class TestApplyFiltersCollection(unittest.TestCase):
         self.assertEqual(res.n_filtered, len(res.ids), "If equal the test is useless")
         self.assertNotEqual(res.n_filtered, len(var))
 
+    def test_apply_mask_only(self):
+        """Only the filtered set is computed, the same as with a page of variants."""
+        fc = FiltersCollection([self.qfilter, self.dominant])
+        res = fc.apply(db='test', limit=2, sort_by='quality')
+        only = fc.apply(db='test', mask_only=True, sort_by='quality')
+        self.assertEqual(len(only.variants), 0)
+        self.assertEqual(only.n_filtered, res.n_filtered)
+        self.assertEqual(only.mask.tolist(), res.mask.tolist())
+        fc = FiltersCollection([self.qfilter])
+        self.assertEqual(sorted(fc.apply(db='test', mask_only=True).ids.tolist()),
+                         sorted(fc.apply(db='test').ids.tolist()))
+
     def test_apply_with_gf_and_limit_and_offset(self):
         """Should return at most *limit* variants, skipping the first *offset*."""
         limit = 2
@@ -4,7 +4,7 @@ import unittest
 from django.test.client import RequestFactory
 from varapp.models.gemini import Variants
 from varapp.variants.variants_factory import variants_collection_factory
-from varapp.filters.pagination import Pagination, pagination_from_request
+from varapp.filters.pagination import Pagination, Cursor, pagination_from_request
 
 
 #@unittest.skip('')
@@ -77,6 +77,72 @@ class TestPagination(unittest.TestCase):
         self.assertEqual(var[0].variant_id, self.variants[N].variant_id)
 
 
+class TestCursor(unittest.TestCase):
+    def setUp(self):
+        self.variants_django = Variants.objects.using('test').all()
+
+    def test_encode_decode(self):
+        """A cursor survives its round trip through the frontend."""
+        cursor = Cursor(['chr1', 12345], 42, ['chrom','start'])
+        s = cursor.encode()
+        self.assertIsInstance(s, str)
+        back = Cursor.decode(s)
+        self.assertEqual(back.key, ['chr1', 12345])
+        self.assertEqual(back.variant_id, 42)
+        self.assertEqual(back.fields, ['chrom','start'])
+        self.assertFalse(back.reverse)
+
+    def test_decode_invalid(self):
+        with self.assertRaises(ValueError):
+            Cursor.decode('not a cursor')
+
+    def test_check_ordering(self):
+        """A cursor cannot be used with another ordering than its own."""
+        cursor = Cursor([0.5], 42, ['quality'], reverse=True)
+        cursor.check(['quality'], True)
+        with self.assertRaises(ValueError):
+            cursor.check(['quality'], False)
+        with self.assertRaises(ValueError):
+            cursor.check(['chrom','start'], True)
+
+    def test_pagination_from_request_cursor(self):
+        cursor = Cursor([None], 7, ['aaf_1kg_all'])
+        request = RequestFactory().get('/', {'limit':'10', 'cursor':cursor.encode()})
+        pagination = pagination_from_request(request)
+        self.assertEqual(pagination.cursor.variant_id, 7)
+        self.assertEqual(pagination.cursor.key, [None])
+
+    def test_condition(self):
+        """The cursor condition selects exactly the variants after it in the db ordering,
+        from every page: the values of a DecimalField are rounded by the model, not in the db."""
+        for field, reverse in [('start', False), ('aaf_1kg_all', False), ('aaf_1kg_all', True)]:
+            sign = '-' if reverse else ''
+            qs = self.variants_django.order_by(sign+field, sign+'variant_id')
+            ordered = list(qs.values_list('variant_id', flat=True))
+            for N in range(7, len(ordered), 7):
+                cursor = Cursor.from_db(qs, ordered[N-1], [field], reverse)
+                after = list(qs.filter(cursor.condition()).values_list('variant_id', flat=True))
+                self.assertEqual(after, ordered[N:])
+
+    def test_walk_pages(self):
+        """Following the cursors of a sorted result returns each variant once, then ends."""
+        from varapp.filters.filters import FiltersCollection
+        from varapp.filters.variant_filters import QualityFilter
+        fc = FiltersCollection([QualityFilter(val='10', op='>=', db='test')])
+        for reverse in (False, True):
+            result = fc.apply(db='test', sort_by='aaf_1kg_all', reverse=reverse)
+            seen = []
+            cursor = None
+            for _ in range(len(result.variants)):
+                page = fc.apply(db='test', sort_by='aaf_1kg_all', reverse=reverse, limit=7, cursor=cursor)
+                seen.extend(v.variant_id for v in page.variants)
+                cursor = page.cursor
+                if cursor is None:
+                    break
+            self.assertIsNone(cursor)
+            self.assertEqual(seen, [v.variant_id for v in result.variants])
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -50,6 +50,12 @@ class TestStatsContinuous(unittest.TestCase):
         self.assertEqual(histo.max, 0)
 
 
+class TestHistogram(unittest.TestCase):
+    def test_Histogram(self):
+        h = Histogram([0, 0.5, 1], [3, 4], no_value=2)
+        self.assertEqual(h.expose(), {'breaks': [0, 0.5, 1], 'counts': [3, 4], 'no_value': 2})
+
+
 if __name__ == '__main__':
     unittest.main()
 
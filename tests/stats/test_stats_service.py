@@ -1,5 +1,9 @@
 import unittest
-from varapp.stats.stats_service import stats_service, GlobalStatsService
+from django.core.cache import caches
+from django.db import connections
+from varapp.common import masking
+from varapp.common.db_utils import get_db_hash, set_db_hash, service_key
+from varapp.stats.stats_service import stats_service, GlobalStatsService, MasksMatrix, BinnedColumns
 from varapp.stats.variant_stats import VariantStats
 from varapp.variants.variants_factory import variants_collection_factory
 from varapp.data_models.variants import Variant
@@ -18,6 +22,33 @@ class TestStatsService(unittest.TestCase):
         sts = stats_service(db='test')
         self.assertIsInstance(sts, GlobalStatsService)
 
+    def test_stats_service_memoized(self):
+        """stats_service(db) returns the same service until the db hash changes."""
+        sts = stats_service(db='test')
+        self.assertIs(stats_service(db='test'), sts)
+        old_hash = get_db_hash('test')
+        try:
+            set_db_hash('test', 'another hash')
+            sts2 = stats_service(db='test')
+            self.assertIsNot(sts2, sts)
+            self.assertEqual(sts2.hash, 'another hash')
+            self.assertIs(stats_service(db='test'), sts2)
+        finally:
+            set_db_hash('test', old_hash)
+
+    def test_services_memoized_per_generation(self):
+        """Bumping the cache generation of a db, e.g. from another process, renews its local services."""
+        from varapp.common.db_utils import bump_cache_generation
+        from varapp.variants.genotypes_service import genotypes_service
+        from varapp.variants.sort_service import sort_service
+        from varapp.annotation.location_index import location_index
+        factories = [stats_service, genotypes_service, sort_service, location_index]
+        services = [f('test') for f in factories]
+        self.assertEqual([f('test') for f in factories], services)
+        bump_cache_generation('test')
+        for f, service in zip(factories, services):
+            self.assertIsNot(f('test'), service)
+
     def test_GLobalStatsService(self):
         """Check attributes"""
         VS = GlobalStatsService('test')
@@ -64,6 +95,96 @@ class TestStatsService(unittest.TestCase):
         self.assertEqual(stats.stats['in_dbsnp'].counts[True], freq_filtered.filter(in_dbsnp=True).count())
         self.assertEqual(stats.stats['in_dbsnp'].counts[False], freq_filtered.filter(in_dbsnp=False).count())
 
+    def test_make_stats_from_mask(self):
+        """Same stats from a (shorter) packed mask as from the list of ids."""
+        VS = GlobalStatsService('test')
+        ids = list(self.qs.filter(quality__gte=100, variant_id__lte=self.N-10).values_list('variant_id',flat=True))
+        mask = masking.pack(masking.to_binary_array(ids, self.N-10))
+        s1 = VS.make_stats(ids)
+        s2 = VS.make_stats(mask=mask)
+        self.assertEqual(s2.total_count, len(ids))
+        self.assertEqual(s1.expose(), s2.expose())
+
+    def test_query_stats(self):
+        """Stats of a filtered set are computed once, then read from cache."""
+        VS = GlobalStatsService('test')
+        VS.cache.delete(VS.key_query_stats('some query'))
+        computed = []
+        def compute():
+            computed.append(1)
+            return VS.make_stats([1, 2, 3])
+        s1 = VS.query_stats('some query', compute)
+        s2 = VS.query_stats('some query', compute)
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(s1.expose(), s2.expose())
+        VS.cache.delete(VS.key_query_stats('some query'))
+
+    def test_masks_matrix(self):
+        """All masks are kept in local memory, the same as in Redis."""
+        VS = GlobalStatsService('test')
+        masks = VS.masks_matrix()
+        self.assertIsInstance(masks, MasksMatrix)
+        self.assertIs(caches['stats_masks'].get(service_key('test')), masks)
+        self.assertEqual(masks.width, (self.N+7)//8)
+        for val, mask in masks.masks('impact'):
+            self.assertEqual(mask.tolist(), VS.get_mask('impact', val).tolist())
+        # Reloaded from Redis
+        caches['stats_masks'].delete(service_key('test'))
+        reloaded = GlobalStatsService('test').masks_matrix()
+        self.assertIsNot(reloaded, masks)
+        for f in DISCRETE_FILTER_NAMES:
+            self.assertEqual({v: m.tolist() for v,m in reloaded.masks(f)}, {v: m.tolist() for v,m in masks.masks(f)})
+
+    def test_masks_matrix_expired(self):
+        """A mask that expired after the masks were found ready is built again."""
+        VS = GlobalStatsService('test')
+        masks = VS.masks_matrix()
+        caches['stats_masks'].delete(service_key('test'))
+        val = next(masks.masks('impact'))[0]
+        VS.cache.delete(VS.key_mask('impact', val))
+        self.assertIsNone(VS._load_masks_matrix())
+        rebuilt = VS.masks_matrix()
+        self.assertEqual({v: m.tolist() for v,m in rebuilt.masks('impact')},
+                         {v: m.tolist() for v,m in masks.masks('impact')})
+        self.assertTrue(VS._check_masks_ready())
+
+    def test_column_masks(self):
+        """The masks of any discrete field are the same as filtering in the db."""
+        VS = GlobalStatsService('test')
+        for f in ['impact', 'in_dbsnp', 'impact_so', 'clinvar_sig']:
+            masks = VS._column_masks(f)
+            for val, mask in masks.items():
+                expected = list(self.qs.filter(**{f: val}).values_list('variant_id', flat=True)) if val is not None \
+                      else list(self.qs.filter(**{f+'__isnull': True}).values_list('variant_id', flat=True))
+                ids = masking.to_indices(masking.unpack(mask, self.N)) + 1
+                self.assertEqual(sorted(ids.tolist()), sorted(expected), (f, val))
+            self.assertEqual(sum(masking.popcount(m) for m in masks.values()), self.N)
+
+    def test_make_stats_histograms(self):
+        """Histograms of numeric fields for a subset are the same as counting the db values."""
+        VS = GlobalStatsService('test')
+        subset = self.qs.filter(quality__gte=100)
+        ids = list(subset.values_list('variant_id', flat=True))
+        stats = VS.make_stats(ids)
+        cursor = connections['test'].cursor()
+        for f in CONTINUOUS_FILTER_NAMES + FREQUENCY_FILTER_NAMES:
+            hist = stats.stats[f]
+            # Raw values, because the ORM rounds decimal fields
+            cursor.execute("SELECT {} FROM variants WHERE qual >= 100".format(Variant._meta.get_field(f).column))
+            values = np.array([r[0] for r in cursor.fetchall()], dtype=np.float64)
+            known = (values >= hist.breaks[0]) & (values <= hist.breaks[-1]) if hist.breaks else np.zeros(len(values), bool)
+            self.assertEqual(hist.no_value, np.count_nonzero(~known), f)
+            values = values[known]
+            expected = np.histogram(values, bins=hist.breaks)[0] if len(hist.counts) else []
+            self.assertEqual(hist.counts, list(expected), f)
+        self.assertEqual(stats.stats['aaf_1kg_all'].breaks, [0, 0.001, 0.01, 0.05, 1])
+        self.assertIsInstance(VS.binned_columns(), BinnedColumns)
+
+    def test_digitize(self):
+        breaks = np.array([0, 1, 2, 4])
+        codes = BinnedColumns.digitize(np.array([0, 0.5, 1, 3, 4, np.nan, -1, 5]), breaks)
+        self.assertEqual(codes.tolist(), [0, 0, 1, 2, 2, 3, 3, 3])
+
     def test_init_impacts(self):
         VS = GlobalStatsService('test')
         impacts = VS.get_global_stats().stats['impact']['pairs']
@@ -25,5 +25,27 @@ class TestValidators(unittest.TestCase):
         self.assertFalse(check_user_exists('test','test2'))
 
 
+class TestAuthorizations(unittest.TestCase):
+    def setUp(self):
+        invalidate_authorizations()
+
+    def test_authorizations(self):
+        user = find_user('test', 'test')
+        self.assertIsNone(get_authorization('test', 'test', 'test'))
+        set_authorization(user, 'test')
+        set_authorization(user)
+        self.assertEqual(get_authorization('test', 'test', 'test'), user.id)
+        self.assertEqual(get_authorization('test', 'test'), user.id)
+        self.assertIsNone(get_authorization('test', 'test', 'other'))
+        self.assertIsNone(get_authorization('test', 'other', 'test'))
+        self.assertEqual(find_user_by_id(user.id), user)
+
+    def test_attribute_db_invalidates(self):
+        """Modifying an access forgets all authorizations."""
+        user = find_user('test', 'test')
+        set_authorization(user, 'test')
+        attribute_db('test', 'test', 'test', 'true')
+        self.assertIsNone(get_authorization('test', 'test', 'test'))
+
 if __name__ == '__main__':
     unittest.main()
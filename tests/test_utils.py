@@ -1,10 +1,12 @@
 
 import threading
 import os, sqlite3
+import tempfile
 from varapp.common.utils import random_string
-from varapp.common.db_utils import db_name_from_filename
+from varapp.common.db_utils import db_name_from_filename, DB_HASHES
 from django.conf import settings
 from django.db import connections
+from django.test.utils import override_settings
 TEST_DB_PATH = settings.GEMINI_DB_PATH
 
 def create_dummy_db(filename, path, overwrite=False):
@@ -46,6 +48,39 @@ class TempSqliteContext():
             connections.databases.pop(name)
 
 
+class TempDirSettings():
+    """Settings pointing into a new temporary directory, until `disable`. The hashes of the dbs
+    known to this process (DB_HASHES), that tests change, are restored then.
+    :param paths: {setting name: subdirectory of the temporary directory ('' for itself)}.
+    :param kwargs: other settings to override.
+    """
+    def __init__(self, paths, **kwargs):
+        self.paths = paths
+        self.kwargs = kwargs
+
+    def enable(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.name = self.tmpdir.name
+        overrides = {k: os.path.join(self.name, d) if d else self.name for k, d in self.paths.items()}
+        overrides.update(self.kwargs)
+        self.override = override_settings(**overrides)
+        self.override.enable()
+        self.db_hashes = dict(DB_HASHES)
+        return self.name
+
+    def disable(self):
+        DB_HASHES.clear()
+        DB_HASHES.update(self.db_hashes)
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, return_type, return_value, traceback):
+        self.disable()
+
+
 def with_concurrency(times):
     """
     Add this decorator to small pieces of code that you want to test
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy as np
+from django.core.cache import caches
+from varapp.common.db_utils import service_key
+from varapp.data_models.variants import Variant
+from varapp.filters.filters import FiltersCollection
+from varapp.filters.pagination import Cursor, InvalidCursor
+from varapp.filters.variant_filters import QualityFilter
+from varapp.filters.genotype_filters import GenotypesFilterDominant
+from varapp.samples.samples_factory import samples_selection_factory
+from varapp.variants.sort_service import *
+from varapp.constants.tests import NVAR
+
+
+class TestSortService(unittest.TestCase):
+    def setUp(self):
+        self.ss = SortService('test')
+
+    def sql_order(self, fields, reverse=False):
+        sign = '-' if reverse else ''
+        return list(Variant.objects.using('test').order_by(*[sign+f for f in fields + ['variant_id']])
+                    .values_list('variant_id', flat=True))
+
+    def test_ranks(self):
+        self.assertEqual(ranks([3, None, 1, 3]).tolist(), [2, 0, 1, 2])
+        self.assertEqual(ranks(['b', 'a', None]).tolist(), [2, 1, 0])
+        self.assertEqual(ranks([None, None]).tolist(), [0, 0])
+
+    def test_sort_service(self):
+        self.assertIsInstance(sort_service('test'), SortService)
+        self.assertIs(sort_service('test'), sort_service('test'))
+        caches['sort_service'].delete(service_key('test'))
+
+    def test_permutation_same_as_sql(self):
+        """The permutations give the same order as the db, including None and ties."""
+        for fields in [['quality'], ['sift_score'], ['gene_symbol'], ['impact'], LOCATION_FIELDS]:
+            for reverse in [False, True]:
+                perm = self.ss.permutation(fields, reverse)
+                self.assertEqual(len(perm), NVAR)
+                self.assertEqual(perm.tolist(), self.sql_order(fields, reverse), (fields, reverse))
+
+    def test_permutation_is_immutable(self):
+        perm = self.ss.permutation(['quality'])
+        with self.assertRaises(ValueError):
+            perm[0] = 0
+
+    def test_position(self):
+        for reverse in [False, True]:
+            perm = self.ss.permutation(['quality'], reverse)
+            for i in [0, 5, len(perm)-1]:
+                self.assertEqual(self.ss.position(int(perm[i]), ['quality'], reverse), i)
+        # Not a variant of the db, e.g. of another version of it
+        for variant_id in [0, NVAR+1, 10**6, -1]:
+            with self.assertRaises(ValueError):
+                self.ss.position(variant_id, ['quality'])
+
+    def test_first(self):
+        bin_ids = np.zeros(NVAR, dtype=np.bool_)  # variant_id-1 indexed
+        bin_ids[::3] = 1
+        expected = [x for x in self.sql_order(['quality'], True) if bin_ids[x-1]]
+        first = self.ss.first(bin_ids, 10, ['quality'], reverse=True)
+        self.assertEqual(first.tolist(), expected[:10])
+        first = self.ss.first(bin_ids, 10, ['quality'], reverse=True, offset=5)
+        self.assertEqual(first.tolist(), expected[5:15])
+        first = self.ss.first(bin_ids, 10, ['quality'], reverse=True, after_id=expected[4])
+        self.assertEqual(first.tolist(), expected[5:15])
+
+    def test_apply_sorted_with_gf(self):
+        """FiltersCollection.apply returns the same page as sorting in the db."""
+        ss = samples_selection_factory(db='test', groups={'affected': ['09818','09819'], 'not_affected':['09960','09961']})
+        fc = FiltersCollection([QualityFilter(val='100', op='>=', db='test'),
+                                GenotypesFilterDominant(ss=ss, db='test')])
+        ids = set(fc.apply(db='test').ids.tolist())
+        for field in ['quality', 'gene_symbol']:
+            for reverse in [False, True]:
+                expected = [x for x in self.sql_order([field], reverse) if x in ids]
+                var = fc.apply(db='test', sort_by=field, reverse=reverse, limit=20, offset=3).variants
+                self.assertEqual([v.variant_id for v in var], expected[3:23])
+                # Resume from a cursor
+                cursor = fc.apply(db='test', sort_by=field, reverse=reverse, limit=3).cursor
+                var = fc.apply(db='test', sort_by=field, reverse=reverse, limit=20, cursor=cursor).variants
+                self.assertEqual([v.variant_id for v in var], expected[3:23])
+        # The cursor points to a variant that the db does not have, e.g. of a previous version
+        cursor = Cursor([0.5], NVAR+1, ['quality'], reverse=True)
+        with self.assertRaises(InvalidCursor):
+            fc.apply(db='test', sort_by='quality', reverse=True, limit=20, cursor=cursor)
@@ -68,3 +68,26 @@ class TestExtractVariants(unittest.TestCase):
         var = extract_variants_from_ids_bin_array(qs, bin_ids, ordered_qs_indices, limit=10, batch_size=self.BS)
         self.assertEqual(len(var), 10)
         self.assertNotEqual([v.variant_id for v in var], list(range(21,31)))
+
+    def test_extract_variants_after_id(self):
+        """Starting right after a given variant id is the same as skipping those before it."""
+        qs = Variant.objects.using(self.db).all().order_by('variant_id')
+        bin_ids = np.zeros(NVAR)
+        bin_ids[20:50] = 1
+        var = extract_variants_from_ids_bin_array(qs, bin_ids, limit=10, after_id=30, batch_size=self.BS)
+        self.assertEqual([v.variant_id for v in var], list(range(31,41)))
+
+    def test_extract_variants_offset_batches(self):
+        """The offset is applied once, not once per batch."""
+        qs = Variant.objects.using(self.db).all().order_by('variant_id')
+        bin_ids = np.ones(NVAR)
+        var = extract_variants_from_ids_bin_array(qs, bin_ids, limit=100, offset=10, batch_size=self.BS)
+        self.assertEqual([v.variant_id for v in var], list(range(11,111)))
+
+    def test_ids_bin_array(self):
+        qs = Variant.objects.using(self.db).filter(quality__gte=100)
+        expected = masking.to_binary_array(list(qs.values_list('variant_id', flat=True)), NVAR)
+        self.assertEqual(ids_bin_array(qs, NVAR, batch_size=self.BS).tolist(), expected.tolist())
+        # Ids beyond size are ignored
+        self.assertEqual(ids_bin_array(qs, 50).tolist(), expected[:50].tolist())
+        self.assertEqual(masking.popcount(masking.pack(expected)), qs.count())
@@ -23,4 +23,28 @@ class TestAccounts(unittest.TestCase):
         pass
 
     def test_protected(self):
-        pass
\ No newline at end of file
+        pass
+
+    def test_protected_cached(self):
+        """Once granted, the same access is checked with the user and the db only."""
+        from django.db import connections
+        from django.http import HttpResponse
+        from django.test.utils import CaptureQueriesContext
+        from varapp.auth.auth import invalidate_authorizations
+        invalidate_authorizations()
+        view = protected(lambda request, user=None, **kwargs: HttpResponse(user.username))
+        request = RequestFactory().get('/')
+        request.META['HTTP_AUTHORIZATION'] = 'JWT ' + set_jwt({'username':'test', 'code':'test'}, secret)
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = view(request, db='test')
+        self.assertEqual(response.content, b'test')
+        self.assertGreater(len(queries), 0)
+        first = len(queries)
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = view(request, db='test')
+        self.assertEqual(response.content, b'test')
+        self.assertLess(len(queries), first)
+        self.assertFalse(any('db_accesses' in q['sql'] for q in queries.captured_queries))
+        # Not for another db
+        response = view(request, db='nope')
+        self.assertEqual(response.status_code, 403)
\ No newline at end of file
@@ -6,6 +6,7 @@ from varapp.views.main_views import *
 from varapp.views.accounts_views import *
 from varapp.views.bookmarks_views import *
 from varapp.models.users import Users
+from varapp.filters.pagination import Cursor
 from varapp.constants.tests import NVAR, NSAMPLES
 import unittest, json
 
@@ -73,6 +74,82 @@ class TestMainViews(unittest.TestCase):
         data = json.loads(response.content.decode())
         self.assertGreaterEqual(len(data['variants']), 1)
 
+    def test_variants_without_stats(self):
+        """'?stats=0' returns the variants without stats, but still the total count."""
+        request = RequestFactory().get('/test/variants/', {'limit':'5', 'filter':'in_dbsnp=0', 'stats':'0'})
+        data = json.loads(variants(request, db='test').content.decode())
+        self.assertNotIn('stats', data)
+        self.assertEqual(len(data['variants']), 5)
+        request = RequestFactory().get('/test/variants/', {'limit':'5', 'filter':'in_dbsnp=0'})
+        data2 = json.loads(variants(request, db='test').content.decode())
+        self.assertEqual(data['nfound'], data2['nfound'])
+        self.assertEqual(data2['stats']['total_count'], data2['nfound'])
+
+    def test_variants_cursor(self):
+        """The next page starts right after the cursor; a malformed cursor, or one made
+        for another ordering, is a bad request."""
+        params = {'limit':'5', 'filter':'in_dbsnp=0', 'order_by':'quality,DESC', 'stats':'0'}
+        request = RequestFactory().get('/test/variants/', dict(params, limit='10'))
+        first10 = [v['variant_id'] for v in json.loads(variants(request, db='test').content.decode())['variants']]
+        request = RequestFactory().get('/test/variants/', params)
+        data = json.loads(variants(request, db='test').content.decode())
+        request = RequestFactory().get('/test/variants/', dict(params, cursor=data['cursor']))
+        data = json.loads(variants(request, db='test').content.decode())
+        self.assertEqual([v['variant_id'] for v in data['variants']], first10[5:])
+        for cursor in ['not a cursor', Cursor([0.5], 1, ['start']).encode()]:
+            request = RequestFactory().get('/test/variants/', dict(params, cursor=cursor))
+            self.assertEqual(variants(request, db='test').status_code, 400)
+
+    def test_stats_filtered(self):
+        """Stats() with filters returns the same stats as Variants() with the same filters,
+        and they are computed only once whatever the page."""
+        params = {'filter':'in_dbsnp=0', 'limit':'5'}
+        request = RequestFactory().get('/test/stats/', params)
+        filters = AllFilters(request, db='test')
+        filters.stats.cache.delete(filters.stats.key_query_stats(filters.stats_key()))
+        computed = []
+        make_stats = filters.stats.make_stats
+        filters.stats.make_stats = lambda *args, **kwargs: computed.append(1) or make_stats(*args, **kwargs)
+        try:
+            data = json.loads(stats(request, db='test').content.decode())
+            self.assertEqual(len(computed), 1)
+            for offset in ['0', '5']:
+                request = RequestFactory().get('/test/variants/', dict(params, offset=offset, order_by='quality,DESC'))
+                data2 = json.loads(variants(request, db='test').content.decode())
+                self.assertEqual(data2['stats'], data)
+            self.assertEqual(len(computed), 1)
+        finally:
+            del filters.stats.make_stats
+        self.assertLess(data['total_count'], NVAR)
+
+    def test_unavailable_while_warming(self):
+        """Views answer 503 while another request builds the caches."""
+        def view(request, db, **kwargs):
+            raise CacheWarming('gen:test')
+        response = unavailable_while_warming(view)(REQUEST, db='test')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    def test_ready(self):
+        """The startup warm-up is done (in the foreground, for tests)."""
+        warmup_scheduler().start(['test'])
+        response = ready(REQUEST)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode())
+        self.assertTrue(data['ready'])
+        self.assertEqual(data['dbs']['test'], 'ready')
+
+    def test_db_status(self):
+        warmup_scheduler().start(['test'])
+        data = json.loads(db_status(REQUEST, db='test').content.decode())
+        self.assertEqual(data['state'], 'ready')
+        self.assertIn('resident_bytes', data)
+        self.assertEqual(db_status(REQUEST, db='unknown').status_code, 404)
+        # Errors are not exposed
+        warmup_scheduler().start(['does_not_exist'])
+        data = json.loads(db_status(REQUEST, db='does_not_exist').content.decode())
+        self.assertEqual(data, {'state': 'failed', 'resident_bytes': 0})
+
     def test_stats(self):
         """Stats() returns statistics over the complete variants dataset.
         Just to run it ; already tested in stats_service."""
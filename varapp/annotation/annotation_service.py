@@ -6,6 +6,8 @@ Gemini: gene_summary, gene_detailed.
 from django.db import connections, OperationalError
 from django.core.cache import caches
 from varapp.annotation.genomic_range import GenomicRange
+from varapp.common.artifacts import load_bundle
+from varapp.common.db_utils import service_key
 import sys, logging
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format='%(message)s')
 
@@ -33,6 +35,10 @@ class GeneSummaryService:
         self._gene_names = None
         self._gene_dict = None
         self._chrom_dict = None
+        bundle = load_bundle(db)  # see `manage.py ingest`
+        if bundle is not None and 'gene_summary' in bundle:
+            self._chrom_dict, self._gene_names, self._gene_dict = bundle.load('gene_summary')
+            return
         _check_table_exists(db, "gene_summary")
         self._init()
 
@@ -112,8 +118,11 @@ def gene_summary_service(db, new=False):
     :param db: database name
     """
     gene_summary_cache = caches['gene_summary']
-    if gene_summary_cache.get(db) is None or new is True:
+    key = service_key(db)
+    service = gene_summary_cache.get(key)
+    if service is None or new is True:
         logging.info("Init gene summary cache for db {}.".format(db))
-        gene_summary_cache.set(db, GeneSummaryService(db))
-    return gene_summary_cache.get(db)
+        service = GeneSummaryService(db)
+        gene_summary_cache.set(key, service)
+    return service
 
@@ -0,0 +1,103 @@
+"""
+In-memory index of the variants' genomic locations, to find those inside
+a set of genomic ranges, or in a set of genes, without querying the db.
+For each chromosome, variant starts are sorted, with their ends and ids in the same order,
+so that the variants inside a range are found by binary search.
+The index is built once per db, and kept in local process memory.
+"""
+
+from django.core.cache import caches
+from django.db import connections
+from varapp.common import masking
+from varapp.common.db_utils import cache_namespace, service_key
+from collections import defaultdict
+import numpy as np
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+
+class LocationIndex:
+    """Index of the locations of the variants of database *db*."""
+    def __init__(self, db):
+        self.db = db
+        self.namespace = cache_namespace(db)  # the version and cache generation it was built for
+        self._chroms = {}   # {chrom: (starts, ends, ids)}, sorted by start
+        self._genes = None  # sorted array of lowercase gene symbols
+        self._gene_offsets = None  # ids of gene k are _gene_ids[_gene_offsets[k]:_gene_offsets[k+1]]
+        self._gene_ids = None
+        self._init()
+
+    def _init(self):
+        cursor = connections[self.db].cursor()
+        cursor.execute("SELECT variant_id,chrom,start,end,gene FROM variants")
+        all_rows = cursor.fetchall()
+        # Locations: group by chromosome, then sort by start. NULLs are never inside a range.
+        rows = [r for r in all_rows if r[1] is not None and r[2] is not None and r[3] is not None]
+        n = len(rows)
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+        starts = np.fromiter((r[2] for r in rows), dtype=np.int64, count=n)
+        ends = np.fromiter((r[3] for r in rows), dtype=np.int64, count=n)
+        chroms = np.asarray([r[1] for r in rows])
+        if n > 0:
+            chrom_names, chrom_codes = np.unique(chroms, return_inverse=True)
+            order = np.lexsort((starts, chrom_codes))
+            bounds = np.searchsorted(chrom_codes[order], np.arange(len(chrom_names)+1))
+            for k,chrom in enumerate(chrom_names):
+                sel = order[bounds[k]:bounds[k+1]]
+                self._chroms[chrom] = (starts[sel], ends[sel], ids[sel])
+        # Genes: group by (lowercase) gene symbol
+        rows = [r for r in all_rows if r[4] is not None]
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        genes = np.asarray([r[4].lower() for r in rows], dtype=np.str_)
+        self._genes, gene_codes = np.unique(genes, return_inverse=True)
+        order = np.argsort(gene_codes, kind='mergesort')
+        self._gene_ids = ids[order]
+        self._gene_offsets = np.searchsorted(gene_codes[order], np.arange(len(self._genes)+1))
+
+    def find(self, ranges, N):
+        """Return a packed binary array of length *N*, with 1 at index variant_id-1 of each variant
+        entirely inside one of the GenomicRanges *ranges*. As in `LocationFilter`, it means
+        the same chrom, start >= range.start-1 and end <= range.end (Gemini starts are 0-based).
+        Costs O(log N) per range, plus the number of variants found."""
+        z = np.zeros(N, dtype=np.bool_)
+        by_chrom = defaultdict(list)
+        for loc in ranges:
+            by_chrom[loc.chrom].append((loc.start, loc.end))
+        for chrom, locs in by_chrom.items():
+            if chrom not in self._chroms:
+                continue
+            starts, ends, ids = self._chroms[chrom]
+            locs = np.asarray(locs, dtype=np.int64)
+            # Since start <= end, candidates have range.start-1 <= start <= range.end
+            lo = np.searchsorted(starts, locs[:,0]-1, side='left')
+            hi = np.searchsorted(starts, locs[:,1], side='right')
+            for e,a,b in zip(locs[:,1], lo, hi):
+                if a < b:
+                    found = ids[a:b][ends[a:b] <= e]
+                    z[found[found <= N] - 1] = 1
+        return masking.pack(z)
+
+    def find_genes(self, genes, N):
+        """Return a packed binary array of length *N*, with 1 at index variant_id-1
+        of each variant annotated with one of the gene symbols *genes* (case-insensitive)."""
+        z = np.zeros(N, dtype=np.bool_)
+        for g in genes:
+            g = g.lower()
+            k = np.searchsorted(self._genes, g)
+            if k < len(self._genes) and self._genes[k] == g:
+                found = self._gene_ids[self._gene_offsets[k]:self._gene_offsets[k+1]]
+                z[found[found <= N] - 1] = 1
+        return masking.pack(z)
+
+
+def location_index(db):
+    """Creates a new LocationIndex, if not already found in local process cache,
+    or if the db or its cache generation changed since it was created (see `cache_namespace`)."""
+    index_cache = caches['location_index']
+    key = service_key(db)
+    index = index_cache.get(key)
+    if index is None or index.namespace != cache_namespace(db):
+        logging.info("[cache] Init location index '{}'".format(db))
+        index = LocationIndex(db)
+        index_cache.set(key, index)
+    return index
@@ -18,9 +18,8 @@ class VarappConfig(AppConfig):
 
     def ready(self):
         from varapp.common import manage_dbs, utils, db_utils
-        from varapp.common.versioning import add_versions
-        from varapp.stats.stats_service import stats_service
-        from varapp.variants.genotypes_service import genotypes_service
+        from varapp.common.cache.resident import resident_dbs
+        from varapp.common.warmup import warmup_scheduler, preload
 
         # Check that there are tables in the users_db,
         # because this code is also run when manage.py is used,
@@ -59,20 +58,18 @@ class VarappConfig(AppConfig):
             # It is necessary for stats and genotypes cache.
             redis_ready = utils.check_redis_connection()
             if redis_ready:
-                # Fill the stats cache
-                if settings.WARMUP_STATS_CACHE:
-                    for dbname in added_connections:
-                        stats_service(dbname)
+                # Fill the stats and genotypes caches, and the versions of all programs used.
+                # Unless WARMUP_WORKERS is 0, it happens in the background (see /ready).
+                # To preload, everything must be built before this process forks workers.
+                warmup_scheduler().start(added_connections,
+                    stats=settings.WARMUP_STATS_CACHE, genotypes=settings.WARMUP_GENOTYPES_CACHE,
+                    inline=settings.PRELOAD_DBS)
+                if settings.PRELOAD_DBS:
+                    preload(added_connections)
 
-                # Fill the genotypes cache
-                if settings.WARMUP_GENOTYPES_CACHE:
-                    for dbname in added_connections:
-                        genotypes_service(dbname)
-
-                # Update the *annotation* table with versions of all programs used,
-                # i.e. Gemini, VEP, their dbs, etc.
-                for dbname in added_connections:
-                    add_versions(dbname)
+                # Do not keep more dbs in memory than the budget allows
+                if settings.RESIDENT_DBS_MAX_BYTES:
+                    resident_dbs().enforce()
             else:
                 logger.warning("(!) Could not connect to Redis. Make sure Redis is installed, "
                                 "is up and running (try `redis-cli ping`) "
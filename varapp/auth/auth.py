@@ -1,12 +1,13 @@
 """
 Methods that modify the users database
 """
-import datetime, re, crypt
+import datetime, re, crypt, hashlib
 import logging, sys
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format='%(message)s')
 
 import jwt
 from django.conf import settings
+from django.core.cache import caches
 
 from varapp.common import utils
 from varapp.common.email import send_email
@@ -53,6 +54,32 @@ def find_user(username, code, require_active=True):
         logging.warning("No account was found with username '{}' and private code".format(username))
         return None
 
+## Authorizations cache
+
+def _authorization_key(username, code, dbname=None):
+    return hashlib.sha1('{}:{}:{}'.format(username, code, dbname or '').encode()).hexdigest()
+
+def get_authorization(username, code, dbname=None):
+    """Return the id of user <username, code> if it was recently granted access to the active db *dbname*
+    (or just found to exist and be active, if *dbname* is None) by this process. Otherwise return None.
+    Only the grant is kept: the user and the db are read again, so that they are never stale.
+    Entries expire after a few seconds (TIMEOUT of the 'auth' cache), so that changes made
+    by other processes are eventually seen."""
+    grant = caches['auth'].get(_authorization_key(username, code, dbname))
+    return grant[0] if grant is not None else None
+
+def set_authorization(user, dbname=None):
+    """Remember that *user* was granted access to *dbname* (or exists and is active, if *dbname* is None)."""
+    caches['auth'].set(_authorization_key(user.username, user.code, dbname), (user.id, dbname))
+
+def invalidate_authorizations():
+    """Forget all authorizations, after users or accesses were modified."""
+    caches['auth'].clear()
+
+def find_user_by_id(user_id):
+    """Return the active User with that id, with its role, or None if not found"""
+    return Users.objects.select_related('role').filter(pk=user_id, is_active=1).first()
+
 def find_user2(username, email, require_active=True):
     """Return the unique active User with that username and email, or None if not found"""
     try:
@@ -152,6 +179,7 @@ def create_user(username, password, firstname, lastname, email, phone, email_to_
 
 def delete_user(username, code):
     Users.objects.filter(username=username, code=code).delete()
+    invalidate_authorizations()
     return
 
 def reset_password_request(username, email, host, email_to_file=None):
@@ -199,6 +227,7 @@ def change_attribute(username, code, attribute, new_value):
     user = find_user(username=username, code=code)
     if not user:
         return [None, USER_NOT_FOUND_MSG]
+    invalidate_authorizations()
     if attribute == 'password':
         return change_password(username, user.email, user.activation_code, new_value, send=False)
     elif attribute == 'role':
@@ -217,6 +246,7 @@ def user_activation(username, code, email, activate, email_to_file=None):
     user = Users.objects.get(username=username, code=code)
     if not user:
         return [None, USER_NOT_FOUND_MSG]
+    invalidate_authorizations()
     if activate=='true':
         user.is_active = 1
         user.save()
@@ -243,5 +273,6 @@ def attribute_db(username, code, dbname, add):
     else:
         access = DbAccess.objects.filter(user=user, variants_db__in=dbs)
         access.update(is_active=0)
+    invalidate_authorizations()
     return user
 
@@ -0,0 +1,89 @@
+"""
+SQLite backend for Gemini dbs, which varapp only reads. Each connection is opened with
+the 'PROFILE' of its db settings (see `db_utils.sqlite_profile`):
+
+- 'IMMUTABLE': open the file with `immutable=1`: no locking nor change detection (default: False).
+  Only for files that are never rewritten, not even in place (e.g. `cp new.db old.db`), while being served:
+  SQLite would then return corrupt results;
+- 'MMAP_SIZE': bytes of the file mapped in memory, so that pages are shared with the OS cache;
+- 'CACHE_SIZE_KB': page cache of the connection;
+- 'IN_MEMORY_MAX_BYTES': dbs up to that size are copied once per process into a shared in-memory db,
+  and connections read from there instead (0: never).
+
+All connections are also `query_only`, with temporary tables in memory.
+"""
+
+from django.db.backends.sqlite3 import base
+from varapp.common.db_utils import file_signature
+from urllib.request import pathname2url
+import os
+import sqlite3
+import threading
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+# {path: (uri, connection)}. An in-memory db lives as long as a connection to it is open.
+_memory_dbs = {}
+_memory_dbs_lock = threading.Lock()
+
+
+def file_uri(path, immutable=False):
+    return 'file:{}?mode=ro{}'.format(pathname2url(os.path.abspath(path)), '&immutable=1' if immutable else '')
+
+def memory_db_uri(path):
+    """Return the URI of a shared in-memory copy of the db at *path*, making it if necessary.
+    A new copy is made when the file changes."""
+    signature = file_signature(path)
+    with _memory_dbs_lock:
+        uri, keeper = _memory_dbs.get(path, (None, None))
+        name = 'varapp_{}'.format('_'.join(map(str, signature)))
+        if uri is not None and name in uri:
+            return uri
+        uri = 'file:{}?mode=memory&cache=shared'.format(name)
+        logging.info("[sqlite] Copy '{}' in memory".format(path))
+        new_keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(file_uri(path), uri=True)
+        try:
+            if hasattr(source, 'backup'):  # Python >= 3.7
+                source.backup(new_keeper)
+            else:
+                new_keeper.executescript(';\n'.join(source.iterdump()))
+        finally:
+            source.close()
+        if keeper is not None:
+            keeper.close()
+        _memory_dbs[path] = (uri, new_keeper)
+        return uri
+
+def release_memory_db(path):
+    """Drop the in-memory copy of the db at *path*, if any. It is freed when the connections to it are closed."""
+    with _memory_dbs_lock:
+        uri, keeper = _memory_dbs.pop(path, (None, None))
+    if keeper is not None:
+        keeper.close()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        profile = self.settings_dict.get('PROFILE', {})
+        path = kwargs['database']
+        in_memory_max = profile.get('IN_MEMORY_MAX_BYTES', 0)
+        if in_memory_max and os.path.getsize(path) <= in_memory_max:
+            kwargs['database'] = memory_db_uri(path)
+        else:
+            kwargs['database'] = file_uri(path, profile.get('IMMUTABLE', False))
+        kwargs['uri'] = True
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        profile = self.settings_dict.get('PROFILE', {})
+        pragmas = ['query_only = 1', 'temp_store = MEMORY']
+        if profile.get('MMAP_SIZE'):
+            pragmas.append('mmap_size = {:d}'.format(profile['MMAP_SIZE']))
+        if profile.get('CACHE_SIZE_KB'):
+            pragmas.append('cache_size = -{:d}'.format(profile['CACHE_SIZE_KB']))  # negative: in KiB
+        for pragma in pragmas:
+            conn.execute('PRAGMA ' + pragma)
+        return conn
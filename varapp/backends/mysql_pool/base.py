@@ -0,0 +1,29 @@
+"""
+MySQL backend for the users db, with persistent connections shared by the threads
+of a process (see varapp.common.connection_pool). Set in DATABASES['default']::
+
+    'ENGINE': 'varapp.backends.mysql_pool',
+    'POOL': {'MAX_SIZE': 10, 'MAX_AGE': 600, 'TIMEOUT': 10},
+
+Django still "closes" the connection at the end of each request (CONN_MAX_AGE=0),
+which returns it to the pool instead.
+"""
+
+from django.db.backends.mysql import base
+from varapp.common.connection_pool import connection_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _connection_pool(self, conn_params):
+        options = {k.lower(): v for k,v in self.settings_dict.get('POOL', {}).items()}
+        connect = lambda: base.DatabaseWrapper.get_new_connection(self, conn_params)
+        return connection_pool(self.alias, connect, ping=lambda conn: conn.ping(), **options)
+
+    def get_new_connection(self, conn_params):
+        self._pool = self._connection_pool(conn_params)
+        return self._pool.acquire()
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                return self._pool.release(self.connection)
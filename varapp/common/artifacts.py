@@ -0,0 +1,329 @@
+"""
+Artifact bundles: all the derived structures of a db, precomputed offline by `manage.py ingest`
+(see `build_bundle`) and loaded directly by the services instead of being built at request time,
+or read from Redis.
+
+A bundle is a directory per db hash, under settings.ARTIFACTS_PATH, with a `manifest.json`
+and one file per artifact. Arrays are saved as .npy and memory-mapped read-only when loaded,
+so that all processes share the same pages; other (small) objects are pickled.
+It is written to a temporary directory first, then renamed: a bundle that exists is always complete.
+
+Artifacts:
+- genotypes, chrX: see GenotypesService
+- gene_batches_genes, gene_batches_ids, gene_batches_offsets: the gene batches of GenotypesService,
+  as one array of variant ids (see `pack_gene_batches`)
+- masks_matrix, masks_index: the MasksMatrix of GlobalStatsService, i.e. all packed masks as the rows
+  of one array, and `{filter_name: [(value, row)]}`
+- binned_codes, binned_breaks: the BinnedColumns of GlobalStatsService, i.e. its array of bin indices,
+  and `(fields, breaks, stride)`
+- global_stats: see GlobalStatsService
+- gene_summary (`(chrom_dict, gene_names, gene_dict)`): see GeneSummaryService
+- variant_keys, gts_digests, samples, field_digests: to compare two versions of a db (see `build_bundle`)
+
+`manage.py ingest` can also build the bundle of a db file before it is released in GEMINI_DB_PATH
+(see `build_file_bundle`): the new version is then served as soon as it is found.
+
+When a db is replaced by a new version, the bundle of the new one is built from the previous one
+(see `manage_dbs.update_db`): genotype rows of variants whose key (chrom, start, ref, alt)
+and genotypes blob did not change are copied instead of decoded, and if the variants are the same,
+the masks of discrete fields whose column did not change are reused.
+"""
+
+from django.conf import settings
+from django.db import connections
+from varapp.common.db_utils import get_db_hash, file_hash, add_db_to_settings, remove_db_from_settings, GEMINI_DB_PATH
+from varapp.common.cache.single_flight import build_lock, build_wait
+from varapp.common.sidecar import build_sidecar, index_db, index_alias, release_index_db
+from varapp.constants.filters import DISCRETE_FILTER_NAMES, TRANSLATION
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import join, basename, dirname
+import numpy as np
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+ARTIFACTS_VERSION = 3  # increment when the content of bundles changes, to build new ones
+MANIFEST = 'manifest.json'
+BLOBS_BATCH = 10000  # genotype blobs read at a time
+
+
+def artifacts_dir():
+    return getattr(settings, 'ARTIFACTS_PATH', None) or join(GEMINI_DB_PATH, '.artifacts')
+
+def bundle_path(sha):
+    """Path to the bundle of the db with hash *sha*."""
+    return join(artifacts_dir(), '{}.v{}'.format(sha, ARTIFACTS_VERSION))
+
+
+class ArtifactBundle:
+    """The artifacts of one version of a db, as described by its *manifest*."""
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+
+    def __contains__(self, name):
+        return name in self.manifest['artifacts']
+
+    def load(self, name):
+        """Return the artifact *name*. Arrays are read-only memory maps."""
+        filename = join(self.path, self.manifest['artifacts'][name]['file'])
+        if filename.endswith('.npy'):
+            try:
+                return np.load(filename, mmap_mode='r')
+            except ValueError:  # empty arrays cannot be memory-mapped
+                array = np.load(filename)
+                array.flags.writeable = False
+                return array
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+
+def load_bundle(dbname):
+    """Return the ArtifactBundle of *dbname* for its current hash, or None if it was not built."""
+    return bundle_at(get_db_hash(dbname))
+
+def bundle_at(sha):
+    """Return the ArtifactBundle of the db with hash *sha*, or None if it was not built."""
+    if sha is None:
+        return None
+    path = bundle_path(sha)
+    try:
+        with open(join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.error("[artifacts] Invalid manifest in '{}'".format(path))
+        return None
+    if manifest.get('hash') != sha or manifest.get('version') != ARTIFACTS_VERSION:
+        return None
+    return ArtifactBundle(path, manifest)
+
+
+## Build
+
+def _digest(data):
+    """64 bits hash of the bytes *data*, as an int."""
+    return int.from_bytes(hashlib.blake2b(data or b'', digest_size=8).digest(), 'little')
+
+def variant_keys(dbname):
+    """Return the digests of the (chrom, start, ref, alt) of all variants of *dbname*, in variant_id order."""
+    cursor = connections[index_db(dbname)].cursor()
+    cursor.execute("SELECT chrom,start,ref,alt FROM variants ORDER BY variant_id")
+    return np.fromiter((_digest('\t'.join(map(str, r)).encode()) for r in cursor.fetchall()), dtype=np.uint64)
+
+def matching_rows(keys, digests, old_keys, old_digests, order=None):
+    """Return (new indices, old indices) of the variants that have the same key
+    and the same genotypes digest in both versions.
+    :param order: `np.argsort(old_keys, kind='mergesort')`, if already computed."""
+    if len(old_keys) == 0 or len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if order is None:
+        order = np.argsort(old_keys, kind='mergesort')
+    sorted_keys = np.asarray(old_keys)[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(order)-1)
+    old_idx = order[pos]
+    match = (sorted_keys[pos] == keys) & (np.asarray(old_digests)[old_idx] == digests)
+    return np.flatnonzero(match), old_idx[match]
+
+def _column_digest(dbname, filter_name):
+    cursor = connections[index_db(dbname)].cursor()
+    cursor.execute("SELECT {} FROM variants ORDER BY variant_id".format(TRANSLATION.get(filter_name, filter_name)))
+    return hashlib.sha1(repr(cursor.fetchall()).encode()).hexdigest()
+
+
+def _genotypes_artifacts(dbname, keys, parent):
+    from varapp.common.genotypes import decode_int
+    from varapp.models.gemini import Samples
+    from varapp.variants.genotypes_service import genotype_bits, build_chrX, build_gene_batches, pack_gene_batches
+    samples = list(Samples.objects.using(dbname).order_by('sample_id').values_list('name', flat=True))
+    genotypes = np.zeros((len(keys), len(samples)), dtype=np.uint8)
+    digests = np.zeros(len(keys), dtype=np.uint64)
+    # A change in the samples changes all blobs: then there is nothing to reuse
+    reuse = parent is not None and 'gts_digests' in parent and parent.load('samples') == samples
+    if reuse:
+        old_keys, old_digests = parent.load('variant_keys'), parent.load('gts_digests')
+        old_genotypes = parent.load('genotypes')
+        order = np.argsort(old_keys, kind='mergesort')
+    reused = 0
+    # Blobs are streamed: they are much larger than the decoded genotypes
+    cursor = connections[dbname].cursor()
+    cursor.execute("SELECT gt_types FROM variants ORDER BY variant_id")
+    start = 0
+    while True:
+        blobs = [r[0] for r in cursor.fetchmany(BLOBS_BATCH)]
+        if not blobs:
+            break
+        end = start + len(blobs)
+        digests[start:end] = np.fromiter((_digest(b) for b in blobs), dtype=np.uint64, count=len(blobs))
+        todo = np.ones(len(blobs), dtype=np.bool_)
+        if reuse:
+            new_idx, old_idx = matching_rows(keys[start:end], digests[start:end], old_keys, old_digests, order)
+            genotypes[start + new_idx] = old_genotypes[old_idx]
+            todo[new_idx] = False
+            reused += len(new_idx)
+        todo = np.flatnonzero(todo)
+        if len(todo) > 0:
+            genotypes[start + todo] = genotype_bits(np.array([decode_int(blobs[i]) for i in todo], dtype=np.int8))
+        start = end
+    if reuse:
+        logging.info("[artifacts] Db '{}': reused {}/{} genotype rows".format(dbname, reused, len(keys)))
+    genotypes.flags.writeable = False  # make it immutable
+    genes, ids, offsets = pack_gene_batches(build_gene_batches(dbname))
+    return {'genotypes': genotypes, 'gts_digests': digests, 'samples': samples, 'chrX': build_chrX(dbname),
+            'gene_batches_genes': genes, 'gene_batches_ids': ids, 'gene_batches_offsets': offsets}
+
+def _stats_artifacts(dbname, keys, parent):
+    from varapp.stats.stats_service import GlobalStatsService, MasksMatrix, column_masks
+    digests = {f: _column_digest(dbname, f) for f in DISCRETE_FILTER_NAMES}
+    old_digests = {}
+    # Masks are indexed by variant_id: only reusable if the variants are the same, in the same order
+    if parent is not None and 'field_digests' in parent and np.array_equal(parent.load('variant_keys'), keys):
+        old_digests = parent.load('field_digests')
+        old_masks = MasksMatrix.from_arrays(parent.load('masks_matrix'), parent.load('masks_index')).to_dict()
+    masks = {}
+    for f in DISCRETE_FILTER_NAMES:
+        masks[f] = old_masks[f] if old_digests.get(f) == digests[f] else column_masks(dbname, f, len(keys))
+    if old_digests:
+        reused = [f for f in DISCRETE_FILTER_NAMES if old_digests.get(f) == digests[f]]
+        logging.info("[artifacts] Db '{}': reused masks of {}/{} fields".format(
+            dbname, len(reused), len(DISCRETE_FILTER_NAMES)))
+    # The service computes the global stats from these masks, instead of building them again.
+    # Not through the local cache: *dbname* may be served another version meanwhile.
+    matrix = MasksMatrix(masks)
+    stats = GlobalStatsService(dbname, masks=matrix)
+    binned = stats.binned_columns()
+    return {'masks_matrix': matrix.matrix, 'masks_index': matrix.index, 'field_digests': digests,
+            'global_stats': stats.get_global_stats(),
+            'binned_codes': binned.codes, 'binned_breaks': (binned.fields, binned.breaks, binned.stride)}
+
+def _gene_summary_artifacts(dbname, keys, parent):
+    from varapp.annotation.annotation_service import GeneSummaryService
+    try:
+        gs = GeneSummaryService(dbname)
+    except FileNotFoundError:  # no gene_summary table
+        return {}
+    return {'gene_summary': (gs.chrom_dict(), gs.gene_names(), gs.gene_dict())}
+
+BUILDERS = [
+    ('genotypes', _genotypes_artifacts),
+    ('stats', _stats_artifacts),
+    ('gene_summary', _gene_summary_artifacts),
+]
+
+
+def _run_builder(builder, wait, *args):
+    start = time.time()
+    try:
+        with build_wait(wait):  # also for the services it builds, in this thread
+            return builder(*args), time.time() - start
+    finally:
+        # Django connections are per thread: close those opened by this one
+        connections.close_all()
+
+def _log_progress(dbname, step, done, total, seconds):
+    logging.info("[artifacts] Db '{}': {} done in {:.1f}s ({}/{})".format(dbname, step, seconds, done, total))
+
+
+def build_bundle(dbname, workers=4, force=False, progress=_log_progress, parent_sha=None,
+                 record_versions=True, wait=None):
+    """Compute all the artifacts of *dbname* for its current hash, in parallel threads,
+    and write its bundle, unless it exists. Return its path, or None if the hash of the db is unknown.
+    The sidecar index db is built first, so that the stats read from it, and annotation versions
+    are recorded in the users db.
+    :param force: rebuild the bundle even if it exists.
+    :param progress: called as `progress(dbname, step, done, total, seconds)` each time a step is done.
+    :param parent_sha: hash of a previous version of the db, whose bundle is reused for what did not change.
+    :param record_versions: whether to record annotation versions. *dbname* must then be a VariantsDb name.
+    :param wait: maximum number of seconds to wait for another process building the same bundle,
+        or the same structures (see `build_lock`).
+    """
+    from varapp.common.versioning import add_versions
+    sha = get_db_hash(dbname)
+    if sha is None:
+        return None
+    path = bundle_path(sha)
+    parent = bundle_at(parent_sha)
+    with build_wait(wait), build_lock('artifacts:{}'.format(sha)):
+        if os.path.exists(path) and not force:
+            return path
+        if os.path.exists(path):
+            shutil.rmtree(path)  # otherwise the services would read from it
+        steps = len(BUILDERS) + (3 if record_versions else 2)
+        start = time.time()
+        if getattr(settings, 'SIDECAR_DBS', False):
+            build_sidecar(dbname)
+        progress(dbname, 'sidecar', 1, steps, time.time() - start)
+        start = time.time()
+        keys = variant_keys(dbname)
+        progress(dbname, 'variant_keys', 2, steps, time.time() - start)
+        artifacts = {'variant_keys': keys}
+        timings = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(_run_builder, builder, wait, dbname, keys, parent): step
+                       for step, builder in BUILDERS}
+            for done, future in enumerate(as_completed(futures), 3):
+                result, seconds = future.result()
+                for name in result:
+                    timings[name] = seconds
+                artifacts.update(result)
+                progress(dbname, futures[future], done, steps, seconds)
+        _write_bundle(dbname, sha, artifacts, timings, path, parent_sha=parent and parent_sha)
+        if record_versions:
+            start = time.time()
+            # Update the *annotation* table with versions of all programs used, i.e. Gemini, VEP, their dbs, etc.
+            add_versions(dbname)
+            progress(dbname, 'versions', steps, steps, time.time() - start)
+    return path
+
+def build_file_bundle(path, sha=None, alias=None, **kwargs):
+    """Build the bundle of the db file at *path*, that is not served (e.g. a new version of a db,
+    before it is released or swapped in), under a temporary connection alias. Annotation versions
+    are not recorded. Return the path of the bundle, or None if the file is gone or being written.
+    :param sha: the hash of the file, if known.
+    :param alias: name of the temporary alias. Default: after the hash.
+    Other keyword arguments are passed to `build_bundle`.
+    """
+    sha = sha or file_hash(path)
+    if sha is None:
+        return None
+    alias = alias or 'v_{}'.format(sha[:12])
+    add_db_to_settings(alias, basename(path), gemini_path=dirname(path), sha=sha)
+    try:
+        return build_bundle(alias, record_versions=False, **kwargs)
+    finally:
+        for a in (alias, index_alias(alias, sha)):
+            if a in settings.DATABASES:
+                connections[a].close()
+        release_index_db(alias, sha)
+        remove_db_from_settings(alias)
+
+def _write_bundle(dbname, sha, artifacts, timings, path, parent_sha=None):
+    os.makedirs(artifacts_dir(), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.{}.'.format(sha), dir=artifacts_dir())
+    try:
+        manifest = {'version': ARTIFACTS_VERSION, 'db': dbname, 'hash': sha, 'parent': parent_sha,
+                    'created': time.time(), 'artifacts': {}}
+        for name, obj in artifacts.items():
+            if isinstance(obj, np.ndarray):
+                filename = name + '.npy'
+                np.save(join(tmp, filename), obj)
+            else:
+                filename = name + '.pickle'
+                with open(join(tmp, filename), 'wb') as f:
+                    pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            manifest['artifacts'][name] = {'file': filename, 'seconds': round(timings.get(name, 0), 3),
+                                           'bytes': os.path.getsize(join(tmp, filename))}
+        with open(join(tmp, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+    logging.info("[artifacts] Wrote bundle of db '{}' to '{}'".format(dbname, path))
@@ -21,11 +21,23 @@ Example usage as a secondary cache::
             data = generate_data(request)
          cache.set(key, data)
      return generate_response(data)
+
+Entries are evicted in least-recently-used order, when there are more than MAX_ENTRIES
+or when their total size exceeds OPTIONS['MAX_BYTES'] (if set, in bytes).
+The size of an entry is given by its `sizeof()` method if it has one,
+otherwise estimated by `sizeof` below (mostly the `nbytes` of the numpy arrays it holds).
+It is measured when the entry is set; entries that grow afterwards (e.g. services building
+indices on demand) are measured again by `measure`.
 """
 
 import time
+import sys
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
 
-from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
 from django.utils.synch import RWLock
 
 # Global in-memory store of cache data. Keyed by name, to provide
@@ -33,16 +45,64 @@ from django.utils.synch import RWLock
 _caches = {}
 _expire_info = {}
 _locks = {}
+_sizes = {}
+_counters = {}
+_lru_locks = {}
+
+SIZEOF_MAX_DEPTH = 8
+
+
+def sizeof(value, _seen=None, _depth=0):
+    """Estimate the memory footprint of *value*, in bytes, walking through containers
+    and object attributes: numpy arrays count for their `nbytes`, other objects for `sys.getsizeof`.
+    Objects with a `sizeof()` method are trusted. Caches are not counted."""
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen or _depth > SIZEOF_MAX_DEPTH:
+        return 0
+    _seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (BaseCache, type)):
+        return 0
+    if _depth > 0 and callable(getattr(value, 'sizeof', None)):
+        return value.sizeof()
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        children = list(value.keys()) + list(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        children = value
+    elif hasattr(value, '__dict__'):
+        children = vars(value).values()
+    else:
+        children = ()
+    return size + sum(sizeof(c, _seen, _depth+1) for c in children)
+
+def entry_size(value):
+    """Size of a cache entry: its own `sizeof()` if it has one, otherwise the `sizeof` estimate."""
+    hook = getattr(value, 'sizeof', None)
+    if callable(hook) and not isinstance(value, type):
+        return hook()
+    return sizeof(value)
+
 
 class LocMemNoPickleCache(BaseCache):
     def __init__(self, name, params):
         BaseCache.__init__(self, params)
         global _caches, _expire_info, _locks
-        self._cache = _caches.setdefault(name, {})
+        self.name = name
+        self._cache = _caches.setdefault(name, OrderedDict())  # least recently used first
         self._expire_info = _expire_info.setdefault(name, {})
         self._lock = _locks.setdefault(name, RWLock())
+        self._sizes = _sizes.setdefault(name, {})  # {key: size in bytes}
+        self._counters = _counters.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+        self._lru_lock = _lru_locks.setdefault(name, threading.Lock())  # for readers to move keys
+        options = params.get('OPTIONS', {})
+        self._max_bytes = int(options.get('MAX_BYTES', 0) or 0)
 
-    def add(self, key, value, timeout=None, version=None):
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
         self._lock.writer_enters()
@@ -62,31 +122,35 @@ class LocMemNoPickleCache(BaseCache):
         try:
             exp = self._expire_info.get(key)
             if exp is None:
+                self._count('misses')
                 return default
             elif exp > time.time():
+                with self._lru_lock:
+                    self._cache.move_to_end(key)
+                    self._counters['hits'] += 1
                 return self._cache[key]
         finally:
             self._lock.reader_leaves()
         self._lock.writer_enters()
         try:
-            try:
-                del self._cache[key]
-                del self._expire_info[key]
-            except KeyError:
-                pass
+            self._delete(key)
+            self._count('misses')
             return default
         finally:
             self._lock.writer_leaves()
 
-    def _set(self, key, value, timeout=None):
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self._delete(key)
         if len(self._cache) >= self._max_entries:
             self._cull()
-        if timeout is None:
-            timeout = self.default_timeout
+        expires = self.get_backend_timeout(timeout)
         self._cache[key] = value
-        self._expire_info[key] = time.time() + timeout
+        self._expire_info[key] = float('inf') if expires is None else expires  # TIMEOUT None: never expires
+        self._sizes[key] = entry_size(value)
+        if self._max_bytes:
+            self._evict_to_budget(keep=key)
 
-    def set(self, key, value, timeout=None, version=None):
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
         self._lock.writer_enters()
@@ -111,32 +175,48 @@ class LocMemNoPickleCache(BaseCache):
 
         self._lock.writer_enters()
         try:
-            try:
-                del self._cache[key]
-                del self._expire_info[key]
-            except KeyError:
-                pass
+            self._delete(key)
             return False
         finally:
             self._lock.writer_leaves()
 
     def _cull(self):
+        """Evict the least recently used entries, a fraction 1/CULL_FREQUENCY of them
+        (at least one), or all of them if CULL_FREQUENCY is 0."""
         if self._cull_frequency == 0:
             self.clear()
         else:
-            doomed = [k for (i, k) in enumerate(self._cache) if i % self._cull_frequency == 0]
-            for k in doomed:
-                self._delete(k)
+            n = max(1, len(self._cache) // self._cull_frequency)
+            for k in list(self._cache)[:n]:
+                self._evict(k)
+
+    def _evict_to_budget(self, keep=None):
+        """Evict the least recently used entries until their total size fits in MAX_BYTES,
+        as last measured. The entry *keep* is never evicted."""
+        total = sum(self._sizes.values())
+        for k in list(self._cache):
+            if total <= self._max_bytes:
+                break
+            if k != keep:
+                total -= self._sizes.get(k, 0)
+                self._evict(k)
+        if total > self._max_bytes:
+            logging.warning("[cache] '{}' exceeds its memory budget ({} > {} bytes)".format(
+                self.name, total, self._max_bytes))
+
+    def _evict(self, key):
+        logging.info("[cache] Evicting '{}' from '{}'".format(key, self.name))
+        self._delete(key)
+        self._counters['evictions'] += 1
+
+    def _count(self, counter):
+        with self._lru_lock:
+            self._counters[counter] += 1
 
     def _delete(self, key):
-        try:
-            del self._cache[key]
-        except KeyError:
-            pass
-        try:
-            del self._expire_info[key]
-        except KeyError:
-            pass
+        self._cache.pop(key, None)
+        self._expire_info.pop(key, None)
+        self._sizes.pop(key, None)
 
     def delete(self, key, version=None):
         key = self.make_key(key, version=version)
@@ -147,9 +227,50 @@ class LocMemNoPickleCache(BaseCache):
         finally:
             self._lock.writer_leaves()
 
+    def delete_prefix(self, prefix, version=None):
+        """Delete all entries whose key starts with *prefix*. Return how many there were."""
+        prefix = self.make_key(prefix, version=version)
+        self._lock.writer_enters()
+        try:
+            keys = [k for k in self._cache if k.startswith(prefix)]
+            for k in keys:
+                self._delete(k)
+            return len(keys)
+        finally:
+            self._lock.writer_leaves()
+
     def clear(self):
         self._cache.clear()
         self._expire_info.clear()
+        self._sizes.clear()
+
+    def measure(self, key, version=None):
+        """Measure again the size of the entry at *key*, since it may have grown since it was set.
+        Return it in bytes, or None if there is no such entry."""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._lock.writer_enters()
+        try:
+            if key not in self._cache:
+                return None
+            self._sizes[key] = entry_size(self._cache[key])
+            return self._sizes[key]
+        finally:
+            self._lock.writer_leaves()
+
+    def info(self):
+        """Return a dict with the size of each entry (in bytes), their total,
+        the budget, and the number of hits, misses and evictions so far."""
+        self._lock.reader_enters()
+        try:
+            with self._lru_lock:  # readers move keys (see `get`)
+                sizes = {k: self._sizes.get(k, 0) for k in self._cache}
+                counters = dict(self._counters)
+        finally:
+            self._lock.reader_leaves()
+        info = {'sizes': sizes, 'bytes': sum(sizes.values()), 'max_bytes': self._max_bytes}
+        info.update(counters)
+        return info
 
 # For backwards compatibility
 class CacheClass(LocMemNoPickleCache):
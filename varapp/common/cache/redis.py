@@ -1,14 +1,103 @@
+"""
+Batched access to the Redis cache, to save round trips:
+- several keys are read at once (MGET), or tested at once (EXISTS in a single pipeline);
+- the expiry of keys that are read is refreshed lazily: at most once per TTL_REFRESH_INTERVAL
+  for each key in a given process, and all the keys due at once in a single pipeline.
+
+One instance is shared by all services of the same process (see `batched_cache`).
+"""
+
 from django.core.cache import caches
-import sys, logging
-logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(message)s')
-
-stats_cache = caches['stats']
-genotypes_cache = caches['genotypes']
-
-def remove_db_from_cache(dbname):
-    """Remove all cached items relative to a db that got deactivated"""
-    logging.info("[cache] Removing Redis-cached keys for db '{}'".format(dbname))
-    logging.info("[cache] -Stats keys: {}".format(stats_cache.keys("stats:{}:*")))
-    logging.info("[cache] -Genotypes keys: {}".format(genotypes_cache.keys("stats:{}:*")))
-    stats_cache.delete_pattern("stats:{}:*".format(dbname))
-    genotypes_cache.delete_pattern("stats:{}:*".format(dbname))
+from varapp.constants.common import HOUR
+import time
+import threading
+
+TTL_REFRESH_INTERVAL = HOUR
+
+_batched_caches = {}
+
+
+class BatchedRedisCache:
+    """Wraps the django_redis cache *alias*.
+    :param refresh_interval: minimum number of seconds between two refreshes of the TTL of the same key.
+    """
+    def __init__(self, alias='redis', refresh_interval=TTL_REFRESH_INTERVAL):
+        self.cache = caches[alias]
+        self.refresh_interval = refresh_interval
+        self._refreshed = {}  # {key: time of the last TTL refresh}
+        self._lock = threading.Lock()
+
+    def _client(self):
+        return self.cache.client.get_client(write=True)
+
+    def _pipeline(self):
+        return self._client().pipeline(transaction=False)
+
+    def get(self, key, timeout=None):
+        """Return the value at *key* (None if not found), refreshing its TTL to *timeout* if due."""
+        value = self.cache.get(key)
+        if value is not None and timeout is not None:
+            self.touch([key], timeout)
+        return value
+
+    def get_many(self, keys, timeout=None):
+        """Return a dict `{key: value}` of the *keys* that were found, in a single MGET,
+        refreshing the TTL of those found to *timeout* if due."""
+        found = self.cache.get_many(list(keys))
+        if found and timeout is not None:
+            self.touch(list(found), timeout)
+        return found
+
+    def exists_many(self, keys):
+        """Return a dict `{key: bool}` telling if each of the *keys* is in cache, in a single round trip."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        pipe = self._pipeline()
+        for key in keys:
+            pipe.exists(self.cache.make_key(key))
+        return {key: bool(e) for key, e in zip(keys, pipe.execute())}
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout=timeout)
+        self._mark_refreshed([key])
+
+    def set_many(self, mapping, timeout):
+        """Set all items of the dict *mapping*, in a single pipeline."""
+        self.cache.set_many(mapping, timeout=timeout)
+        self._mark_refreshed(list(mapping))
+
+    def touch(self, keys, timeout):
+        """Reset the TTL of *keys* to *timeout*, only for the keys that were not refreshed
+        (or set) by this process within the last `refresh_interval` seconds.
+        All such keys are refreshed in a single pipeline. Return the number of keys refreshed."""
+        now = time.time()
+        with self._lock:
+            due = [k for k in keys if now - self._refreshed.get(k, 0) >= self.refresh_interval]
+            for k in due:
+                self._refreshed[k] = now
+        if due:
+            pipe = self._pipeline()
+            for key in due:
+                pipe.expire(self.cache.make_key(key), timeout)
+            pipe.execute()
+        return len(due)
+
+    def forget(self, keys):
+        """Forget when *keys* were refreshed, e.g. because they were deleted."""
+        with self._lock:
+            for k in keys:
+                self._refreshed.pop(k, None)
+
+    def _mark_refreshed(self, keys):
+        now = time.time()
+        with self._lock:
+            for k in keys:
+                self._refreshed[k] = now
+
+
+def batched_cache(alias='redis'):
+    """Return the BatchedRedisCache for that cache *alias*, shared within the process."""
+    if alias not in _batched_caches:
+        _batched_caches[alias] = BatchedRedisCache(alias)
+    return _batched_caches[alias]
@@ -0,0 +1,138 @@
+"""
+Registry of the dbs whose structures are resident in the local memory of this process:
+genotypes, gene summary, sort permutations, location index, stats masks and service.
+They are still built lazily, by their factories, on first access to a db.
+Given a memory budget (`settings.RESIDENT_DBS_MAX_BYTES`, in bytes), when the total size of all
+these structures exceeds it, those of the least recently used dbs are dropped from all service caches.
+They are rebuilt - usually from Redis - the next time the db is accessed.
+Only the version of a db that is served is measured and counted; previous versions
+are dropped anyway when their last request is done (see `generations`).
+The size of a db is measured after a request used it (see `loaded`), at most every MEASURE_INTERVAL;
+the budget is checked against the last measures of the others.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from varapp.common.db_utils import SERVICE_CACHES, service_key
+from collections import OrderedDict
+import threading
+import time
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+MEASURE_INTERVAL = 60  # seconds between two measures of the resident size of a db that is being used
+
+_resident_dbs = None
+
+
+class ResidentDbs:
+    """Least recently used order of the dbs loaded in this process, and their memory footprint.
+    :param max_bytes: memory budget for all dbs together (0: no limit).
+    """
+    def __init__(self, max_bytes=0, cache_names=SERVICE_CACHES):
+        self.max_bytes = max_bytes
+        self.cache_names = cache_names
+        self._dbs = OrderedDict()  # {db: time of last access}, least recently used first
+        self._sizes = {}           # {db: {cache name: size in bytes}}, as last measured
+        self._measured = {}        # {db: time of its last measure}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def touch(self, db):
+        """Record an access to *db*, before it is used."""
+        with self._lock:
+            self._dbs[db] = time.time()
+            self._dbs.move_to_end(db)
+
+    def loaded(self, db):
+        """Record that a request just used *db*, so that its structures are loaded. Measure them
+        if that was not done recently, then evict the least recently used other dbs if necessary.
+        Return the list of evicted dbs."""
+        if time.time() - self._measured.get(db, 0) < MEASURE_INTERVAL:
+            return []
+        self.measure(db)
+        return self.enforce(keep=db) if self.max_bytes else []
+
+    def measure(self, db):
+        """Measure the structures of *db* in all service caches. Return `{cache name: size in bytes}`."""
+        sizes = self._measure(db)
+        with self._lock:
+            self._sizes[db] = sizes
+            self._measured[db] = time.time()
+        return sizes
+
+    def _measure(self, db):
+        sizes = {}
+        for name in self.cache_names:
+            size = caches[name].measure(service_key(db))
+            if size is not None:
+                sizes[name] = size
+        return sizes
+
+    def sizes(self):
+        """Return `{db: {cache name: size in bytes}}` for every resident db, as last measured.
+        Dbs that were loaded without being accessed through a view (warmup) are measured once."""
+        for db in self._known_dbs():
+            if db not in self._sizes:
+                sizes = self._measure(db)
+                with self._lock:
+                    self._sizes.setdefault(db, sizes)
+        with self._lock:
+            return {db: dict(s) for db, s in self._sizes.items() if s}
+
+    def measured_bytes(self, db):
+        """Return the total size of *db* as last measured, without measuring it (0 if it never was)."""
+        with self._lock:
+            return sum(self._sizes.get(db, {}).values())
+
+    def enforce(self, keep=None):
+        """Evict the least recently used dbs, except *keep*, until the resident size fits in the budget.
+        Return the list of evicted dbs."""
+        totals = {db: sum(s.values()) for db, s in self.sizes().items()}
+        total = sum(totals.values())
+        evicted = []
+        for db in self._lru_order():
+            if total <= self.max_bytes:
+                break
+            if db != keep and db in totals:
+                self.evict(db)
+                total -= totals[db]
+                evicted.append(db)
+        if total > self.max_bytes:
+            logging.warning("[cache] Resident dbs exceed the memory budget ({} > {} bytes)".format(total, self.max_bytes))
+        return evicted
+
+    def evict(self, db):
+        """Drop all local structures of *db*, of all its versions. Redis keys are kept, to rebuild them fast."""
+        logging.info("[cache] Evicting db '{}' from local memory".format(db))
+        for name in self.cache_names:
+            caches[name].delete_prefix('{}:'.format(db))
+        with self._lock:
+            self._dbs.pop(db, None)
+            self._sizes.pop(db, None)
+            self._measured.pop(db, None)
+        self.evictions += 1
+
+    def report(self):
+        """Return `{db: {'bytes': total size, 'caches': {cache name: size}, 'last_access': timestamp}}`,
+        as last measured."""
+        return {db: {'bytes': sum(s.values()), 'caches': s, 'last_access': self._dbs.get(db)}
+                for db, s in self.sizes().items()}
+
+    def _known_dbs(self):
+        """Registered dbs, plus those that were loaded without being accessed through a view (warmup)."""
+        return list(OrderedDict.fromkeys(list(self._dbs) + list(settings.DATABASES)))
+
+    def _lru_order(self):
+        """Dbs that were never accessed first, then from the least to the most recently used."""
+        with self._lock:
+            used = list(self._dbs)
+        return [db for db in settings.DATABASES if db not in used] + used
+
+
+def resident_dbs():
+    """Return the ResidentDbs registry of this process."""
+    global _resident_dbs
+    if _resident_dbs is None:
+        _resident_dbs = ResidentDbs(getattr(settings, 'RESIDENT_DBS_MAX_BYTES', 0))
+    return _resident_dbs
@@ -0,0 +1,105 @@
+"""
+Single-flight cache builds: when the cache of a db is missing, only one builder runs at a time,
+across threads and processes. The others wait for it to finish, then read what it built.
+Coordination uses a lock key in Redis, or a local file lock if Redis cannot be reached.
+
+Usage (double-checked)::
+
+    if not is_built():
+        with build_lock('stats:<namespace>:masks'):
+            if not is_built():  # maybe built by someone else while we were waiting
+                build()
+"""
+
+from django.core.cache import caches
+from redis.exceptions import ConnectionError as RedisConnectionError, LockError
+from contextlib import contextmanager
+import fcntl
+import os
+import re
+import tempfile
+import threading
+import time
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+BUILD_WAIT = 30             # seconds a request waits for another builder before giving up
+BUILD_LOCK_TIMEOUT = 3600   # seconds after which the lock of a builder that died is released
+LOCK_POLL_INTERVAL = 0.1
+
+_local = threading.local()
+
+
+class CacheWarming(Exception):
+    """Raised when the cache of a db is being built by someone else, and waiting for it took too long."""
+    def __init__(self, name):
+        super().__init__("Cache '{}' is being built".format(name))
+        self.name = name
+
+
+@contextmanager
+def build_wait(seconds):
+    """Make `build_lock` wait up to *seconds* by default, in the current thread only, while in this context.
+    For builders that nobody is waiting for, e.g. the warm-up. If *seconds* is None, nothing changes."""
+    previous = getattr(_local, 'wait', None)
+    _local.wait = previous if seconds is None else seconds
+    try:
+        yield
+    finally:
+        _local.wait = previous
+
+def default_wait():
+    """The default wait of `build_lock` in the current thread: BUILD_WAIT, unless changed by `build_wait`."""
+    wait = getattr(_local, 'wait', None)
+    return BUILD_WAIT if wait is None else wait
+
+
+@contextmanager
+def build_lock(name, wait=None, timeout=BUILD_LOCK_TIMEOUT):
+    """Hold the lock called *name* while in this context.
+    :param wait: maximum number of seconds to wait for it, after which CacheWarming is raised.
+        Defaults to `default_wait()`.
+    :param timeout: the lock expires after that many seconds, in case the holder died.
+    """
+    wait = default_wait() if wait is None else wait
+    cache = caches['redis']
+    lock = cache.lock('lock:{}'.format(name), timeout=timeout, sleep=LOCK_POLL_INTERVAL, blocking_timeout=wait)
+    try:
+        acquired = lock.acquire()
+    except RedisConnectionError:
+        logging.warning("[cache] Redis unavailable: using a file lock for '{}'".format(name))
+        with file_lock(name, wait):
+            yield
+        return
+    if not acquired:
+        raise CacheWarming(name)
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except LockError:  # expired meanwhile
+            pass
+        except RedisConnectionError:  # it will expire after *timeout*
+            logging.warning("[cache] Redis unavailable: could not release the lock of '{}'".format(name))
+
+
+@contextmanager
+def file_lock(name, wait=None):
+    """Same as `build_lock`, for the processes of this machine only, using `fcntl.flock`."""
+    wait = default_wait() if wait is None else wait
+    path = os.path.join(tempfile.gettempdir(), 'varapp-{}.lock'.format(re.sub(r'[^\w.-]', '_', name)))
+    deadline = time.time() + wait
+    with open(path, 'w') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise CacheWarming(name)
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
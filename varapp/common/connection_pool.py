@@ -0,0 +1,176 @@
+"""
+Pools of persistent DB-API connections, shared by all threads of a process.
+Django opens a new connection for each request and closes it at the end;
+a pooling backend (see varapp.backends.mysql_pool) instead takes it from here and gives it back.
+
+A connection is reused only if it is younger than `max_age` seconds and passes the health check (*ping*).
+At most `max_size` connections are open at once; beyond that, callers wait
+for one to be released, up to `timeout` seconds.
+"""
+
+from django.db.utils import OperationalError
+from collections import deque
+import os
+import threading
+import time
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+POOL_MAX_SIZE = 10
+POOL_MAX_AGE = 600  # seconds
+POOL_TIMEOUT = 10   # seconds
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(OperationalError):
+    """Raised when no connection became available in time. An OperationalError,
+    as Django raises when the db cannot be reached."""
+
+
+class ConnectionPool:
+    """:param connect: function returning a new connection.
+    :param ping: function raising an exception if the connection it is given is not usable anymore.
+    """
+    def __init__(self, connect, ping=None, max_size=POOL_MAX_SIZE, max_age=POOL_MAX_AGE, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.ping = ping
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timeout = timeout
+        self._idle = deque()   # (connection, creation time), most recently released last
+        self._created = {}     # {id(connection): creation time}, for those in use
+        self._size = 0         # open connections, idle or in use
+        self._cond = threading.Condition()
+        self._counters = {'created': 0, 'reused': 0, 'discarded': 0, 'waits': 0, 'timeouts': 0, 'wait_time': 0.0}
+
+    def acquire(self):
+        """Return a usable connection: an idle one if there is, a new one otherwise."""
+        start = time.time()
+        waited = False
+        while True:
+            with self._cond:
+                conn = None
+                if self._idle:
+                    conn, created = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout("No connection available after {}s".format(self.timeout))
+                    waited = True
+                    self._cond.wait(remaining)
+                    continue
+            if conn is None:
+                return self._new(start, waited)
+            if self._is_usable(conn, created):
+                with self._cond:
+                    self._created[id(conn)] = created
+                    self._counters['reused'] += 1
+                    self._record_wait(start, waited)
+                return conn
+            self._discard(conn)
+
+    def _new(self, start, waited):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(conn)] = time.time()
+            self._counters['created'] += 1
+            self._record_wait(start, waited)
+        return conn
+
+    def _record_wait(self, start, waited):
+        if waited:
+            self._counters['waits'] += 1
+            self._counters['wait_time'] += time.time() - start
+
+    def _is_usable(self, conn, created):
+        if time.time() - created > self.max_age:
+            return False
+        if self.ping is not None:
+            try:
+                self.ping(conn)
+            except Exception:
+                return False
+        return True
+
+    def release(self, conn):
+        """Give back *conn* to the pool, rolling back what was not committed.
+        It is closed instead if it is too old or broken."""
+        with self._cond:
+            created = self._created.pop(id(conn), None)
+        if created is None:  # not from this pool (e.g. before a fork)
+            conn.close()
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            return self._discard(conn)
+        if time.time() - created > self.max_age:
+            return self._discard(conn)
+        with self._cond:
+            self._idle.append((conn, created))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._counters['discarded'] += 1
+            self._cond.notify()
+
+    def close_idle(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Return the usage of the pool: sizes, counters, and total/average wait time in seconds."""
+        with self._cond:
+            stats = dict(self._counters, size=self._size, idle=len(self._idle),
+                         in_use=self._size - len(self._idle), max_size=self.max_size)
+        stats['wait_time'] = round(stats['wait_time'], 6)
+        stats['avg_wait_time'] = round(stats['wait_time'] / stats['waits'], 6) if stats['waits'] else 0
+        return stats
+
+
+def connection_pool(alias, connect, ping=None, **options):
+    """Return the pool of connections to the db *alias*, creating it with these parameters if necessary.
+    A process forked from the one that created it gets its own."""
+    key = (alias, os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            logging.info("[pool] New connection pool for '{}' ({})".format(alias, options))
+            pool = _pools[key] = ConnectionPool(connect, ping, **options)
+    return pool
+
+
+def close_idle_pools():
+    """Close the idle connections of all pools of this process, e.g. before forking:
+    a child must not reuse the sockets of its parent."""
+    pid = os.getpid()
+    for (alias, p), pool in list(_pools.items()):
+        if p == pid:
+            pool.close_idle()
+
+
+def pools_stats():
+    """Return `{alias: stats}` for all connection pools of this process."""
+    pid = os.getpid()
+    return {alias: pool.stats() for (alias, p), pool in list(_pools.items()) if p == pid}
@@ -3,8 +3,10 @@ from varapp.common.utils import normpath, random_string, sha1sum
 from django.conf import settings
 from django.core.cache import caches
 from django.db import connections
+from contextlib import contextmanager
 import os, logging, time, datetime
 import sqlite3
+import threading
 from os.path import join
 logger = logging.getLogger(__name__)
 
@@ -62,34 +64,149 @@ def vdb_full_path(vdb:VariantsDb):
         vdb.filename or ''
     )
 
-def add_db_to_settings(dbname, filename, gemini_path=GEMINI_DB_PATH):
-    """Add a new db to settings.DATABASES"""
+# Hash of the db file behind each connection, as last seen by this process: {dbname: sha}
+DB_HASHES = {}
+# Versions read by the current thread instead of the served ones (see `read_version`)
+_local = threading.local()
+
+def set_db_hash(dbname, sha):
+    """Record the hash of the db currently connected as *dbname*."""
+    DB_HASHES[dbname] = sha
+
+def get_db_hash(dbname):
+    """Return the hash of the db currently connected as *dbname*, or None if unknown.
+    In a thread that reads another version of it (see `read_version`), return that one.
+    Process caches built from that db should be discarded when it changes."""
+    versions = getattr(_local, 'versions', None)
+    if versions and dbname in versions:
+        return versions[dbname]
+    return DB_HASHES.get(dbname)
+
+def served_db_hash(dbname):
+    """Return the hash of the version of *dbname* served to new requests, whatever this thread reads."""
+    return DB_HASHES.get(dbname)
+
+@contextmanager
+def read_version(dbname, sha, connection=None):
+    """Make the current thread read version *sha* of *dbname* while in this context, e.g. for a request,
+    even if another version is served meanwhile: `get_db_hash` returns *sha*, so that the services
+    of that version are used (see `service_key`).
+    :param connection: the settings of the connection to that version, copied when it was served.
+        The connection of this thread to *dbname* is made with these, instead of the current ones.
+    """
+    versions = getattr(_local, 'versions', None)
+    if versions is None:
+        versions = _local.versions = {}
+    previous = versions.get(dbname)
+    versions[dbname] = sha
+    wrapper = connections[dbname] if connection is not None else None
+    if wrapper is not None:
+        wrapper.settings_dict = connection
+    try:
+        yield
+    finally:
+        if previous is None:
+            versions.pop(dbname, None)
+        else:
+            versions[dbname] = previous
+        if wrapper is not None:
+            # Back to the settings that add_db_to_settings updates
+            wrapper.settings_dict = connections.databases.get(dbname, connection)
+            if wrapper.settings_dict['NAME'] != connection['NAME']:
+                wrapper.close()  # still connected to that version
+
+def service_key(dbname):
+    """Return the key of the services of *dbname* in the local caches, for the version this thread reads.
+    Requests to a version that is being replaced keep using its services until they are done."""
+    return '{}:{}'.format(dbname, get_db_hash(dbname))
+
+GENERATION_TTL = 5  # seconds during which this process trusts the generation it last read from Redis
+# Generation of the Redis cache of each db, as last read by this process: {dbname: (generation, time read)}
+_generations = {}
+
+def _generation_key(dbname):
+    return 'generation:{}'.format(dbname)
+
+def cache_generation(dbname):
+    """Return the generation number of the Redis cache of *dbname*.
+    Bumping it invalidates all its cached keys at once.
+    It is read from Redis at most every GENERATION_TTL, so that looking up a service costs nothing:
+    a bump from another process is seen here within that delay."""
+    known = _generations.get(dbname)
+    if known is not None and time.time() - known[1] < GENERATION_TTL:
+        return known[0]
+    generation = caches['redis'].get(_generation_key(dbname)) or 0
+    _generations[dbname] = (generation, time.time())
+    return generation
+
+def bump_cache_generation(dbname):
+    """Invalidate all Redis keys of *dbname* by incrementing its generation number (atomic).
+    Return the new generation."""
+    cache = caches['redis']
+    generation = cache.client.get_client(write=True).incr(cache.make_key(_generation_key(dbname)))
+    _generations[dbname] = (generation, time.time())
+    return generation
+
+def cache_namespace(dbname):
+    """Return the namespace of the Redis keys of *dbname*, of the form '<db>:<hash>:<generation>'.
+    Keys of an older version of the db file, or of an older generation, are never read
+    again, and expire by themselves."""
+    return '{}:{}:{}'.format(dbname, get_db_hash(dbname), cache_generation(dbname))
+
+def sqlite_profile(dbname):
+    """Return the connection profile of the Gemini db *dbname*: settings.GEMINI_SQLITE_PROFILE,
+    updated with what is specific to *dbname* in settings.GEMINI_SQLITE_PROFILES."""
+    profile = dict(getattr(settings, 'GEMINI_SQLITE_PROFILE', {}))
+    profile.update(getattr(settings, 'GEMINI_SQLITE_PROFILES', {}).get(dbname, {}))
+    return profile
+
+def add_db_to_settings(dbname, filename, gemini_path=GEMINI_DB_PATH, sha=None):
+    """Add a new db to settings.DATABASES, opened read-only (see varapp.backends.gemini_sqlite).
+    :param sha: the hash of the db file, if known."""
     connection = {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': join(gemini_path, filename)
+        'ENGINE': 'varapp.backends.gemini_sqlite',
+        'NAME': join(gemini_path, filename),
+        'PROFILE': sqlite_profile(dbname),
     }
-    settings.DATABASES[dbname] = connection
-    connections.databases[dbname] = connection
+    current = settings.DATABASES.get(dbname)
+    if current is not None and current.get('ENGINE') == connection['ENGINE']:
+        # Threads that already made a connection wrapper read this same dict: they connect to the new file next time
+        current.update(connection)
+    else:
+        settings.DATABASES[dbname] = connection
+        connections.databases[dbname] = connection
+    if sha is not None:
+        set_db_hash(dbname, sha)
     logger.debug("(+) Adding connection '{}'".format(dbname))
 
 def remove_db_from_settings(dbname):
     """Remove that connection from settings.DATABASES and connections.databases."""
     settings.DATABASES.pop(dbname, None)
     connections.databases.pop(dbname, None)
+    DB_HASHES.pop(dbname, None)
+
+SERVICE_CACHES = ['genotypes_service', 'gene_summary', 'sort_service', 'location_index',
+                  'stats_masks', 'stats_service']
 
 def remove_db_from_cache(dbname):
-    """Delete all Redis keys related to *dbname*."""
-    cache = caches['redis']
-    gen_service_cache = caches['genotypes_service']
-    cache.delete_pattern("stats:{}:*".format(dbname))
-    cache.delete_pattern("gen:{}:*".format(dbname))
-    gen_service_cache.delete(dbname, None)
+    """Invalidate all Redis keys related to *dbname*, and drop the services of all its versions
+    and its authorizations from local memory."""
+    bump_cache_generation(dbname)
+    for name in SERVICE_CACHES:
+        caches[name].delete_prefix('{}:'.format(dbname))
+    caches['auth'].clear()  # accesses to that db
+
+def remove_version_from_cache(dbname, sha):
+    """Drop the services of version *sha* of *dbname* from local memory."""
+    key = '{}:{}'.format(dbname, sha)
+    for name in SERVICE_CACHES:
+        caches[name].delete(key)
 
 def add_db(vdb:VariantsDb):
     """Add that db to settings, connections, and activate it"""
     vdb.is_active = 1
     vdb.save()
-    add_db_to_settings(vdb.name, vdb.filename)
+    add_db_to_settings(vdb.name, vdb.filename, sha=vdb.hash)
 
 def remove_db(vdb:VariantsDb):
     """Remove that db from settings, connections, cache, and deactivate it."""
@@ -131,12 +248,46 @@ def is_valid_vdb(vdb:VariantsDb, path=None):
         return False
     return True
 
+FILE_HASH_TIMEOUT = 3600 * 24 * 30
+
+def file_signature(path):
+    """Return `(inode, size, mtime_ns)` of the file at *path*, or None if it does not exist.
+    Its content is assumed not to have changed as long as its signature is the same."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def file_hash(path):
+    """Return the SHA1 hash of the file at *path*, or None if it does not exist.
+    It is computed only once per version of the file, by a single process: the result is shared in Redis,
+    keyed by the file signature. If the file changes while being hashed, None is returned."""
+    from varapp.common.cache.single_flight import build_lock
+    signature = file_signature(path)
+    if signature is None:
+        return None
+    cache = caches['redis']
+    key = 'filehash:{}:{}'.format(normpath(path), ':'.join(map(str, signature)))
+    fhash = cache.get(key)
+    if fhash is None:
+        with build_lock(key, wait=FILE_HASH_TIMEOUT):
+            fhash = cache.get(key)  # maybe computed by another process meanwhile
+            if fhash is None:
+                fhash = sha1sum(path)
+                if file_signature(path) != signature:  # still being written
+                    return None
+                cache.set(key, fhash, timeout=FILE_HASH_TIMEOUT)
+    return fhash
+
 def is_hash_changed(vdb:VariantsDb, path=None, warn=False):
     """Check that the VariantDb hash is the same as that of its source file.
        Fills the hash field if not present.
        Return False if unchanged, or the new hash if it changed."""
     path = path or vdb_full_path(vdb)
-    fhash = sha1sum(path)
+    fhash = file_hash(path)
+    if fhash is None:  # gone, or being written: check again later
+        return False
     if not vdb.hash:
         return fhash
     if fhash != vdb.hash:
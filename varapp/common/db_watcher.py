@@ -0,0 +1,155 @@
+"""
+Background watcher of the Gemini dbs directory (settings.GEMINI_DB_PATH), so that requests
+do not have to check the files on disk, nor hash them.
+
+Every `settings.DB_WATCH_INTERVAL` seconds, a thread of each process lists the directory
+and compares the signature (inode, size, mtime) of each file with the previous poll.
+A file that changed is only considered once its signature is stable over a whole interval,
+i.e. when it is not being copied anymore. Then VariantsDb and settings are synced as
+`diff_disk_VariantsDb` does; each version of a file is hashed by a single process (see `file_hash`).
+
+The versions of active dbs are pinned, so that they can be served until a new version is ready
+(see varapp.common.generations). State changes of the active dbs, from this process or another,
+are published as generation numbers, and new versions of the dbs are prepared in this process.
+If DB_WATCH_INTERVAL is 0, there is no watcher and requests check the disk themselves.
+"""
+
+from django.conf import settings
+from django.db import connections
+from varapp.common.db_utils import file_signature, GEMINI_DB_PATH
+from varapp.common import manage_dbs
+from varapp.common.generations import generations, prune_versions
+from varapp.auth.auth import invalidate_authorizations
+from varapp.models.users import VariantsDb
+import os
+import threading
+import traceback
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+WATCH_INTERVAL = 10  # seconds
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+class DbWatcher:
+    """Polls the dbs directory *path* in a background thread, every *interval* seconds.
+    :attr generation: incremented every time the state of an active db changes.
+    """
+    def __init__(self, path=GEMINI_DB_PATH, interval=WATCH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.generation = 0
+        self.pid = os.getpid()
+        self._states = None        # {db: hash} of the active dbs, as of the last poll
+        self._signatures = {}      # {filename: signature} as of the last poll
+        self._unsettled = set()    # files that changed during the last interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='db-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.error("[watcher] Poll failed: {}".format(traceback.format_exc()))
+            finally:
+                # Django connections are per thread: do not keep this one open between polls
+                connections.close_all()
+
+    ## Polling
+
+    def scan(self):
+        """Return `{filename: signature}` for all files in the directory (not subdirectories)."""
+        signatures = {}
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            signature = file_signature(path) if os.path.isfile(path) else None
+            if signature is not None:
+                signatures[filename] = signature
+        return signatures
+
+    def poll(self):
+        """Look for changes on disk once, sync the dbs if some files changed and are settled,
+        and publish the state changes of active dbs. Return the names of the dbs that changed."""
+        signatures = self.scan()
+        changed = {f for f in set(signatures) | set(self._signatures)
+                   if signatures.get(f) != self._signatures.get(f)}
+        settled = self._unsettled - changed
+        self._signatures = signatures
+        if settled:
+            logging.info("[watcher] Changed on disk: {}".format(', '.join(sorted(settled))))
+            self.sync()
+        # Only now: if the sync failed, the settled files are synced again at the next poll
+        self._unsettled = changed
+        return self.publish(self.active_states())
+
+    def sync(self):
+        """Deactivate dbs whose file is gone, add new files, update dbs whose file changed.
+        Unchanged files are not hashed again (see `file_hash`), so timestamps need not be compared.
+        Then pin the active versions, and delete old ones."""
+        manage_dbs.activate_deactivate_at_gemini_path()
+        manage_dbs.diff_disk_VariantsDb(path=self.path, check_time=False)
+        active = list(VariantsDb.objects.filter(is_active=1).exclude(filename=settings.DB_TEST)
+                      .values_list('name', 'filename', 'hash'))
+        for name, filename, sha in active:
+            if sha:
+                generations().pin(name, filename, sha)
+        # Including the test db, which is not pinned but has a sidecar and a bundle
+        prune_versions(set(VariantsDb.objects.filter(is_active=1).values_list('hash', flat=True)))
+
+    @staticmethod
+    def active_states():
+        return dict(VariantsDb.objects.filter(is_active=1).values_list('name', 'hash'))
+
+    def publish(self, states):
+        """Compare the *states* `{db: hash}` of active dbs with the previous ones, and bump
+        the generation if some were added, removed or replaced. The first call only records them.
+        Return the names of the dbs that changed."""
+        with self._lock:
+            if self._states is None:
+                self._states = states
+                return []
+            changed = sorted(db for db in set(states) | set(self._states)
+                             if states.get(db) != self._states.get(db))
+            if changed:
+                self.generation += 1
+                invalidate_authorizations()
+                logging.info("[watcher] Generation {}: changed {}".format(self.generation, ', '.join(changed)))
+            replaced = [db for db in changed if db in states and db in self._states]
+            self._states = states
+        for db in replaced:
+            # Maybe by another process: serve the new version here too, once ready
+            filename = VariantsDb.objects.filter(name=db, is_active=1).values_list('filename', flat=True).first()
+            if filename and states[db]:
+                generations().prepare(db, filename, states[db])
+        return changed
+
+
+def db_watcher():
+    """Return the DbWatcher of this process, started on first call,
+    or None if settings.DB_WATCH_INTERVAL is 0.
+    After a fork, the child process starts its own."""
+    global _watcher
+    interval = getattr(settings, 'DB_WATCH_INTERVAL', WATCH_INTERVAL)
+    if not interval:
+        return None
+    with _watcher_lock:
+        if _watcher is None or _watcher.pid != os.getpid():
+            _watcher = DbWatcher(settings.GEMINI_DB_PATH, interval)
+            _watcher.publish(_watcher.active_states())
+            _watcher.start()
+    return _watcher
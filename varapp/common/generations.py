@@ -0,0 +1,312 @@
+"""
+Double-buffered versions of the Gemini dbs, so that replacing a db file neither interrupts
+its users nor makes them wait for cold caches.
+
+Each version of a db file is pinned by a copy named after its hash, under settings.DB_VERSIONS_PATH
+(see `pin_version`): a reflink where the file system supports it, so that it takes no space until
+the file is replaced. Connections to a db read its pinned version, so they can keep reading it
+after the file is replaced on disk, or rewritten in place. Pins are made by the warm-up of each db
+(see `Generations.pin_served`), and by the db watcher for new versions. A version that is not pinned
+(e.g. the file was replaced before its warm-up was done) is read from the file itself,
+and thus replaced as soon as a new version is found.
+
+When a new version of a db is found (see `manage_dbs.update_db`, or the watcher if another process
+found it), the current one keeps serving requests while the artifact bundle of the new one is built
+in the background, under a temporary connection alias. Then the new version is swapped in at once:
+its connection settings and hash replace the previous ones, and its services are loaded from the bundle.
+Each request reads the version that was served when it started until it is done (see `serving`):
+its hash, its connection and its services, which are kept per version in the local caches
+(see `db_utils.service_key`). Requests are counted per version: the previous version is released,
+services included, when the last request that used it is done. Pins of versions that are not active
+anymore are deleted after VERSIONS_RETENTION, since other processes may still be serving them.
+"""
+
+from django.conf import settings
+from django.db import connections
+from varapp.common.artifacts import build_file_bundle, bundle_path, artifacts_dir
+from varapp.common.db_utils import file_signature, file_hash, served_db_hash, add_db_to_settings, \
+    read_version, remove_version_from_cache, GEMINI_DB_PATH
+from varapp.common.sidecar import release_index_db, sidecar_path, sidecar_dir
+from varapp.backends.gemini_sqlite.base import release_memory_db
+from varapp.constants.common import DAY
+from collections import Counter
+from contextlib import contextmanager
+from os.path import join, basename, dirname
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+VERSIONS_RETENTION = DAY  # seconds during which a version that is not active anymore is kept on disk
+PREPARE_WAIT = 3600       # seconds to wait for another process building the same bundle
+FICLONE = 0x40049409      # Linux ioctl making a reflink (btrfs, xfs...)
+
+_generations = None
+
+
+## Pins
+
+def versions_dir():
+    return getattr(settings, 'DB_VERSIONS_PATH', None) or join(GEMINI_DB_PATH, '.versions')
+
+def version_path(sha):
+    """Path to the pin of the db version with hash *sha*."""
+    return join(versions_dir(), '{}.db'.format(sha))
+
+def _copy(src, dst):
+    """Copy the file *src* to *dst*: a reflink if the file system supports it, otherwise a full copy."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, 16 * 1024 * 1024)
+
+def pin_version(path, sha):
+    """Copy the file at *path* as version *sha*, if that is still its content.
+    Not a hard link: the file may be rewritten in place (`cp new.db old.db`), which would change the link too.
+    Return the path of the pin, or None if it could not be made."""
+    pin = version_path(sha)
+    if os.path.exists(pin):
+        return pin
+    signature = file_signature(path)
+    if signature is None or file_hash(path) != sha:
+        return None
+    os.makedirs(versions_dir(), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(pin, os.getpid())
+    try:
+        _copy(path, tmp)
+        if file_signature(path) != signature:  # rewritten meanwhile
+            return None
+        os.replace(tmp, pin)
+    except OSError as e:  # e.g. no space left
+        logging.warning("[generations] Could not pin '{}': {}".format(path, e))
+        return None
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return pin
+
+def version_hashes():
+    """Return the hashes of all versions that have a pin, a sidecar or an artifact bundle on disk."""
+    hashes = set()
+    for path, pattern in ((versions_dir(), r'(\w+)\.db'), (sidecar_dir(), r'(\w+)\.v\d+\.db'),
+                          (artifacts_dir(), r'(\w+)\.v\d+')):
+        if os.path.isdir(path):
+            for filename in os.listdir(path):
+                match = re.fullmatch(pattern, filename)
+                if match:
+                    hashes.add(match.group(1))
+    return hashes
+
+def prune_versions(active_hashes, retention=VERSIONS_RETENTION):
+    """Delete the pins of versions that are not in *active_hashes*, together with their sidecar
+    and artifact bundle, once they have been inactive for *retention* seconds. Return their hashes.
+    Versions that were never pinned (e.g. without a watcher) are deleted the same way."""
+    pruned = []
+    for sha in sorted(version_hashes()):
+        pin = version_path(sha)
+        marker = pin + '.retired'  # its mtime is when the version was first seen inactive
+        if sha in active_hashes:
+            if os.path.exists(marker):  # reactivated
+                os.remove(marker)
+        elif not os.path.exists(marker):
+            os.makedirs(versions_dir(), exist_ok=True)
+            open(marker, 'w').close()
+        elif time.time() - os.path.getmtime(marker) > retention:
+            logging.info("[generations] Deleting version {}".format(sha))
+            for f in (pin, marker, sidecar_path(sha)):
+                if os.path.exists(f):
+                    os.remove(f)
+            shutil.rmtree(bundle_path(sha), ignore_errors=True)
+            pruned.append(sha)
+    return pruned
+
+
+## Generations
+
+class Generations:
+    """The versions of the dbs served by this process.
+    :param background: prepare new versions in a background thread. Otherwise,
+        `prepare` returns once the new version is served: only for tests and commands,
+        never from a request or a transaction.
+    """
+    def __init__(self, background=True):
+        self.background = background
+        self._inflight = Counter()  # {(db, hash): number of requests being served}
+        self._retired = {}          # {(db, hash): path}, replaced, released when their last request is done
+        self._preparing = {}        # {db: (hash, thread)}
+        self._lock = threading.Lock()
+
+    ## Requests
+
+    def enter(self, dbname):
+        """Record a request to the current version of *dbname*. Return that version, to give back to `leave`."""
+        return self._enter(dbname)[0]
+
+    def _enter(self, dbname):
+        """Return the current version of *dbname* and a copy of its connection settings, as of the same swap."""
+        with self._lock:
+            sha = served_db_hash(dbname)
+            self._inflight[(dbname, sha)] += 1
+            connection = settings.DATABASES.get(dbname)
+            return sha, (dict(connection) if connection is not None else None)
+
+    @contextmanager
+    def serving(self, dbname):
+        """Serve a request with the current version of *dbname* while in this context, even if another one
+        is swapped in meanwhile: its hash, connection and services (see `db_utils.read_version`).
+        Yield that version."""
+        sha, connection = self._enter(dbname)
+        try:
+            with read_version(dbname, sha, connection):
+                yield sha
+        finally:
+            self.leave(dbname, sha)
+
+    def leave(self, dbname, sha):
+        """Record the end of a request to version *sha* of *dbname*,
+        and release that version if it was replaced and that was the last one."""
+        key = (dbname, sha)
+        with self._lock:
+            self._inflight[key] -= 1
+            if self._inflight[key] > 0:
+                return
+            del self._inflight[key]
+            path = self._retired.pop(key, None)
+        if path is not None:
+            self._release(dbname, sha, path)
+
+    def inflight(self, dbname, sha):
+        """Return the number of requests being served by version *sha* of *dbname*."""
+        with self._lock:
+            return self._inflight.get((dbname, sha), 0)
+
+    ## Versions
+
+    @staticmethod
+    def is_pinned(dbname):
+        """Whether the current version of *dbname* is read from its pin."""
+        sha = served_db_hash(dbname)
+        connection = settings.DATABASES.get(dbname)
+        return sha is not None and connection is not None and connection['NAME'] == version_path(sha)
+
+    def pin(self, dbname, filename, sha):
+        """Pin version *sha* of the file *filename* of *dbname*, and if it is the current version,
+        read it from there from now on. Return the path of the pin, or None."""
+        pin = pin_version(join(GEMINI_DB_PATH, filename), sha)
+        if pin is not None and served_db_hash(dbname) == sha and not self.is_pinned(dbname):
+            add_db_to_settings(dbname, basename(pin), gemini_path=dirname(pin), sha=sha)
+        return pin
+
+    def pin_served(self, dbname):
+        """Pin the version of *dbname* being served, if that is still the content of its file, and read it
+        from there from now on: then it keeps being served while a new version is prepared, even without
+        a watcher. Return the path of the pin, or None. The test db is never replaced, thus not pinned."""
+        sha = served_db_hash(dbname)
+        connection = settings.DATABASES.get(dbname)
+        if sha is None or connection is None or basename(connection['NAME']) == settings.DB_TEST:
+            return None
+        if self.is_pinned(dbname):
+            return connection['NAME']
+        pin = pin_version(connection['NAME'], sha)
+        with self._lock:
+            if pin is not None and served_db_hash(dbname) == sha and not self.is_pinned(dbname):
+                add_db_to_settings(dbname, basename(pin), gemini_path=dirname(pin), sha=sha)
+        return pin
+
+    def prepare(self, dbname, filename, sha, parent_sha=None):
+        """Build the caches of version *sha* of *dbname*, from the file *filename*, then serve it.
+        Return the thread doing it, or None if that version is already served or being prepared.
+        :param parent_sha: a previous version, whose artifacts are reused for what did not change.
+            Defaults to the current version.
+        """
+        with self._lock:
+            current = served_db_hash(dbname)
+            preparing = self._preparing.get(dbname)
+            if current == sha or (preparing is not None and preparing[0] == sha and preparing[1].is_alive()):
+                return None
+            args = (dbname, filename, sha, parent_sha or current)
+            thread = threading.Thread(target=self._prepare_in_thread, args=args,
+                                      name='prepare-{}'.format(dbname), daemon=True)
+            self._preparing[dbname] = (sha, thread)
+        logging.info("[generations] Preparing version {} of db '{}'".format(sha, dbname))
+        if self.background:
+            thread.start()
+        else:
+            self._prepare(*args)
+        return thread
+
+    def _prepare_in_thread(self, *args):
+        try:
+            self._prepare(*args)
+        finally:
+            connections.close_all()  # Django connections are per thread
+
+    def _prepare(self, dbname, filename, sha, parent_sha):
+        from varapp.common.versioning import add_versions
+        path = pin_version(join(GEMINI_DB_PATH, filename), sha) or join(GEMINI_DB_PATH, filename)
+        # Pinned by the warm-up, maybe in another process: not if the file was replaced since then
+        if not self.is_pinned(dbname) and os.path.exists(version_path(served_db_hash(dbname) or '')):
+            self.pin_served(dbname)
+        if not self.is_pinned(dbname):
+            # The file of the current version was replaced: serving it would mix both versions
+            self.swap(dbname, sha, path)
+        try:
+            build_file_bundle(path, sha, alias='{}__v_{}'.format(dbname, sha[:12]),
+                              parent_sha=parent_sha, wait=PREPARE_WAIT)
+        except Exception:
+            # Serve it anyway: the services will build what is missing
+            logging.error("[generations] Could not build the caches of db '{}': {}".format(
+                dbname, traceback.format_exc()))
+        self.swap(dbname, sha, path)
+        try:
+            add_versions(dbname)
+        except Exception:
+            logging.error("[generations] Could not record the versions of db '{}': {}".format(
+                dbname, traceback.format_exc()))
+
+    def swap(self, dbname, sha, path):
+        """Serve version *sha* of *dbname*, read from *path*, instead of the current one.
+        Requests being served keep the current one until they are done."""
+        with self._lock:
+            old = served_db_hash(dbname)
+            if old == sha:
+                return
+            old_path = settings.DATABASES.get(dbname, {}).get('NAME')
+            add_db_to_settings(dbname, basename(path), gemini_path=dirname(path), sha=sha)
+            release = old is not None
+            if release and self._inflight.get((dbname, old), 0) > 0:
+                self._retired[(dbname, old)] = old_path  # released by the last request
+                release = False
+        logging.info("[generations] Db '{}' now serves version {}".format(dbname, sha))
+        if release:
+            self._release(dbname, old, old_path)
+
+    @staticmethod
+    def _release(dbname, sha, path):
+        if sha != served_db_hash(dbname):  # not served again meanwhile
+            remove_version_from_cache(dbname, sha)
+        release_index_db(dbname, sha)
+        if path is not None and path != settings.DATABASES.get(dbname, {}).get('NAME'):
+            release_memory_db(path)
+        logging.info("[generations] Released version {} of db '{}'".format(sha, dbname))
+
+    def join(self, timeout=None):
+        """Wait until the versions being prepared are served."""
+        for sha, thread in list(self._preparing.values()):
+            if thread.is_alive():
+                thread.join(timeout)
+
+
+def generations():
+    """Return the Generations of this process. New versions are always prepared in the background,
+    so that neither requests nor transactions wait for them (whatever settings.WARMUP_WORKERS)."""
+    global _generations
+    if _generations is None:
+        _generations = Generations()
+    return _generations
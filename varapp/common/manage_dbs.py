@@ -8,6 +8,7 @@ but also record it to VariantsDb so that the next time the app is loaded,
 it can be read from there before any request is made (and already knowing hash etc.).
 """
 from varapp.common.db_utils import *
+from varapp.common.generations import generations
 from varapp.models.users import VariantsDb, DbAccess
 from django.conf import settings
 from django.db import transaction, IntegrityError
@@ -68,7 +69,7 @@ def copy_VariantsDb_to_settings():
         elif not is_valid_vdb(vdb):
             continue
         added.append(vdb.name)
-        add_db_to_settings(vdb.name, vdb.filename)
+        add_db_to_settings(vdb.name, vdb.filename, sha=vdb.hash)
     if added:
         logger.info("(v) Added connections: '{}'.".format("','".join(sorted(added))))
     else:
@@ -83,9 +84,11 @@ def scan_dir_for_dbs(path=settings.GEMINI_DB_PATH):
     filenames = [x for x in os.listdir(path) if is_sqlite3(join(path, x))]
     return filenames
 
-def add_new_db(path, dbname=None, sha=None, parent_db_id=None):
+def add_new_db(path, dbname=None, sha=None, parent_db_id=None, connect=True):
     """Add a new db found on disk at *path* to both settings and VariantsDb.
     :param sha: hash of the new db.
+    :param connect: whether to add it to settings. A new version of an existing db
+        is connected by `update_db` instead, once it is ready.
     """
     assert os.path.exists(path)
     filename = os.path.basename(path)
@@ -93,7 +96,8 @@ def add_new_db(path, dbname=None, sha=None, parent_db_id=None):
     dbname = dbname or db_name_from_filename(filename)
     size = os.path.getsize(path)
     logger.info("(+) Adding '{}' as '{}' to settings and users_db".format(path, dbname))
-    add_db_to_settings(dbname, filename)
+    if connect:
+        add_db_to_settings(dbname, filename, sha=sha)
     try:
         newdb,created = VariantsDb.objects.get_or_create(
             name=dbname, filename=filename, location=dirname, is_active=1,
@@ -104,25 +108,41 @@ def add_new_db(path, dbname=None, sha=None, parent_db_id=None):
         # should not be allowed
         return
 
-def update_db(parent:VariantsDb, newdb:VariantsDb):
+def update_db(parent:VariantsDb, newdb:VariantsDb, prepare=True):
     """Deactivate the parent db, deactivate all accesses to the older one,
     and create accesses to the new one for the same users.
+    A new version of the same db is served once its caches are built, reusing those of the parent
+    for what did not change; meanwhile, the parent's version is (see `generations`).
+    :param prepare: whether to start preparing the new version now. Otherwise the caller
+        does it with `prepare_new_version`, e.g. once its transaction is committed.
     """
     if not newdb:
         return
     logger.info("(+) Found newer version of '{}'. Replacing.".format(parent.filename))
     # Deactivate the old one
-    remove_db(parent)
+    if newdb.name == parent.name:
+        parent.is_active = 0
+        parent.save()
+    else:
+        remove_db(parent)
     # All accesses to the old one to target the new one instead
     old_accesses = DbAccess.objects.filter(variants_db=parent)
     for acc in old_accesses:
         acc.is_active = 0
         acc.save()
         DbAccess.objects.get_or_create(variants_db=newdb, user=acc.user, is_active=1)
+    if prepare:
+        prepare_new_version(parent, newdb)
+
+def prepare_new_version(parent:VariantsDb, newdb:VariantsDb):
+    """Build the caches of *newdb*, a new version of *parent*, in the background, then serve it."""
+    if newdb is not None and newdb.name == parent.name and newdb.hash:
+        generations().prepare(newdb.name, newdb.filename, newdb.hash, parent_sha=parent.hash)
 
-def update_if_db_changed(vdb, check_time=True, warn=True):
+def update_if_db_changed(vdb, check_time=True, warn=True, prepare=True):
     """Return whether the db changed.
     :param check_time: if False, skip the timestamp comparison - especially for testing.
+    :param prepare: see `update_db`.
     """
     if is_test_vdb(vdb):
         # Changing a hash value in the sqlite makes the hash of the whole sqlite change in turn...
@@ -131,8 +151,8 @@ def update_if_db_changed(vdb, check_time=True, warn=True):
     if new_time or not check_time:
         new_hash = is_hash_changed(vdb, warn=warn)
         if new_hash:
-            newdb = add_new_db(vdb_full_path(vdb), vdb.name, new_hash, parent_db_id=vdb.pk)
-            update_db(vdb, newdb)   # add a new entry with same filename
+            newdb = add_new_db(vdb_full_path(vdb), vdb.name, new_hash, parent_db_id=vdb.pk, connect=False)
+            update_db(vdb, newdb, prepare=prepare)   # add a new entry with same filename
             return True
         else:
             logger.info("(v) Same hash for '{}', refresh the updated_time.".format(vdb.name))
@@ -144,7 +164,9 @@ def diff_disk_VariantsDb(path=settings.GEMINI_DB_PATH, check_time=True):
     def add_new_found_db(filename):
         """Add the new *filename* to VariantsDb and settings"""
         fpath = join(path, filename)
-        fsha = sha1sum(fpath)
+        fsha = file_hash(fpath)
+        if fsha is None:  # being written: wait for the next scan
+            return
         # Check if a deactivated db has the same hash. If so, reactivate it
         deac = VariantsDb.objects.filter(filename=filename, is_active=0, hash=fsha)
         if deac.count() > 0:
@@ -152,20 +174,32 @@ def diff_disk_VariantsDb(path=settings.GEMINI_DB_PATH, check_time=True):
             newdb = deac[0]
             newdb.is_active = 1
             newdb.save()
-            add_db_to_settings(newdb.name, newdb.filename)
+            add_db_to_settings(newdb.name, newdb.filename, sha=newdb.hash)
         # Otherwise, create a new one
         else:
             add_new_db(fpath, sha=fsha)
 
+    # Hash the files that need it before locking the rows, as it can take minutes for big dbs:
+    # in the transaction, `file_hash` then reads the results back from Redis.
+    ondisk = scan_dir_for_dbs(path)
+    known = {v.filename: v for v in VariantsDb.objects.filter(is_active=1)}
+    for fname in ondisk:
+        vdb = known.get(fname)
+        if vdb is None:
+            file_hash(join(path, fname))
+        elif not is_test_vdb(vdb) and (not check_time or is_source_updated(vdb)):
+            file_hash(vdb_full_path(vdb))
+
     with transaction.atomic():  # otherwise "select_for_update cannot be used outside of a transaction"
         vdbs = VariantsDb.objects.select_for_update().filter(is_active=1)
         vdb_names = [v.filename for v in vdbs]
-        ondisk = scan_dir_for_dbs(path)
         # Add dbs that are newly found on disk
         diff = set(ondisk) - set(vdb_names)
         for fname in diff:
             add_new_found_db(fname)
         # Already existing filenames could be updates. Check SHA hash to update
-        for vdb in vdbs:
-            update_if_db_changed(vdb, check_time=check_time, warn=True)
+        replaced = [vdb for vdb in vdbs if update_if_db_changed(vdb, check_time=check_time, warn=True, prepare=False)]
+    # Not while the rows are locked
+    for vdb in replaced:
+        prepare_new_version(vdb, VariantsDb.objects.filter(name=vdb.name, is_active=1).first())
 
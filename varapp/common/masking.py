@@ -25,7 +25,110 @@ def binary_and(a,b):
     # return np.logical_and(a,b)  # does not work with packed arrays
     return np.bitwise_and(a, b)
 
+def binary_or(a,b):
+    """Compare two binary arrays of the same length and return a third one,
+    the bitwise union of the first two."""
+    return np.bitwise_or(a, b)
+
+def binary_not(a, size):
+    """Return the complement of the packed binary array *a* of (unpacked) length *size*,
+    leaving the padding bits at 0."""
+    z = np.invert(a)
+    if size % 8:
+        z[-1] &= (0xFF << (8 - size % 8)) & 0xFF
+    return z
+
+def pack_indices(ids, size):
+    """Return the packed binary array of length *size* with 1 at the (1-based) *ids*,
+    without making the unpacked one."""
+    z = np.zeros((size + 7) // 8, dtype=np.uint8)
+    i = np.asarray(ids, dtype=np.int64) - 1
+    if len(i) != 0:
+        np.bitwise_or.at(z, i >> 3, np.right_shift(0x80, i & 7).astype(np.uint8))
+    return z
+
+def is_set(a, ids):
+    """Return, for each (1-based) id in *ids*, whether its bit is set in the packed array *a*."""
+    i = np.asarray(ids, dtype=np.int64) - 1
+    return (np.right_shift(a[i >> 3], 7 - (i & 7)) & 1).astype(np.bool_)
+
 def to_indices(a):
     """Return the array of indices (0-based) where elements of *a* are True."""
     return np.flatnonzero(a)
 
+def factorize(values):
+    """Encode the sequence *values* as integer codes. Return (uniques, codes),
+    such that `uniques[codes[i]] == values[i]`; *uniques* is sorted, except for None,
+    which is a value like any other but comes last.
+    :rtype: (list, np.ndarray)
+    """
+    n = len(values)
+    isnull = np.fromiter((v is None for v in values), dtype=np.bool_, count=n)
+    nonnull = np.asarray([v for v in values if v is not None])
+    codes = np.empty(n, dtype=np.int64)
+    uniques = []
+    if len(nonnull) > 0:
+        uniq, codes[~isnull] = np.unique(nonnull, return_inverse=True)
+        uniques = uniq.tolist()  # back to python types
+    if isnull.any():
+        codes[isnull] = len(uniques)
+        uniques.append(None)
+    return uniques, codes
+
+def value_masks(ids, codes, n, size):
+    """Given the (1-based) *ids* of elements and their integer *codes* (0 <= code < *n*),
+    as returned by `factorize`, return the list of *n* packed binary arrays of length *size*,
+    the k-th one having 1 at the index of the ids with code k."""
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.searchsorted(codes[order], np.arange(n+1))
+    masks = []
+    for k in range(n):
+        z = np.zeros(size, dtype=np.bool_)
+        z[ids[order[bounds[k]:bounds[k+1]]] - 1] = 1
+        masks.append(pack(z))
+    return masks
+
+# Number of bits set in each possible byte
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(a):
+    """Return the number of bits set in the packed array *a*, without unpacking it."""
+    return int(POPCOUNT_TABLE[a].sum(dtype=np.int64))
+
+def popcount_rows(matrix, mask, block=64):
+    """Return, for each row of the packed 2-D array *matrix*, the number of bits set
+    both in that row and in the packed array *mask*, without unpacking anything.
+    Rows are processed by blocks, to bound the size of the temporary arrays."""
+    counts = np.zeros(len(matrix), dtype=np.int64)
+    for k in range(0, len(matrix), block):
+        common = np.bitwise_and(matrix[k:k+block], mask)
+        counts[k:k+block] = POPCOUNT_TABLE[common].sum(axis=1, dtype=np.int64)
+    return counts
+
+
+def first_in_order(ordered_ids, a, n, chunk=4096, size=None):
+    """Walk the variant ids *ordered_ids* (1-based) in their given order, and return
+    the first *n* of them that are set in the binary array *a*.
+    Blocks of growing size are tested at once, and the walk stops as soon as
+    enough are found, so the cost depends on *n* rather than on the total length.
+    :param size: if given, *a* is packed, of that (unpacked) length. Then it is never unpacked.
+    """
+    packed = size is not None
+    if not packed:
+        size = len(a)
+    found = []
+    nfound = 0
+    k = 0
+    B = max(chunk, n)
+    while nfound < n and k < len(ordered_ids):
+        block = np.asarray(ordered_ids[k:k+B], dtype=np.int64)
+        block = block[(block > 0) & (block <= size)]
+        hits = block[is_set(a, block) if packed else np.asarray(a[block-1], dtype=np.bool_)]
+        found.append(hits)
+        nfound += len(hits)
+        k += B
+        B *= 2
+    if not found:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(found)[:n]
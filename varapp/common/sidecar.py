@@ -0,0 +1,156 @@
+"""
+Sidecar index dbs. Gemini files must not be modified (their hash is their identity),
+and rows of their *variants* table carry large genotype blobs, so that queries
+on several columns read a lot of pages.
+
+The sidecar of a db is an SQLite file per db hash, under settings.SIDECAR_DB_PATH, with a narrow copy
+of the *variants* table: all its columns known to the Variant model, except blobs,
+`variant_id` as primary key, and an index on each filterable column. Since `variant_id` is the rowid,
+all these indexes are covering for queries returning variant ids.
+
+Queries that only need variant ids (filters, masks, sort permutations, stats) are sent
+to `index_db(db)`, the connection alias of the sidecar if it was built, otherwise *db* itself.
+Rows are still read from the Gemini file, only for the page being shown.
+Sidecars are built offline: by the background warm-up, or by `build_sidecar`.
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import BinaryField
+from varapp.common.db_utils import get_db_hash, sqlite_profile, GEMINI_DB_PATH
+from varapp.common.cache.single_flight import build_lock
+from varapp.models.gemini import Variants
+from varapp.backends.gemini_sqlite.base import file_uri
+from urllib.request import pathname2url
+from os.path import join
+import os
+import sqlite3
+import threading
+import time
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+SIDECAR_VERSION = 1  # increment when the schema changes, to build new ones
+LOCATION_INDEX = ('chrom', 'start', 'end')
+MISSING_RECHECK = 10  # seconds before looking again for a sidecar that was not found (maybe built by another process)
+
+_aliases = {}  # {db: (hash, alias of its sidecar or None)}
+_missing = {}  # {hash: time when its sidecar was last found missing}
+_aliases_lock = threading.Lock()
+
+
+def sidecar_dir():
+    return getattr(settings, 'SIDECAR_DB_PATH', None) or join(GEMINI_DB_PATH, '.sidecars')
+
+def sidecar_path(sha):
+    """Path to the sidecar of the db with hash *sha*."""
+    return join(sidecar_dir(), '{}.v{}.db'.format(sha, SIDECAR_VERSION))
+
+def sidecar_columns():
+    """Columns of the *variants* table that are copied: all but blobs."""
+    return [f.column for f in Variants._meta.get_fields() if not isinstance(f, BinaryField)]
+
+def indexed_columns():
+    """Columns of the filterable fields."""
+    from varapp.filters.filters_factory import variant_filters_map
+    names = {getattr(f, 'field_name', '') for f in variant_filters_map.values()}
+    columns = []
+    for f in Variants._meta.get_fields():
+        if f.name in names and f.column not in columns and f.column != 'variant_id':
+            columns.append(f.column)
+    return columns
+
+
+def build_sidecar(dbname):
+    """Build the sidecar of *dbname* for its current hash, unless it exists. Return its path,
+    or None if the hash of the db is unknown. Only one process builds it; it is written to a
+    temporary file first, so that a sidecar that exists is always complete."""
+    sha = get_db_hash(dbname)
+    if sha is None:
+        return None
+    path = sidecar_path(sha)
+    if os.path.exists(path):
+        _found(sha)
+        return path
+    with build_lock('sidecar:{}'.format(sha)):
+        if not os.path.exists(path):  # maybe built by another process meanwhile
+            logging.info("[sidecar] Building sidecar of db '{}'".format(dbname))
+            os.makedirs(sidecar_dir(), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                _write_sidecar(settings.DATABASES[dbname]['NAME'], tmp)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    _found(sha)
+    return path
+
+def _found(sha):
+    """Forget that the sidecar of *sha* was missing, so that `index_db` uses it from now on."""
+    with _aliases_lock:
+        _missing.pop(sha, None)
+
+def _write_sidecar(source, path):
+    conn = sqlite3.connect('file:' + pathname2url(os.path.abspath(path)), uri=True)
+    try:
+        conn.execute("ATTACH DATABASE ? AS gemini", (file_uri(source),))
+        types = {r[1]: r[2] for r in conn.execute("PRAGMA gemini.table_info(variants)")}
+        columns = [c for c in sidecar_columns() if c in types]
+        definitions = ['"{}" {}'.format(c, 'INTEGER PRIMARY KEY' if c == 'variant_id' else types[c])
+                       for c in columns]
+        quoted = ','.join('"{}"'.format(c) for c in columns)
+        conn.execute("CREATE TABLE variants ({})".format(','.join(definitions)))
+        conn.execute("INSERT INTO variants ({0}) SELECT {0} FROM gemini.variants".format(quoted))
+        conn.commit()
+        conn.execute("DETACH DATABASE gemini")
+        conn.execute("CREATE INDEX location_idx ON variants({})".format(
+            ','.join('"{}"'.format(c) for c in LOCATION_INDEX)))
+        for c in indexed_columns():
+            if c in columns and c not in LOCATION_INDEX[:1]:
+                conn.execute('CREATE INDEX "{0}_idx" ON variants("{0}")'.format(c))
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def index_alias(dbname, sha):
+    return '{}__index_{}'.format(dbname, sha[:12])
+
+def release_index_db(dbname, sha):
+    """Remove the connection alias of the sidecar of version *sha* of *dbname*, once it is not used anymore."""
+    alias = index_alias(dbname, sha)
+    with _aliases_lock:
+        if _aliases.get(dbname, (None, None))[1] == alias:
+            _aliases.pop(dbname)
+        settings.DATABASES.pop(alias, None)
+        connections.databases.pop(alias, None)
+
+def index_db(dbname):
+    """Return the connection alias of the sidecar of *dbname* for its current hash,
+    registering it on first call, or *dbname* itself if there is none.
+    A missing sidecar is looked for again after MISSING_RECHECK seconds, or once this process built it."""
+    sha = get_db_hash(dbname)
+    with _aliases_lock:
+        known = _aliases.get(dbname)
+        if known is not None and known[0] == sha and known[1] is not None:
+            return known[1]
+        if sha is None or time.time() - _missing.get(sha, 0) < MISSING_RECHECK:
+            return dbname
+        alias = None
+        if os.path.exists(sidecar_path(sha)):
+            # One alias per version, since other threads keep their connection to the previous one
+            alias = index_alias(dbname, sha)
+            connection = {
+                'ENGINE': 'varapp.backends.gemini_sqlite',
+                'NAME': sidecar_path(sha),
+                # Written once, then renamed: never rewritten in place
+                'PROFILE': dict(sqlite_profile(dbname), IMMUTABLE=True),
+            }
+            settings.DATABASES[alias] = connection
+            connections.databases[alias] = connection
+        else:
+            _missing[sha] = time.time()
+        _aliases[dbname] = (sha, alias)
+    return alias or dbname
@@ -0,0 +1,218 @@
+"""
+Warm-up of the caches of all active dbs at startup, in the background.
+Dbs are built in parallel by a pool of worker processes, the most recently used first,
+while the web process already accepts requests. Workers fill Redis (stats masks, global stats,
+genotypes, versions); the web process then reads them from there on first access.
+The state of each db is one of 'pending', 'building', 'ready' or 'failed'.
+
+With a preforking server that loads the app before forking (e.g. gunicorn --preload),
+settings.PRELOAD_DBS makes the master process build and load everything before the workers are forked.
+The workers then share the physical pages of these immutable structures (copy-on-write),
+and skip their own warm-up.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from varapp.common.connection_pool import close_idle_pools
+from varapp.common.generations import generations
+from concurrent.futures import ProcessPoolExecutor
+import gc
+import threading
+import time
+import traceback
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+PENDING = 'pending'
+BUILDING = 'building'
+READY = 'ready'
+FAILED = 'failed'
+
+USAGE_KEY = 'usage:dbs'    # Redis sorted set of dbs, scored by their last access time
+USAGE_RECORD_INTERVAL = 60  # seconds between two records of the usage of the same db by a process
+
+_last_usage_records = {}
+_scheduler = None
+
+
+## Usage
+
+def record_usage(dbname):
+    """Record that *dbname* was just accessed, so that it is warmed up first at the next startup.
+    Sent to Redis at most once per USAGE_RECORD_INTERVAL by each process."""
+    now = time.time()
+    if now - _last_usage_records.get(dbname, 0) < USAGE_RECORD_INTERVAL:
+        return
+    _last_usage_records[dbname] = now
+    cache = caches['redis']
+    cache.client.get_client(write=True).zadd(cache.make_key(USAGE_KEY), {dbname: now})
+
+def usage_order(dbnames):
+    """Return *dbnames* sorted from the most to the least recently used."""
+    cache = caches['redis']
+    last_used = dict(cache.client.get_client(write=False).zrange(cache.make_key(USAGE_KEY), 0, -1, withscores=True))
+    return sorted(dbnames, key=lambda db: -last_used.get(db.encode(), 0))
+
+
+## Build
+
+def warm_db(dbname, stats=True, genotypes=True):
+    """Build the caches of *dbname*. Runs in a worker process, or in the current one."""
+    from varapp.common.cache.single_flight import build_wait, BUILD_LOCK_TIMEOUT
+    from varapp.common.sidecar import build_sidecar
+    from varapp.common.versioning import add_versions
+    from varapp.stats.stats_service import stats_service
+    from varapp.variants.genotypes_service import genotypes_service
+    # Nobody is waiting for a response: wait as long as another process is building the same caches
+    try:
+        with build_wait(BUILD_LOCK_TIMEOUT):
+            # So that this version is served until a new one is ready, if its file is replaced
+            generations().pin_served(dbname)
+            # First, so that the stats below are read from it
+            if settings.SIDECAR_DBS:
+                build_sidecar(dbname)
+            if stats:
+                stats_service(dbname)
+            if genotypes:
+                genotypes_service(dbname)
+            # Update the *annotation* table with versions of all programs used,
+            # i.e. Gemini, VEP, their dbs, etc.
+            add_versions(dbname)
+    finally:
+        connections[dbname].close()
+    return dbname
+
+
+def preload(dbnames):
+    """Load all the immutable structures of *dbnames* in the local memory of this process:
+    genotypes, gene batches and chrX, stats masks and histogram bins, gene summary,
+    location index and default sort order. Meant to run in a master process before it forks workers:
+    then ready-made objects are collected by `gc.freeze`, so that the garbage collector
+    of the workers does not write to (and thus copy) their memory pages.
+    `gc.freeze` only exists from Python 3.7: before, only the data of numpy arrays stays shared."""
+    from varapp.annotation.annotation_service import gene_summary_service
+    from varapp.annotation.location_index import location_index
+    from varapp.stats.stats_service import stats_service
+    from varapp.variants.genotypes_service import genotypes_service
+    from varapp.variants.sort_service import sort_service, LOCATION_FIELDS
+    for db in dbnames:
+        logging.info("[warmup] Preloading db '{}'".format(db))
+        try:
+            gs = genotypes_service(db)
+            gs.chrX, gs.variant_ids_batches_by_gene
+            stats = stats_service(db)
+            stats.masks_matrix()
+            stats.binned_columns()
+            location_index(db)
+            sort_service(db).permutation(LOCATION_FIELDS)
+            try:
+                gene_summary_service(db)
+            except FileNotFoundError:  # no gene_summary table
+                pass
+        except Exception:
+            logging.error("[warmup] Could not preload db '{}': {}".format(db, traceback.format_exc()))
+    # Forked workers must not share the parent's db connections, including the idle ones of the pools
+    connections.close_all()
+    close_idle_pools()
+    gc.collect()
+    if hasattr(gc, 'freeze'):  # Python >= 3.7
+        gc.freeze()
+
+
+class WarmupScheduler:
+    """Builds the caches of a list of dbs, and keeps track of the state of each.
+    :param workers: number of worker processes. If 0, dbs are built one after the other
+        in the current process, before `start` returns.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._states = {}   # {db: {'state', 'error', 'started', 'finished'}}
+        self._futures = {}  # {db: Future}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, dbnames, stats=True, genotypes=True, inline=False):
+        """Schedule the warm-up of *dbnames*, the most recently used first.
+        :param inline: build them in the current process before returning, whatever the number of workers.
+        """
+        dbnames = usage_order(dbnames)
+        with self._lock:
+            for db in dbnames:
+                self._states[db] = {'state': PENDING, 'error': None, 'started': None, 'finished': None}
+        if inline or self.workers == 0:
+            for db in dbnames:
+                self._run_inline(db, stats, genotypes)
+        else:
+            self._thread = threading.Thread(target=self._run_pool, args=(dbnames, stats, genotypes),
+                                            name='warmup', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run_inline(self, db, stats, genotypes):
+        self._set_state(db, BUILDING, started=time.time())
+        try:
+            warm_db(db, stats, genotypes)
+            self._set_state(db, READY, finished=time.time())
+        except Exception as error:
+            logging.error("[warmup] {}".format(traceback.format_exc()))
+            self._failed(db, repr(error))
+
+    def _run_pool(self, dbnames, stats, genotypes):
+        # Workers are forked from this thread, and inherit its (thread-local) db connections:
+        # close them so that workers open their own. Those of other threads are never used by the workers.
+        # Idle pooled connections are shared by all threads: close them too.
+        connections.close_all()
+        close_idle_pools()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for db in dbnames:
+                future = pool.submit(warm_db, db, stats, genotypes)
+                future.add_done_callback(self._done_callback(db))
+                with self._lock:
+                    self._futures[db] = future
+
+    def _done_callback(self, db):
+        def done(future):
+            error = future.exception()
+            if error is None:
+                generations().pin_served(db)  # pinned by the worker: read it from there here too
+                self._set_state(db, READY, finished=time.time())
+                logging.info("[warmup] Db '{}' is ready".format(db))
+            else:
+                self._failed(db, repr(error))
+        return done
+
+    def _failed(self, db, error):
+        logging.error("[warmup] Db '{}' failed: {}".format(db, error))
+        self._set_state(db, FAILED, error=error, finished=time.time())
+
+    def _set_state(self, db, state, **kwargs):
+        with self._lock:
+            self._states[db].update(state=state, **kwargs)
+
+    def status(self, db):
+        """Return a dict describing the warm-up of *db*, or None if it was not scheduled."""
+        with self._lock:
+            if db not in self._states:
+                return None
+            status = dict(self._states[db])
+            future = self._futures.get(db)
+        if status['state'] == PENDING and future is not None and future.running():
+            status['state'] = BUILDING
+        return status
+
+    def statuses(self):
+        """Return `{db: status}` for all scheduled dbs."""
+        return {db: self.status(db) for db in list(self._states)}
+
+    def is_done(self):
+        """Whether all dbs are either ready or failed."""
+        return all(s['state'] in (READY, FAILED) for s in self.statuses().values())
+
+
+def warmup_scheduler():
+    """Return the WarmupScheduler of this process."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = WarmupScheduler(getattr(settings, 'WARMUP_WORKERS', 4))
+    return _scheduler
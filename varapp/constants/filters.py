@@ -5,6 +5,7 @@ FILTER_CLASS_LOCATION = 'location'
 FILTER_CLASS_FREQUENCY = 'frequency'
 FILTER_CLASS_IMPACT = 'impact'
 FILTER_CLASS_GENOTYPE = 'genotype'
+FILTER_CLASS_EXPRESSION = 'expression'
 
 # Correspondance between our names and gemini column names
 TRANSLATION = {'pass_filter':'filter', 'quality':'qual', 'fisher_strand_bias':'FS',
@@ -24,7 +24,7 @@ def user_factory(u: Users):
             logger.warning("Database '{}' "
                             "found in users db but not in settings.DATABASES. "
                             "It was probably introduced manually. Syncing.".format(db.name))
-            manage_dbs.add_db_to_settings(db.name, db.filename)
+            manage_dbs.add_db_to_settings(db.name, db.filename, sha=db.hash)
         if not os.path.exists(settings.DATABASES.get(db.name)['NAME']):
             logger.warning("Database '{}' not found on disk!".format(db.name))
             vdb = VariantsDb.objects.get(name=db.name)
@@ -59,8 +59,10 @@ def users_list_from_users_db(query_set=None, db='default'):
 
 def databases_list_from_users_db(query_set=None, db='default'):
     """Return a list of Database objects, one per active entry in VariantsDb."""
-    manage_dbs.activate_deactivate_at_gemini_path()
-    manage_dbs.diff_disk_VariantsDb()
+    from varapp.common.db_watcher import db_watcher
+    if db_watcher() is None:  # otherwise it is synced in the background
+        manage_dbs.activate_deactivate_at_gemini_path()
+        manage_dbs.diff_disk_VariantsDb()
     if query_set is None:
         query_set = VariantsDb.objects.using(db).filter(is_active=1)
     return [database_factory(d) for d in query_set]
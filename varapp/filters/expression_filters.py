@@ -0,0 +1,146 @@
+"""
+Boolean expressions of variant filters, such as
+`(impact_severity=HIGH OR cadd_scaled>=25) AND NOT in_dbsnp`.
+Keywords AND, OR, NOT are case-insensitive, AND has precedence over OR,
+and the terms have the same syntax as in the 'filter' GET parameter.
+The expression is parsed into a tree whose leaves are VariantFilters. It is evaluated
+either as bitwise operations on the leaves' masks, or as a single Q object (SQL).
+A variant passes `NOT x` whenever it does not pass `x`, even if it has no value for that field.
+"""
+from django.db.models import Q
+from varapp.common import masking
+from varapp.constants.filters import FILTER_CLASS_EXPRESSION
+from varapp.data_models.variants import Variant
+from varapp.filters.filters import VariantFilter
+from functools import reduce
+import numpy as np
+import re
+
+AND = 'AND'
+OR = 'OR'
+NOT = 'NOT'
+_TOKEN = re.compile(r"\(|\)|[^\s()]+")
+
+
+def parse_expression(expr, make_leaf):
+    """Parse the string *expr* into a tree of nested tuples `(AND, [children])`,
+    `(OR, [children])` and `(NOT, child)`, where the leaves are `make_leaf(term)`
+    for each term of the expression, e.g. 'quality>=100'.
+    """
+    tokens = _TOKEN.findall(expr)
+    pos = 0
+
+    def error(msg):
+        return ValueError("Invalid filter expression '{}': {}.".format(expr, msg))
+
+    def peek():
+        return tokens[pos].upper() if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        children = [parse_and()]
+        while peek() == OR:
+            pos += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else (OR, children)
+
+    def parse_and():
+        nonlocal pos
+        children = [parse_not()]
+        while peek() == AND:
+            pos += 1
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else (AND, children)
+
+    def parse_not():
+        nonlocal pos
+        tok = peek()
+        if tok is None:
+            raise error("unexpected end")
+        if tok == NOT:
+            pos += 1
+            return (NOT, parse_not())
+        if tok == '(':
+            pos += 1
+            node = parse_or()
+            if peek() != ')':
+                raise error("missing ')'")
+            pos += 1
+            return node
+        if tok in (AND, OR, ')'):
+            raise error("unexpected '{}'".format(tokens[pos]))
+        pos += 1
+        return make_leaf(tokens[pos-1])
+
+    tree = parse_or()
+    if pos < len(tokens):
+        raise error("unexpected '{}'".format(tokens[pos]))
+    return tree
+
+
+class ExpressionFilter(VariantFilter):
+    """A boolean combination of other variant filters.
+    :param tree: the parsed expression, as returned by `parse_expression`.
+    :param val: the expression string, for display and cache keys.
+    """
+    field_name = 'expression'
+    filter_class = FILTER_CLASS_EXPRESSION
+    use_mask = True
+
+    def __init__(self, tree, val='', db=None):
+        super().__init__(val=val, db=db)
+        self.tree = tree
+
+    @property
+    def leaves(self):
+        """Return the list of the leaf filters."""
+        def walk(node):
+            if not isinstance(node, tuple):
+                return [node]
+            children = node[1] if node[0] != NOT else [node[1]]
+            return [f for c in children for f in walk(c)]
+        return walk(self.tree)
+
+    def condition(self, variant):
+        def evaluate(node):
+            if not isinstance(node, tuple):
+                return node.condition(variant)
+            op, children = node
+            if op == NOT:
+                return not evaluate(children)
+            elif op == AND:
+                return all(evaluate(c) for c in children)
+            else:
+                return any(evaluate(c) for c in children)
+        return evaluate(self.tree)
+
+    def django_condition(self):
+        def evaluate(node):
+            if not isinstance(node, tuple):
+                return node.django_condition()
+            op, children = node
+            if op == NOT:
+                # Plain ~Q would also exclude the variants with no value for that field.
+                # No `using`: the subquery runs on the db of the outer query, maybe the sidecar index db.
+                passing = Variant.objects.filter(evaluate(children)).values('variant_id')
+                return ~Q(variant_id__in=passing)
+            elif op == AND:
+                return reduce(lambda a,b: a & b, map(evaluate, children))
+            else:
+                return reduce(lambda a,b: a | b, map(evaluate, children))
+        return evaluate(self.tree)
+
+    def mask(self, N, db=None):
+        """Combine the leaves' masks with bitwise operations."""
+        db = db or self.db
+        def evaluate(node):
+            if not isinstance(node, tuple):
+                return node.mask(N, db)
+            op, children = node
+            if op == NOT:
+                return masking.binary_not(evaluate(children), N)
+            elif op == AND:
+                return reduce(masking.binary_and, map(evaluate, children))
+            else:
+                return reduce(masking.binary_or, map(evaluate, children))
+        return np.asarray(evaluate(self.tree), dtype=np.uint8)
@@ -6,8 +6,12 @@ from varapp.constants.filters import *
 from varapp.constants.genotype import *
 from varapp.data_models.variants import VariantsCollection, Variant, VARIANT_FIELDS
 from varapp.variants.genotypes_service import genotypes_service
-from varapp.variants.variants_factory import namedtuples, extract_variants_from_ids_bin_array
+from varapp.variants.sort_service import sort_service, SortService
+from varapp.variants.variants_factory import namedtuples, extract_variants_from_ids_bin_array, ids_bin_array, \
+    fetch_variants
+from varapp.filters.pagination import Cursor, InvalidCursor
 from varapp.common import masking
+from varapp.common.sidecar import index_db
 import abc, hashlib
 import numpy as np
 from operator import attrgetter
@@ -18,10 +22,20 @@ DEBUG = False and settings.DEBUG
 
 class FilterResult:
     """Stores info about the result of applying a filter (-collection)"""
-    def __init__(self, variants=None, ids=None, n_filtered=0, sources=None):
+    def __init__(self, variants=None, ids=None, n_filtered=0, sources=None, cursor=None, mask=None):
         self.variants = variants      # (list) A (sub)set of filtered variants to expose (send to frontend)
-        self.ids = ids                # (set) The set of all filtered variant ids (not just the subset)
         self.n_filtered = n_filtered  # (int) Total number of filtered variants
+        self.cursor = cursor          # (Cursor) Points to the last exposed variant, if there is a next page
+        self.mask = mask              # (np.ndarray) Packed binary array, 1 at index variant_id-1 if it passed
+        self._ids = ids
+
+    @property
+    def ids(self):
+        """(np.ndarray) The set of all filtered variant ids (not just the subset).
+        If only the mask is known, they are computed on first access."""
+        if self._ids is None and self.mask is not None:
+            self._ids = np.asarray(masking.to_indices(np.unpackbits(self.mask)) + 1, dtype=np.uint64)
+        return self._ids
 
 
 class Filter:
@@ -60,6 +74,7 @@ class VariantFilter(Filter):
     """Abstract class for QuerySet filters."""
     __metaclass__ = abc.ABCMeta
     field_name = ''  # name used in the local variant model (the db column name)
+    use_mask = False  # if True, FiltersCollection.apply rather evaluates it with `mask()` than in SQL
 
     def __init__(self, val='', name='', op='=', ss=None, db=None):
         super().__init__(op=op, ss=ss, db=db)
@@ -88,6 +103,13 @@ class VariantFilter(Filter):
         """The condition that a *variant* must satisfy in order to pass the filter.
         condition(v) -> Boolean."""
 
+    def mask(self, N, db=None):
+        """Return the packed binary array of length *N* (the number of variants in the db),
+        with 1 at index variant_id-1 of each variant passing the filter.
+        By default it is read from the db; subclasses can build it from cached data."""
+        qs = Variant.objects.using(index_db(db or self.db)).filter(self.django_condition()).order_by()
+        return masking.pack(ids_bin_array(qs, N))
+
     def apply(self, db=None, initqs=None, limit=None, offset=0):
         """Applies a unique filter to the database.
         :rtype: FilterResult"""
@@ -130,8 +152,9 @@ class FiltersCollection:
         impa = self.get_filters_by_class('impact')
         loca = self.get_filters_by_class('location')
         path = self.get_filters_by_class('pathogenicity')
+        expr = self.get_filters_by_class('expression')
         geno = self.get_filters_by_class('genotype')
-        return qual + freq + impa + loca + path + geno
+        return qual + freq + impa + loca + path + expr + geno
 
     def __len__(self):
         """Return the number of filters in the collection."""
@@ -183,6 +206,10 @@ class FiltersCollection:
     @property
     def genotype_filters(self):
         return [f for f in self._dict.values() if f.filter_class == FILTER_CLASS_GENOTYPE]
+    @property
+    def mask_filters(self):
+        """Variant filters that are better evaluated as masks than in SQL."""
+        return [f for f in self.variant_filters if f.use_mask]
 
     def cache_key(self):
         """build a cache key as a string concatenating filters key/op/val"""
@@ -193,7 +220,8 @@ class FiltersCollection:
     ######################################################################################
 
     #@timer
-    def apply(self, db=None, initqs=None, limit=None, offset=0, sort_by=None, reverse=False, batch_size=500):
+    def apply(self, db=None, initqs=None, limit=None, offset=0, sort_by=None, reverse=False, batch_size=500,
+              cursor=None, mask_only=False):
         """Applies all filters in list to the database. Return a FilterResult with
          *limit* variants to expose.
         :param initqs: A QuerySet to be further filtered.
@@ -204,44 +232,71 @@ class FiltersCollection:
         :param offset: number of variants to skip before returning *limit* of them.
         :param sort_by: (str) name of the field to sort by.
         :param reverse: (bool) whether to reverse the ordering.
+        :param cursor: a pagination.Cursor pointing to the last variant of the previous page.
+            If set, *offset* is ignored and the variants start right after that one.
+        :param mask_only: only compute the filtered set (its mask, or ids), not the page of variants:
+            then sorting and pagination are ignored, and no sort permutation is needed.
         :rtype: FilterResult
         """
         is_sorted = sort_by and sort_by in VARIANT_FIELDS
         is_gen_filter = len(self.genotype_filters) > 0
         is_var_fiter = len(self.variant_filters) > 0
 
+        # Queries that only need variant ids go to the sidecar index db, if any
         if initqs is None:
             initqs = Variant.objects.using(db)
-
-        # Filter what can be filtered directly in the db
-        conds = [f.django_condition() for f in self.variant_filters]
+            ids_db = index_db(db)
+        else:
+            ids_db = initqs.db
+
+        # Filter what can be filtered directly in the db.
+        # If there is a genotype filter, some are rather evaluated as masks, see below.
+        sql_filters = self.variant_filters
+        if is_gen_filter:
+            sql_filters = [f for f in sql_filters if not f.use_mask]
+        conds = [f.django_condition() for f in sql_filters]
         conds = [x for x in conds if x]
         qs = initqs.filter(*conds)
 
-        # Sort what can be sorted directly in the db
+        # Sort what can be sorted directly in the db.
+        # Ties are broken by variant_id, so that a cursor can tell where a page ends.
         if is_sorted:
-            sort_key = '-'+sort_by if reverse else sort_by
-            qs = qs.order_by(sort_key)
+            order_fields = [sort_by]
         else:
-            qs = qs.order_by('chrom','start')  # trust Gemini for that
+            order_fields = ['chrom','start']  # trust Gemini for that
+            reverse = False
+        sign = '-' if reverse else ''
+        qs = qs.order_by(*[sign+f for f in order_fields + ['variant_id']])
+        if cursor is not None:
+            cursor.check(order_fields, reverse)
+            offset = 0
 
         # If no genotype filter, paginate from db and return the collection.
         # For the moment it never happens because there is always at least the 'active' gen filter.
-        n_filtered = qs.count()
-        if not is_gen_filter or n_filtered == 0:
-            ids = np.asarray(list(qs.values_list('variant_id', flat=True)), dtype=np.uint64)
+        mask = None
+        if not is_gen_filter:
+            n_filtered = qs.using(ids_db).count()
+            ids_qs = qs.order_by() if mask_only else qs
+            ids = np.asarray(list(ids_qs.using(ids_db).values_list('variant_id', flat=True)), dtype=np.uint64)
+            page_qs = qs
+            if cursor is not None:
+                page_qs = page_qs.filter(cursor.condition())  # seek using the db indexes
             if limit is not None:
-                qs = qs[offset:offset+limit]
-            variants = namedtuples(qs)  # instead of list
+                page_qs = page_qs[offset:offset+limit]
+            variants = namedtuples(page_qs) if not mask_only else []  # instead of list
 
         # If genotype filter, get indices from gen service, indices from
         # the variant filters (nothing is evaluated yet), and return the intersection.
+        # Only the first *offset+limit* variants in sort order are looked for (top-k):
+        # the total count is the number of bits set in the intersection mask,
+        # and the filtered ids are only computed if someone asks for them.
         else:
             gf = self.genotype_filters[0]
             is_compound = gf.val == GENOTYPE_COMPOUND
             gs = genotypes_service(db=db)
             sources = {}; pairs = []
-            sql_indices = []; bin_ids = np.zeros(0)
+            ordered_indices = []; size = 0
+            sorter = None  # a SortService, if the order is that of one of its permutations
             if is_compound:
                 gen_indices,sources,pairs = gf.scan_genotypes_compound(genotypes=gs.genotypes, batches=gs.variant_ids_batches_by_gene)
             elif gf.val == 'x_linked':
@@ -251,45 +306,80 @@ class FiltersCollection:
             # If nothing left, return
             if len(gen_indices) == 0:
                 ids = np.zeros(0)
+                n_filtered = 0
             # Find the variant ids that are present in both var filtered and gen filtered sets
             elif is_var_fiter or is_sorted or initqs is not None:
-                max_gen_index = gen_indices[-1]
-                qs_indices = qs.values_list('variant_id', flat=True).filter(variant_id__lte=max_gen_index)
+                max_gen_index = int(gen_indices[-1])
+                qs_indices = qs.filter(variant_id__lte=max_gen_index).using(ids_db)
                 t1 = time()
-                sql_indices = list(qs_indices)  # qs is already ordered_by, so are sql_indices
+                if mask_only or SortService.is_sortable(order_fields):
+                    # The order is given by a precomputed permutation of all variants,
+                    # so the db does not need to sort them, and they can be streamed.
+                    bin_sql = ids_bin_array(qs_indices.order_by(), max_gen_index)
+                    sorter = sort_service(db) if not mask_only else None
+                else:
+                    sql_indices = list(qs_indices.values_list('variant_id', flat=True))  # ordered as qs
+                    bin_sql = masking.to_binary_array(sql_indices, max_gen_index)
+                    ordered_indices = sql_indices
+                # From here on, everything stays packed: the page is found by walking the mask
+                # in the sort order, so only its own variants are ever unpacked.
+                mask = masking.pack(bin_sql)
+                size = max_gen_index
+                for f in self.mask_filters:
+                    mask &= f.mask(gs.N, db)[:len(mask)]
                 t2 = time()
                 if DEBUG: print("  Apply fc :: Instantiate sql indices:", t2-t1)
-                bin_sql = masking.pack(masking.to_binary_array(sql_indices, max_gen_index))
-                bin_gen = masking.pack(masking.to_binary_array(gen_indices, max_gen_index)),
-                bin_ids = masking.unpack(masking.binary_and(bin_sql, bin_gen), max_gen_index)  # always sorted by id
+                mask &= masking.pack_indices(gen_indices, max_gen_index)
                 t3 = time()
                 if DEBUG: print("  Apply fc :: Sets intersection:", t3-t2)
                 # If compound, filter out those were after intersection, a gene has only one component left
                 if is_compound:
-                    bin_keep = np.zeros(max_gen_index, dtype=np.bool_)
-                    for a,b in pairs:
-                        if bin_ids[a-1] & bin_ids[b-1]:
-                            bin_keep[a-1] = 1
-                            bin_keep[b-1] = 1
-                    bin_ids = masking.binary_and(bin_ids, bin_keep)
+                    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+                    both = masking.is_set(mask, pairs[:,0]) & masking.is_set(mask, pairs[:,1])
+                    mask = masking.pack_indices(pairs[both].ravel(), max_gen_index)
                     t4 = time()
                     if DEBUG: print("  Apply fc :: Compound pairs filtering:", t4-t3)
-                ids = masking.to_indices(bin_ids)+1
+                ids = None  # computed from the mask if necessary
+                n_filtered = masking.popcount(mask)
             # If the only filter is on genotypes and no need to sort, skip slow steps
             else:
                 ids = gen_indices
+                n_filtered = len(ids)
 
-            n_filtered = len(ids)
             # Extract the variants for the filtered ids from the inital QuerySet,
             # up to limit (i.e. up to ~300 variants to expose).
-            # We need to pass `sql_indices` on top of `ids` because the latter is sorted,
+            # We need to pass `ordered_indices` on top of the mask because the latter is sorted by id,
             # and we want the top of the sorted QuerySet.
-            variants = extract_variants_from_ids_bin_array(qs, bin_ids, sql_indices, limit, offset, batch_size, sources)
+            # A cursor is resumed from its position in the sort permutation, without scanning it.
+            after_id = cursor.variant_id if cursor is not None else None
+            page_mask = mask if mask is not None else np.zeros(0, dtype=np.uint8)
+            if mask_only:
+                variants = []
+            elif sorter is not None:
+                n = limit if limit is not None else n_filtered
+                try:
+                    page_ids = sorter.first(page_mask, n, order_fields, reverse, offset, after_id, size=size)
+                except ValueError as e:  # e.g. a cursor from a previous version of the db
+                    raise InvalidCursor(str(e))
+                variants = fetch_variants(qs, page_ids, batch_size, sources)
+            else:
+                try:
+                    variants = extract_variants_from_ids_bin_array(qs, page_mask, ordered_indices, limit, offset,
+                                                                   batch_size, sources, after_id=after_id, size=size)
+                except ValueError as e:  # the variant of the cursor is not part of the result
+                    raise InvalidCursor(str(e))
+
+        # Point to the last variant of this page, if there can be a next one
+        next_cursor = None
+        if limit and len(variants) == limit:
+            next_cursor = Cursor.from_db(initqs, variants[-1].variant_id, order_fields, reverse)
 
         return FilterResult(
             variants = VariantsCollection(variants, db=db),
             n_filtered = n_filtered,
-            ids = np.asarray(ids, dtype=np.uint64),
+            ids = np.asarray(ids, dtype=np.uint64) if ids is not None else None,
+            cursor = next_cursor,
+            mask = mask,
         )
 
     def __str__(self):
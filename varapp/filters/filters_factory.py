@@ -6,6 +6,7 @@ or a GET request that provides them).
 from varapp.filters.filters import FiltersCollection
 from varapp.filters.variant_filters import *
 from varapp.filters.genotype_filters import *
+from varapp.filters.expression_filters import ExpressionFilter, parse_expression
 from varapp.samples.samples_service import samples_selection_from_request
 import re
 
@@ -82,6 +83,28 @@ def variant_filter_factory(name, op, val, db=None, samples_selection=None):
         raise ValueError("Unknown filtering option: '{}={}'.".format(name, val))
     return f
 
+def parse_filter_string(f):
+    """Split a string such as 'quality>=100' into a tuple (name, op, val).
+    A name alone, such as 'in_dbsnp', stands for 'in_dbsnp=1'."""
+    m = re.match(r"(\S+?)([<>=]{1,2})(.+)", f)
+    if m:
+        return m.groups()
+    else:
+        return (f, '=', '1')
+
+def expression_filter_factory(expr, db=None):
+    """Create an ExpressionFilter from a string such as
+    '(impact_severity=HIGH OR cadd_scaled>=25) AND NOT in_dbsnp'.
+    :rtype: ExpressionFilter
+    """
+    def make_leaf(term):
+        name, op, val = parse_filter_string(term)
+        if name == 'genotype':
+            raise ValueError("Genotype filters cannot be part of a filter expression: '{}'.".format(term))
+        return variant_filter_factory(name, op, val, db)
+    tree = parse_expression(expr, make_leaf)
+    return ExpressionFilter(tree, val=expr, db=db)
+
 def variant_filters_collection_factory(filters, samples_selection=None, db='default'):
     """Creates a list of Filter subclass instances from a list of (name,op,val) tuples.
     (name: filter name, op: '[<>=]', val: filter value).
@@ -98,7 +121,8 @@ def variant_filters_collection_factory(filters, samples_selection=None, db='defa
 def variant_filters_from_request(request, db, samples_selection=None):
     """Parse a GET Request and return a list of requested filters.
     A filter is a tuple (name, operation, value), corresponding to a request
-    of the type '?name=value'. See the REST API documentation for more information.
+    of the type '?filter=name<op>value', plus an ExpressionFilter for the '?expr=...' parameters.
+    See the REST API documentation for more information.
     :rtype: FiltersCollection
     """
     filters = []
@@ -106,11 +130,13 @@ def variant_filters_from_request(request, db, samples_selection=None):
     if samples_selection is None:
         samples_selection = samples_selection_from_request(request, db)
     for f in filterlist:
-        m = re.match(r"(\S+?)([<>=]{1,2})(.+)", f)
-        if m:
-            k, op, v = m.groups()
-            filters.append((k, op, v))
-        else:
-            filters.append((f, '=', '1'))
-    return variant_filters_collection_factory(filters, samples_selection, db)
+        filters.append(parse_filter_string(f))
+    fc = variant_filters_collection_factory(filters, samples_selection, db)
+    # Boolean expressions, as in '?expr=(impact_severity=HIGH OR cadd_scaled>=25) AND NOT in_dbsnp'.
+    # Several of them are combined with AND.
+    exprlist = [e for e in request.GET.getlist('expr', []) if e.strip()]
+    if exprlist:
+        expr = ' AND '.join('({})'.format(e) for e in exprlist) if len(exprlist) > 1 else exprlist[0]
+        fc.append(expression_filter_factory(expr, db))
+    return fc
 
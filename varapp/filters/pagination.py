@@ -1,28 +1,40 @@
 """
 Pagination: select how many results to display.
+Either skip the first *offset* results, or resume right after a *cursor*
+pointing to the last variant of the previous page.
 """
+from django.db.models import Q, F, ExpressionWrapper, FloatField, DecimalField
+import base64, binascii, json
+
 
 # Maybe refactor later the same way as variant_filter,
 # but maybe not necessary as long as they are so simple.
 def pagination_from_request(request):
     lim = request.GET.get('limit')
     off = request.GET.get('offset', '0')
+    cur = request.GET.get('cursor')
     assert off.isdigit(), "Argument to 'offset' must be an integer"
     off = int(off)
     if lim is not None:
         assert lim.isdigit(), "Argument to 'limit' must be an integer"
         lim = int(lim)
-    return Pagination(lim, off)
+    if cur:
+        cur = Cursor.decode(cur)
+    else:
+        cur = None
+    return Pagination(lim, off, cur)
 
 
 class Pagination:
-    def __init__(self, limit=None, offset=0):
+    def __init__(self, limit=None, offset=0, cursor=None):
         """
         :param limit: (int) keep only that many.
         :param offset: (int) skip that many.
+        :param cursor: (Cursor) start right after that variant. Overrides *offset*.
         """
         self.lim = limit
         self.off = offset
+        self.cursor = cursor
 
     def limit(self, variants):
         """Keep only the first *lim* variants.
@@ -44,3 +56,94 @@ class Pagination:
             var = self.limit(var)
         return var
 
+
+class InvalidCursor(ValueError):
+    """The pagination cursor cannot be used: it is malformed, was made for another ordering,
+    or points to a variant that is not part of the result (e.g. of a previous version of the db)."""
+
+
+class Cursor:
+    """Points to the last variant of a page: its values for the sorting *fields*, and its id.
+    The next page starts right after it, so its cost does not depend on how deep it is.
+    It is sent to the frontend as an opaque string (see `encode`).
+    """
+    def __init__(self, key, variant_id, fields, reverse=False):
+        """
+        :param key: list of values of the variant for each of the sorting *fields*.
+        :param variant_id: id of the variant, to break ties.
+        :param fields: names of the fields the variants are sorted by.
+        :param reverse: (bool) whether the ordering is reversed.
+        """
+        self.key = list(key)
+        self.variant_id = int(variant_id)
+        self.fields = list(fields)
+        self.reverse = bool(reverse)
+
+    @classmethod
+    def from_db(cls, qs, variant_id, fields, reverse=False):
+        """Make a cursor pointing to the variant *variant_id* of *qs*, in the ordering given by *fields*,
+        with its values as stored in the db. Those of the model can be rounded (DecimalField):
+        compared with the column, they would select again the variants of the previous pages."""
+        exprs = {}
+        for f in fields:
+            if isinstance(qs.model._meta.get_field(f), DecimalField):
+                exprs['_cursor_'+f] = ExpressionWrapper(F(f), output_field=FloatField())
+            else:
+                exprs['_cursor_'+f] = F(f)
+        key = qs.order_by().filter(variant_id=variant_id).annotate(**exprs) \
+                .values_list(*['_cursor_'+f for f in fields]).first()
+        if key is None:
+            raise InvalidCursor("Variant {} not found.".format(variant_id))
+        return cls(key, variant_id, fields, reverse)
+
+    def encode(self):
+        """Return an url-safe string representation of the cursor."""
+        raw = json.dumps({'f': self.fields, 'r': self.reverse, 'k': self.key, 'id': self.variant_id},
+                         default=float)  # Decimal frequencies
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode(cls, s):
+        """Build a Cursor back from a string returned by `encode`."""
+        try:
+            raw = json.loads(base64.urlsafe_b64decode(s.encode('ascii')).decode('utf-8'))
+            return cls(raw['k'], raw['id'], raw['f'], raw['r'])
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            raise InvalidCursor("Invalid pagination cursor: '{}'.".format(s))
+
+    def check(self, fields, reverse):
+        """Raise an InvalidCursor if the cursor was made for another ordering than this one."""
+        if self.fields != list(fields) or self.reverse != bool(reverse):
+            raise InvalidCursor("The pagination cursor was made for another ordering "
+                             "({}), restart from the first page.".format(','.join(self.fields)))
+
+    def condition(self):
+        """Return a Q object selecting the variants that come after this one in its ordering,
+        so that the db can seek the next page using its indexes.
+        As in `filters.sort`, None is lower than anything; ties are broken by variant_id."""
+        if self.reverse:
+            q = Q(variant_id__lt=self.variant_id)
+        else:
+            q = Q(variant_id__gt=self.variant_id)
+        # Lexicographic order: beyond on the first field, or equal on it and beyond on the next ones
+        for f, v in reversed(list(zip(self.fields, self.key))):
+            if v is None:
+                equal = Q(**{f+'__isnull': True})
+            else:
+                equal = Q(**{f: v})
+            q = self._beyond(f, v) | (equal & q)
+        return q
+
+    def _beyond(self, field, value):
+        """Q object for the values of *field* that are strictly after *value* in the ordering."""
+        if not self.reverse:
+            if value is None:
+                return Q(**{field+'__isnull': False})
+            return Q(**{field+'__gt': value})
+        else:
+            if value is None:
+                return Q(**{'variant_id__lt': 0})  # always false: None is last
+            return Q(**{field+'__lt': value}) | Q(**{field+'__isnull': True})
+
+    def __str__(self):
+        return "<Cursor {} {} after {}>".format(self.fields, self.reverse, self.variant_id)
@@ -5,7 +5,11 @@ Build the Filter with a Request, then apply() it to a QuerySet.
 from django.db.models import Q
 from varapp.filters.filters import VariantFilter
 from varapp.annotation.location_service import LocationService
+from varapp.annotation.location_index import location_index
+from varapp.common import masking
 from varapp.constants.filters import *
+from varapp.stats.stats_service import stats_service
+import numpy as np
 import operator
 from functools import reduce
 
@@ -19,6 +23,18 @@ DJANGO_OP = {
 }
 
 
+def discrete_mask(db, field_name, accept, N):
+    """Return the union of the cached stats masks of *field_name*,
+    for all the values *v* it takes such that `accept(v)` is True.
+    :param N: the number of variants in *db*.
+    """
+    mask = np.zeros((N+7)//8, dtype=np.uint8)
+    for v, m in stats_service(db).masks_matrix().masks(field_name):
+        if accept(v):
+            mask = masking.binary_or(mask, m)
+    return mask
+
+
 class VariantIDFilter(VariantFilter):
     """Return variants given a (comma-separated string) list of their ids."""
     field_name = 'variant_id'
@@ -53,6 +69,12 @@ class BinaryFilter(VariantFilter):
     def django_condition(self):
         return Q(**{self.field_name: self.val})
 
+    def mask(self, N, db=None):
+        if self.field_name in DISCRETE_FILTER_NAMES:
+            accept = lambda v: v is not None and bool(v) == self.val
+            return discrete_mask(db or self.db, self.field_name, accept, N)
+        return super().mask(N, db)
+
 
 class EnumFilter(VariantFilter):
     """Filters taking values in a finite list, possibly several of them.
@@ -93,11 +115,22 @@ class EnumFilter(VariantFilter):
             q = reduce(lambda a,b: a|b, q_list)
             return q
 
+    def mask(self, N, db=None):
+        if self.field_name in DISCRETE_FILTER_NAMES:
+            if self.sensitive:
+                accept = lambda v: v in self.val
+            else:
+                accept = lambda v: (None if v is None else str(v).casefold()) in self.val
+            return discrete_mask(db or self.db, self.field_name, accept, N)
+        return super().mask(N, db)
+
 
 class LocationFilter(VariantFilter):
-    """Filter based on genomic location: `chromosome:start-end`."""
+    """Filter based on genomic location: `chromosome:start-end`, or a list of them/gene names.
+    In SQL, it is limited to 300 locations, but not when evaluated as a mask."""
     field_name = 'location'
     filter_class = FILTER_CLASS_LOCATION
+    use_mask = True
 
     def parse_arg(self, arg):
         """Return a list of `GenomicRange`s"""
@@ -119,6 +152,9 @@ class LocationFilter(VariantFilter):
         q = reduce(lambda a,b: a|b, q_list)
         return q
 
+    def mask(self, N, db=None):
+        return location_index(db or self.db).find(self.val, N)
+
     def sql_condition(self):
         pass
 
@@ -246,6 +282,10 @@ class GeneFilter(EnumFilter):
     """Return variants located inside a given gene (given by its name/symbol)."""
     field_name = 'gene_symbol'
     filter_class = FILTER_CLASS_LOCATION
+    use_mask = True
+
+    def mask(self, N, db=None):
+        return location_index(db or self.db).find_genes(self.val, N)
 
 class TranscriptFilter(EnumFilter):
     """Return variants located inside a given transcript (given by Ensembl ID)."""
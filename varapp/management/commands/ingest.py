@@ -0,0 +1,54 @@
+"""
+Precompute all the derived structures of Gemini dbs offline, into their artifact bundles
+(see varapp.common.artifacts), so that serving a new db or a new version of it
+does not build anything at request time. Usage::
+
+    python3 manage.py ingest [dbname|path ...] [--workers 4] [--force]
+
+Without db names, all active dbs are ingested. A path to a db file is hashed and ingested
+as that version, before it is released in GEMINI_DB_PATH: it is then served as soon as it is found.
+If it replaces an active db of the same file name, the bundle of that one is reused for what did not change.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from varapp.common.artifacts import build_bundle, build_file_bundle
+from varapp.common.cache.single_flight import BUILD_LOCK_TIMEOUT
+from varapp.models.users import VariantsDb
+from os.path import basename
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = "Build the artifact bundles of Gemini dbs: genotypes, stats, gene summary, sidecar index db and versions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dbnames', nargs='*',
+                            help="Names of active dbs, or paths to db files. Default: all active dbs.")
+        parser.add_argument('--workers', type=int, default=4, help="Number of structures built in parallel.")
+        parser.add_argument('--force', action='store_true', help="Rebuild bundles that already exist.")
+
+    def handle(self, *args, **options):
+        dbnames = options['dbnames'] or list(VariantsDb.objects.filter(is_active=1).values_list('name', flat=True))
+        unknown = [db for db in dbnames if db not in settings.DATABASES and not os.path.isfile(db)]
+        if unknown:
+            raise CommandError("Unknown or inactive db(s): {}".format(', '.join(unknown)))
+        # Nobody is waiting for a response: wait as long as another process is building the same structures
+        kwargs = dict(workers=options['workers'], force=options['force'], progress=self.progress,
+                      wait=BUILD_LOCK_TIMEOUT)
+        for k, db in enumerate(dbnames, 1):
+            self.stdout.write("[{}/{}] Ingesting db '{}'".format(k, len(dbnames), db))
+            start = time.time()
+            if db in settings.DATABASES:
+                path = build_bundle(db, **kwargs)
+            else:
+                parent_sha = VariantsDb.objects.filter(filename=basename(db), is_active=1) \
+                    .values_list('hash', flat=True).first()
+                path = build_file_bundle(db, parent_sha=parent_sha, **kwargs)
+            if path is None:
+                raise CommandError("Db '{}' has no known hash".format(db))
+            self.stdout.write(self.style.SUCCESS("Db '{}' ingested in {:.1f}s: {}".format(db, time.time() - start, path)))
+
+    def progress(self, dbname, step, done, total, seconds):
+        self.stdout.write("  {} ({}/{}) {:.1f}s".format(step, done, total, seconds))
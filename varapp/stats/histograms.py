@@ -31,6 +31,23 @@ class StatsContinuous:
     def __str__(self):
         return "<StatsContinuous (range:{}-{})>".format(self.min, self.max)
 
+class Histogram:
+    """Number of values between each consecutive pair of *breaks*
+    (the last bin includes its upper bound), and number of missing values."""
+    def __init__(self, breaks, counts, no_value=0):
+        self.breaks = list(breaks)
+        self.counts = list(counts)
+        self.no_value = no_value
+
+    def expose(self):
+        return {'breaks': self.breaks,
+                'counts': self.counts,
+                'no_value': self.no_value,
+                }
+
+    def __str__(self):
+        return "<Histogram ({} bins)>".format(len(self.counts))
+
 class StatsFrequency:
     """Frequency values are always between 0 and 1, and we query
     values at fixed breaks such as [0, 0.01, 0.05]."""
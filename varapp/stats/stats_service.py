@@ -1,126 +1,395 @@
 """
 Cached stats service. Arrays are stored in Redis, but a local memory cache is used
 for faster access, as long as the current wsgi process exists.
-In Redis, arrays are packed and tostring, objects are pickled.
+In Redis, arrays are packed and stored as bytes (`tobytes`), objects are pickled.
+Redis keys are prefixed by 'stats:<db>:<hash>:<generation>:' (see `cache_namespace`).
 
 Cached objects:
 - enum_values: enumerates all possible discrete values that each enum filter can take
 - global_stats: a VariantStats object for the full dataset
+- query stats: a VariantStats object per filtered set of variants, whatever the sorting and pagination
 - masks: packed binary arrays (bitmasks).
   The unpacked array has 1 at the index of each variant_id passing the filter.
+  In local memory, they are all stacked in a single 2-D array per db (MasksMatrix).
+
+Only in local memory:
+- histograms: the numeric fields, each value replaced by the index of its bin (BinnedColumns),
+  so that histograms for any subset of variants need no extra query.
 """
 from django.db import connections
 from django.conf import settings
 from django.core.cache import caches
 from varapp.common import masking
+from varapp.common.cache.redis import batched_cache
+from varapp.common.cache.single_flight import build_lock
+from varapp.common.db_utils import get_db_hash, cache_namespace, bump_cache_generation, service_key
+from varapp.common.sidecar import index_db
+from varapp.common.artifacts import load_bundle
 from varapp.common.utils import timer
 from varapp.constants.filters import *
 from varapp.data_models.variants import Variant
-from varapp.stats.histograms import DiscreteCounts, StatsContinuous, StatsFrequency
+from varapp.stats.histograms import DiscreteCounts, StatsContinuous, StatsFrequency, Histogram
 from varapp.stats.variant_stats import VariantStats
-from varapp.constants.common import WEEK, MONTH
+from varapp.constants.common import DAY, WEEK
 from collections import defaultdict
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import sys, logging
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
 
 
-STATS_CACHE_TIMEOUT = MONTH
+STATS_CACHE_TIMEOUT = WEEK  # refreshed when used, see BatchedRedisCache
+QUERY_STATS_TIMEOUT = DAY
+MASKS_WORKERS = 4  # number of threads building the filter masks
+HISTOGRAM_FIELDS = CONTINUOUS_FILTER_NAMES + FREQUENCY_FILTER_NAMES
+HISTOGRAM_BINS = 20  # number of quantile bins for continuous fields
 CACHE = True
 DEBUG = False and settings.DEBUG
 
 
+def column_masks(db, filter_name, N):
+    """Return a dict `{value: packed mask}` for all the values taken by *filter_name* in *db*,
+       where the unpacked mask has 1 at index variant_id-1 of each variant with that value.
+       Works for any discrete field, given its name in the Variant model."""
+    cursor = connections[index_db(db)].cursor()
+    cursor.execute("SELECT variant_id,{} FROM variants".format(TRANSLATION.get(filter_name, filter_name)))
+    rows = cursor.fetchall()
+    if not rows:
+        return {}
+    ids, values = zip(*rows)
+    uniques, codes = masking.factorize(values)
+    masks = masking.value_masks(ids, codes, len(uniques), N)
+    return dict(zip(uniques, masks))
+
+
+class MasksMatrix:
+    """All the discrete filter masks of a db, as the rows of a single packed 2-D array,
+    so that the counts for all values are computed at once."""
+    def __init__(self, masks):
+        """:param masks: {filter_name: {value: packed mask}}"""
+        self.index = {}  # {filter_name: [(value, row)]}
+        rows = []
+        for f in DISCRETE_FILTER_NAMES:
+            self.index[f] = []
+            for val, mask in masks.get(f, {}).items():
+                self.index[f].append((val, len(rows)))
+                rows.append(mask)
+        self.matrix = np.vstack(rows) if rows else np.zeros((0,0), dtype=np.uint8)
+        self.matrix.flags.writeable = False  # make it immutable
+
+    @classmethod
+    def from_arrays(cls, matrix, index):
+        """Return the MasksMatrix of these *matrix* rows and *index* `{filter_name: [(value, row)]}`,
+        as read from an artifact bundle. *matrix* is not copied."""
+        self = cls.__new__(cls)
+        self.index = index
+        self.matrix = matrix
+        return self
+
+    def to_dict(self):
+        """Return the masks as `{filter_name: {value: packed mask}}`. Rows are not copied."""
+        return {f: dict(self.masks(f)) for f in self.index}
+
+    @property
+    def width(self):
+        """Number of bytes of each packed mask."""
+        return self.matrix.shape[1]
+
+    def masks(self, filter_name):
+        """Iterate over the (value, packed mask) pairs of that filter."""
+        for val, row in self.index[filter_name]:
+            yield val, self.matrix[row]
+
+    def counts(self, variants_mask):
+        """Return `{filter_name: {value: count}}`, the number of variants of the packed
+        *variants_mask* that also pass each of the masks."""
+        c = masking.popcount_rows(self.matrix, variants_mask)
+        return {f: {val: int(c[row]) for val,row in rows} for f,rows in self.index.items()}
+
+
+class BinnedColumns:
+    """The numeric columns *fields* of db *db*, as a single 2-D array of bin indices,
+    so that the histograms of all fields for a subset of variants are computed at once.
+    Breaks are the quantiles of all values for continuous fields,
+    and the fixed `StatsFrequency` breaks for frequencies.
+    Row k has the bin index of field k at index variant_id-1, and the number of bins
+    (one past the last bin) for missing values."""
+    def __init__(self, db, N, fields=HISTOGRAM_FIELDS, nbins=HISTOGRAM_BINS):
+        self.fields = fields
+        self.breaks = []  # one array of breaks per field
+        self.stride = nbins + 2  # at most nbins bins, plus one for missing values
+        self.codes = np.zeros((len(fields), N), dtype=np.uint8)
+        cursor = connections[index_db(db)].cursor()
+        cursor.execute("SELECT variant_id,{} FROM variants".format(
+            ','.join(Variant._meta.get_field(f).column for f in fields)))
+        rows = [r for r in cursor.fetchall() if r[0] <= N]
+        idx = np.fromiter((r[0]-1 for r in rows), dtype=np.int64, count=len(rows))
+        for k,f in enumerate(fields):
+            values = np.array([r[k+1] for r in rows], dtype=np.float64)  # None -> nan
+            breaks = self._breaks(f, values, nbins)
+            self.breaks.append(breaks)
+            self.codes[k, idx] = self.digitize(values, breaks)
+        self.codes.flags.writeable = False  # make it immutable
+
+    @classmethod
+    def from_arrays(cls, fields, breaks, stride, codes):
+        """Return the BinnedColumns with these attributes, as read from an artifact bundle.
+        *codes* is not copied."""
+        self = cls.__new__(cls)
+        self.fields = fields
+        self.breaks = breaks
+        self.stride = stride
+        self.codes = codes
+        return self
+
+    @staticmethod
+    def _breaks(filter_name, values, nbins):
+        if filter_name in FREQUENCY_FILTER_NAMES:
+            return np.array(StatsFrequency().breaks, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return np.zeros(1)
+        breaks = np.unique(np.percentile(values, np.linspace(0, 100, nbins+1)))
+        if len(breaks) == 1:  # a single value: one bin
+            breaks = np.repeat(breaks, 2)
+        return breaks
+
+    @staticmethod
+    def digitize(values, breaks):
+        """Return the bin index of each of *values*. Bins are left-closed, except the last one
+        that also includes its upper bound. NaNs and values outside of the breaks
+        (such as Gemini's -1 for unknown frequencies) get index `len(breaks)-1`, the number of bins."""
+        nb = len(breaks) - 1
+        codes = np.minimum(np.searchsorted(breaks, values, side='right') - 1, max(nb-1, 0))
+        outside = np.isnan(values) | (values < breaks[0]) | (values > breaks[-1])
+        codes[outside] = nb
+        return codes
+
+    def histograms(self, variants_mask, N):
+        """Return `{filter_name: Histogram}` for the variants of the packed *variants_mask*,
+        in a single pass over the selected columns."""
+        selected = masking.to_indices(masking.unpack(variants_mask, N))
+        offsets = np.arange(len(self.fields), dtype=np.int64)[:,None] * self.stride
+        counts = np.bincount((self.codes[:, selected] + offsets).ravel(),
+                             minlength=len(self.fields) * self.stride).reshape(len(self.fields), -1)
+        hists = {}
+        for k,f in enumerate(self.fields):
+            breaks = self.breaks[k]
+            nb = len(breaks) - 1
+            hists[f] = Histogram(breaks.tolist(), counts[k,:nb].tolist(), int(counts[k,nb]))
+        return hists
+
+
 class GlobalStatsService:
-    """Interface to a cached stats service for all variants of database *db*."""
-    def __init__(self, db, new=False):
+    """Interface to a cached stats service for all variants of database *db*.
+    :param masks: the MasksMatrix of *db*, if already computed (e.g. while building its artifact bundle).
+        It is then kept by this service only, instead of in the local cache of *db*.
+    """
+    def __init__(self, db, new=False, masks=None):
         self.db = db
+        self.hash = get_db_hash(db)  # the version of the db it was built for
+        self.masks_key = service_key(db)
         self.cache = caches['redis']
-        #self.service_key = 'services:stats:{}'.format(db)
-        self.global_stats_key = 'stats:{}:global'.format(db)
-        self.enum_values_key = 'stats:{}:enum_values'.format(db)
-        self.mask_key_prefix = 'stats:{}:mask:'.format(db)
+        self.rcache = batched_cache('redis')
+        if new or not CACHE or DEBUG:
+            bump_cache_generation(db)
+            caches['stats_masks'].delete(self.masks_key)
+        self._init_keys(cache_namespace(db))
         self._initqs = Variant.objects.using(db)
         self._N = self._initqs.count()
         self._masks_ready = False
-        if new or not CACHE or DEBUG:
-            #self.cache.delete(self.service_key)
-            self.cache.delete_pattern("stats:{}:*".format(db))
+        self._binned = None  # BinnedColumns, built on first use
+        self._global_stats = None  # only kept here if read from the artifact bundle
+        self._masks = masks
+        self._bundle = load_bundle(db) if CACHE and masks is None else None  # see `manage.py ingest`
+        self.masks_cache = caches['stats_masks']  # local process memory
         self.init()
 
+    def _init_keys(self, namespace):
+        self.namespace = namespace
+        self.global_stats_key = 'stats:{}:global'.format(namespace)
+        self.enum_values_key = 'stats:{}:enum_values'.format(namespace)
+        self.mask_key_prefix = 'stats:{}:mask:'.format(namespace)
+        self.query_stats_key_prefix = 'stats:{}:query:'.format(namespace)
+
     def init(self):
-        """Check all related cache keys, and if one is not found, recreate the object."""
-        if not self._check_masks_ready() or not CACHE:  # generate masks and enum_values
-            logging.info("[cache] unset: init filter masks for db '{}'".format(self.db))
-            self._init_discrete_filter_masks()
+        """Check all related cache keys, and if one is not found, recreate the object.
+        If the db has an artifact bundle, read everything from there instead."""
+        if self._bundle is not None:
+            logging.info("[cache] Load stats of db '{}' from its artifact bundle".format(self.db))
+            self._load_bundle_masks()
+            self._global_stats = self._bundle.load('global_stats')
+            fields, breaks, stride = self._bundle.load('binned_breaks')
+            self._binned = BinnedColumns.from_arrays(fields, breaks, stride, self._bundle.load('binned_codes'))
+            return self
+        if self._masks is not None or (self.masks_cache.get(self.masks_key) is not None and CACHE):
+            self._masks_ready = True
+        elif not self._check_masks_ready() or not CACHE:  # generate masks and enum_values
+            self._build_masks()
         if (not self.global_stats_key in self.cache) or not CACHE:  # generate global_stats and impacts
-            logging.info("[cache] unset: init global stats for db '{}'".format(self.db))
-            global_stats = self._init_global_stats()
-            self.save_global_stats(global_stats)
+            self._build_global_stats()
         #self.cache.set(self.service_key, 1, timeout=STATS_CACHE_TIMEOUT)
         return self
 
-    def make_stats(self, variant_ids):
+    def make_stats(self, variant_ids=None, mask=None):
         """Get stats (dynamically) for a subset of *variant_ids*.
-           We only need counts for discrete filters.
+           Returns counts for discrete filters, and histograms for continuous and frequency filters.
            This is what is accessed to update 'local' stats when a new variants query is made
+        :param mask: instead of *variant_ids*, the packed binary array of the variants
+            (such as `FilterResult.mask`), possibly shorter than the number of variants.
         """
-        if not self._masks_ready:  # shortcut
-            if not self._check_masks_ready():
-                self._init_discrete_filter_masks()
+        masks = self.masks_matrix()
         # Create the mask for the given list of ids
-        variants_mask = masking.pack(masking.to_binary_array(variant_ids, self._N))
-        discrete_counts = {}
-        # Compare to the cached filter masks
-        for f in DISCRETE_FILTER_NAMES:
-            counts = {}
-            for val in self.get_enum_values()[f]:
-                mask = self.get_mask(f, val)
-                assert len(mask) == len(variants_mask), "{} != {}".format(len(mask), len(variants_mask))
-                common = masking.unpack(masking.binary_and(variants_mask, mask), self._N)
-                counts[val] = np.count_nonzero(common)
-            discrete_counts[f] = DiscreteCounts(counts)
-        return VariantStats(discrete_counts, len(variant_ids))
+        if mask is None:
+            variants_mask = masking.pack(masking.to_binary_array(variant_ids, self._N))
+            total_count = len(variant_ids)
+        else:
+            variants_mask = np.zeros(masks.width, dtype=np.uint8)
+            n = min(len(mask), masks.width)
+            variants_mask[:n] = mask[:n]
+            total_count = masking.popcount(variants_mask)
+        assert len(variants_mask) == masks.width, "{} != {}".format(len(variants_mask), masks.width)
+        # Compare to the cached filter masks, all at once
+        counts = masks.counts(variants_mask)
+        stats = {f: DiscreteCounts(counts[f]) for f in DISCRETE_FILTER_NAMES}
+        stats.update(self.binned_columns().histograms(variants_mask, self._N))
+        return VariantStats(stats, total_count)
+
+    def binned_columns(self):
+        """Return the BinnedColumns of this db, reading the numeric columns on first use."""
+        if self._binned is None:
+            logging.info("[cache] unset: init histogram bins for db '{}'".format(self.db))
+            self._binned = BinnedColumns(self.db, self._N)
+        return self._binned
+
+    def query_stats(self, query_key, compute):
+        """Return the VariantStats of the filtered set identified by *query_key*, from cache
+        if the same set was already requested, otherwise calling *compute()* and caching its result.
+        :param query_key: identifies the filters and samples selection, but not the sorting or pagination.
+        :param compute: a function with no argument returning a VariantStats.
+        """
+        key = self.key_query_stats(query_key)
+        stats = self.cache.get(key)
+        if stats is None:
+            stats = compute()
+            self.cache.set(key, stats, timeout=QUERY_STATS_TIMEOUT)
+        return stats
+
+    def masks_matrix(self):
+        """Return the MasksMatrix of this db from local memory,
+        loading it from Redis - or generating the masks - if necessary."""
+        if self._masks is not None:
+            return self._masks
+        masks = self.masks_cache.get(self.masks_key)
+        if masks is None:
+            if self._bundle is not None:
+                masks = self._load_bundle_masks()
+            elif self._check_masks_ready():
+                masks = self._load_masks_matrix()
+            if masks is None:
+                masks = self._build_masks()
+        return masks
 
     ## Cache transactions
 
     def key_mask(self, filter_name, value):
         """Return the cache key for that filter name and value,
-        of the form 'stats:<db>:mask:<filter_name>:<enum_value>'."""
+        of the form 'stats:<namespace>:mask:<filter_name>:<enum_value>'."""
         return self.mask_key_prefix + '{}:{}'.format(filter_name, value)
 
+    def key_query_stats(self, query_key):
+        """Return the cache key for the stats of a filtered set,
+        of the form 'stats:<namespace>:query:<query_key>'."""
+        return self.query_stats_key_prefix + query_key
+
     def save_mask(self, mask, filter_name, value):
         """Cache the enum mask for that filter name and value"""
         key = self.key_mask(filter_name, value)
-        self.cache.set(key, mask.tostring(), timeout=STATS_CACHE_TIMEOUT)
+        self.rcache.set(key, mask.tobytes(), timeout=STATS_CACHE_TIMEOUT)
+
+    def save_masks(self, masks):
+        """Cache all the enum masks `{filter_name: {value: mask}}` at once"""
+        self.rcache.set_many({self.key_mask(f, val): mask.tobytes() for f, vals in masks.items()
+                              for val, mask in vals.items()}, timeout=STATS_CACHE_TIMEOUT)
 
     def get_mask(self, filter_name, value):
         """Retreive from cache the mask for that filter name and value"""
         key = self.key_mask(filter_name, value)
-        mask = np.fromstring(self.cache.get(key), dtype=np.uint8)
-        self.cache.expire(key, STATS_CACHE_TIMEOUT)
-        return mask
+        return np.frombuffer(self.rcache.get(key, STATS_CACHE_TIMEOUT), dtype=np.uint8)
+
+    def _load_masks_matrix(self):
+        """Read all the masks from Redis at once, and keep them in local memory. Return the MasksMatrix,
+        or None if some of them expired since they were found ready: then they must be built again."""
+        enum_values = self.get_enum_values()
+        if enum_values is None:
+            self._masks_ready = False
+            return None
+        keys = {self.key_mask(f, val): (f, val) for f, vals in enum_values.items() for val in vals}
+        found = self.rcache.get_many(keys, timeout=STATS_CACHE_TIMEOUT)
+        if any(found.get(key) is None for key in keys):
+            logging.info("[cache] Some filter masks of db '{}' expired".format(self.db))
+            self._masks_ready = False
+            return None
+        masks = defaultdict(dict)
+        for key, (f, val) in keys.items():
+            masks[f][val] = np.frombuffer(found[key], dtype=np.uint8)
+        matrix = MasksMatrix(masks)
+        self.masks_cache.set(self.masks_key, matrix)
+        return matrix
+
+    def _load_bundle_masks(self):
+        """Read all the masks from the artifact bundle, and keep them in local memory. Return the MasksMatrix."""
+        matrix = MasksMatrix.from_arrays(self._bundle.load('masks_matrix'), self._bundle.load('masks_index'))
+        self.masks_cache.set(self.masks_key, matrix)
+        self._masks_ready = True
+        return matrix
 
     def save_enum_values(self, v):
         """Cache the enum_values dict ({filter_name: [possible_values]})"""
-        self.cache.set(self.enum_values_key, v, timeout=STATS_CACHE_TIMEOUT)
+        self.rcache.set(self.enum_values_key, v, timeout=STATS_CACHE_TIMEOUT)
 
     def get_enum_values(self):
         """Retreive from cache the enum_values dict"""
-        self.cache.expire(self.enum_values_key, STATS_CACHE_TIMEOUT)
-        return self.cache.get(self.enum_values_key)
+        return self.rcache.get(self.enum_values_key, STATS_CACHE_TIMEOUT)
 
     def save_global_stats(self, g):
         """Cache the global_stats object"""
-        self.cache.set(self.global_stats_key, g, timeout=STATS_CACHE_TIMEOUT)
+        self.rcache.set(self.global_stats_key, g, timeout=STATS_CACHE_TIMEOUT)
 
     def get_global_stats(self):
-        """Retreive from cache the global_stats:VariantStats object"""
-        self.cache.expire(self.enum_values_key, STATS_CACHE_TIMEOUT)
-        return self.cache.get(self.global_stats_key)
+        """Retreive from cache the global_stats:VariantStats object.
+        Since the service lives as long as the process, regenerate it if it expired meanwhile."""
+        if self._global_stats is not None:
+            return self._global_stats
+        global_stats = self.rcache.get(self.global_stats_key, STATS_CACHE_TIMEOUT)
+        if global_stats is None:
+            global_stats = self._build_global_stats()
+        return global_stats
 
     ## Initialization - private methods
 
+    def _build_masks(self):
+        """Generate and cache the filter masks, unless another process did it
+        while this one was waiting for the build lock. Return the MasksMatrix."""
+        with build_lock(self.mask_key_prefix + 'build'):
+            if CACHE and self._check_masks_ready():
+                matrix = self._load_masks_matrix()
+                if matrix is not None:
+                    return matrix
+            logging.info("[cache] unset: init filter masks for db '{}'".format(self.db))
+            return self._init_discrete_filter_masks()
+
+    def _build_global_stats(self):
+        """Generate and cache the global stats, unless another process did it
+        while this one was waiting for the build lock. Return the VariantStats."""
+        with build_lock(self.global_stats_key + ':build'):
+            global_stats = self.cache.get(self.global_stats_key) if CACHE else None
+            if global_stats is None:
+                logging.info("[cache] unset: init global stats for db '{}'".format(self.db))
+                global_stats = self._init_global_stats()
+                self.save_global_stats(global_stats)
+            return global_stats
+
     @timer
     def _init_global_stats(self):
         """Get stats for the entire database, and store the result for reuse.
@@ -137,7 +406,7 @@ class GlobalStatsService:
         stats_continuous = {}
         translated = [TRANSLATION.get(f,f) for f in CONTINUOUS_FILTER_NAMES]
         minmax_query = ','.join(['MIN({}),MAX({})'.format(f,f) for f in translated])
-        cursor = connections[self.db].cursor()
+        cursor = connections[index_db(self.db)].cursor()
         cursor.execute('SELECT {} FROM variants'.format(minmax_query))
         minmax = cursor.fetchone()  # [min, max, min, max, ...]
         minmax = [{'min':x[0], 'max':x[1]} for x in zip(minmax[::2], minmax[1::2])]
@@ -153,26 +422,21 @@ class GlobalStatsService:
            by counting the nonzero entries in each binary mask.
            Called only once at init."""
         discrete_counts = {}
+        masks = self.masks_matrix()
+        all_counts = masks.counts(np.full(masks.width, 0xFF, dtype=np.uint8))
         for f in DISCRETE_FILTER_NAMES:
-            counts = {}
-            for val in self.get_enum_values()[f]:
-                mask = self.get_mask(f, val)
-                common = masking.unpack(mask, self._N)
-                counts[val] = np.count_nonzero(common)
+            counts = all_counts[f]
             if f == 'impact':
                 counts['pairs'] = self._init_impacts()
             discrete_counts[f] = DiscreteCounts(counts)
         return discrete_counts
 
     def _check_masks_ready(self):
-        """Check that masks are in the cache for all enum filters"""
-        if self.enum_values_key in self.cache:
-            enum_values = self.get_enum_values()
-            ready = True
-            for fname, vals in enum_values.items():
-                for val in vals:
-                    if not self.key_mask(fname, val) in self.cache:
-                        ready = False
+        """Check that masks are in the cache for all enum filters, in a single round trip"""
+        enum_values = self.get_enum_values()
+        if enum_values is not None:
+            keys = [self.key_mask(fname, val) for fname, vals in enum_values.items() for val in vals]
+            ready = all(self.rcache.exists_many(keys).values())
         else:
             ready = False
         self._masks_ready = ready  # provide a shortcut
@@ -180,34 +444,34 @@ class GlobalStatsService:
 
     @timer
     def _init_discrete_filter_masks(self):
-        """Create an array of passing ids for every discrete valued filter.
-           :rtype: dict `{filter_name: {value: [ids]}}`"""
-        translated = tuple(TRANSLATION.get(f,f) for f in ['variant_id']+DISCRETE_FILTER_NAMES)
-        cursor = connections[self.db].cursor()
-        cursor.execute("SELECT {} FROM variants".format(','.join(translated)))
-        # Create a variants mask per couple (filter, value), with 1 at indices corresponding to passing variants
-        variant_masks = {t:defaultdict(partial(np.zeros, self._N, dtype=np.bool_)) for t in DISCRETE_FILTER_NAMES}
-        enum_values = {t:set() for t in DISCRETE_FILTER_NAMES}
-        irange = range(1,len(translated))
-        for row in cursor:
-            vid = row[0]  # variant id
-            for i in irange:
-                val = row[i]
-                fname = DISCRETE_FILTER_NAMES[i-1]
-                variant_masks[fname][val][vid-1] = 1
-                enum_values[fname].add(val)
-        # Pack and cache the result
-        for fname in DISCRETE_FILTER_NAMES:
-            for val, mask in variant_masks[fname].items():
-                mask = masking.pack(mask)
-                self.save_mask(mask, fname, val)
+        """Create a mask of passing ids for every value of every discrete valued filter,
+           and cache them. Filters are processed in parallel threads. Return the MasksMatrix."""
+        fields = DISCRETE_FILTER_NAMES
+        with ThreadPoolExecutor(max_workers=min(MASKS_WORKERS, len(fields))) as executor:
+            packed_masks = dict(zip(fields, executor.map(self._column_masks_in_thread, fields)))
+        # Cache the result
+        enum_values = {fname: set(packed_masks[fname]) for fname in fields}
+        self.save_masks(packed_masks)
         self.save_enum_values(enum_values)
+        matrix = MasksMatrix(packed_masks)
+        self.masks_cache.set(self.masks_key, matrix)
         self._masks_ready = True
+        return matrix
+
+    def _column_masks(self, filter_name):
+        return column_masks(self.db, filter_name, self._N)
+
+    def _column_masks_in_thread(self, filter_name):
+        """Same as `_column_masks`, closing the connection that Django opened for the current thread."""
+        try:
+            return self._column_masks(filter_name)
+        finally:
+            connections[index_db(self.db)].close()
 
     def _init_impacts(self):
         """Return a dict {impact_severity: [impact_terms]}.
            It is added to global stats, so no need to cache it separately."""
-        cursor = connections[self.db].cursor()
+        cursor = connections[index_db(self.db)].cursor()
         cursor.execute("""SELECT impact_severity, group_concat(distinct impact) FROM variants
                           WHERE impact IS NOT NULL GROUP BY impact_severity;""")
         impacts = {row[0]: row[1].split(',') for row in cursor}
@@ -215,6 +479,18 @@ class GlobalStatsService:
 
 
 def stats_service(db):
-    """Creates a new GlobalStatsService, if not already found in local process cache."""
-    return GlobalStatsService(db)
+    """Creates a new GlobalStatsService, if not already found in local process cache,
+    or if the db or its cache generation changed since it was created (see `cache_namespace`)."""
+    stats_cache = caches['stats_service']
+    key = service_key(db)
+    service = stats_cache.get(key)
+    if service is None or service.namespace != cache_namespace(db):
+        if service is not None:
+            logging.info("[cache] db '{}' changed: reset stats cache".format(db))
+            caches['stats_masks'].delete(key)
+        else:
+            logging.info("[cache] Init stats cache '{}'".format(db))
+        service = GlobalStatsService(db)
+        stats_cache.set(key, service)
+    return service
 
@@ -6,6 +6,7 @@ from varapp.views.auth_views import *
 
 urlpatterns = [
     url(r'^$', index),
+    url(r'^ready$', ready),
 
     # users_db
     url(r'^authenticate$', authenticate),
@@ -23,6 +24,7 @@ urlpatterns = [
 
     # variants_db
     url(r'^(?P<db>.*)/count$', count, name='count'),
+    url(r'^(?P<db>.*)/status$', db_status, name='status'),
     url(r'^(?P<db>.*)/samples$', p_samples, name='samples'),
     url(r'^(?P<db>.*)/variants$', p_variants, name='variants'),
     url(r'^(?P<db>.*)/variants/export$', p_export_variants, name='export'),
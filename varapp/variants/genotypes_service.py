@@ -1,7 +1,8 @@
 """
 Cached genotypes service. Arrays are stored in Redis, but a local memory cache is used
 for faster access, as long as the current wsgi process exists.
-In Redis, arrays are packed and tostring, objects are pickled.
+In Redis, arrays are packed and stored as bytes (`tobytes`), objects are pickled.
+Redis keys are prefixed by 'gen:<db>:<hash>:<generation>:' (see `cache_namespace`).
 """
 
 from django.db import connections
@@ -17,9 +18,13 @@ import logging, sys
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
 
 from django.core.cache import caches
-from varapp.constants.common import WEEK, MONTH
+from varapp.common.cache.redis import batched_cache
+from varapp.common.cache.single_flight import build_lock
+from varapp.common.db_utils import cache_namespace, service_key
+from varapp.common.artifacts import load_bundle
+from varapp.constants.common import WEEK
 
-GENOTYPES_CACHE_TIMEOUT = MONTH
+GENOTYPES_CACHE_TIMEOUT = WEEK  # refreshed when used, see BatchedRedisCache
 
 
 gt_to_bit = {
@@ -42,6 +47,47 @@ def extract_genotypes(db, qs=None):
     gts_array = np.array([decode_int(x) for x in gts_queryset_iter], dtype=np.int8)
     return gts_array
 
+def genotype_bits(gt_types):
+    """From an array of gt_types decoded values, as returned by `extract_genotypes`,
+    build the (immutable) array of GENOTYPE_BIT_* masks."""
+    f = np.vectorize(variant_build_gt_type_bit, otypes=[np.uint8])  # apply to all array elements
+    bits = f(gt_types)
+    bits.flags.writeable = False  # make it immutable
+    return bits
+
+def build_chrX(db):
+    """Return the array of variant_ids belonging to chromosome X."""
+    chrX = np.asarray(list(
+        Variant.objects.using(db).filter(chrom='chrX').values_list('variant_id', flat=True)),
+        dtype=np.uint64)
+    chrX.flags.writeable = False  # make it immutable
+    return chrX
+
+def build_gene_batches(db):
+    """Return a dict `{gene_name: array of variant_ids}`"""
+    ids_by_gene = {}
+    query = "select variant_id,gene from variants where gene is NOT NULL order by gene"
+    cursor = connections[db].cursor()
+    cursor.execute(query)
+    batches = cursor.fetchall()
+    for gene,batch in itertools.groupby(batches, key=itemgetter(1)):
+        ids_by_gene[gene] = np.array([x[0] for x in batch], dtype=np.uint64)
+        ids_by_gene[gene].flags.writeable = False  # make it immutable
+    return ids_by_gene
+
+def pack_gene_batches(ids_by_gene):
+    """Return the batches `{gene_name: array of variant_ids}` as `(genes, ids, offsets)`:
+    the variant ids of all genes in a single array, those of genes[k] being ids[offsets[k]:offsets[k+1]]."""
+    genes = list(ids_by_gene)
+    sizes = [len(ids_by_gene[g]) for g in genes]
+    offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64)
+    ids = np.concatenate([ids_by_gene[g] for g in genes]) if genes else np.zeros(0, dtype=np.uint64)
+    return genes, ids.astype(np.uint64, copy=False), offsets
+
+def unpack_gene_batches(genes, ids, offsets):
+    """Inverse of `pack_gene_batches`. The batches are views of *ids*, not copies."""
+    return {g: ids[offsets[k]:offsets[k+1]] for k, g in enumerate(genes)}
+
 
 class GenotypesService:
     """Read genotypes from the database.
@@ -49,33 +95,65 @@ class GenotypesService:
     def __init__(self, db):
         self.db = db
         self._gt_types_bit = None
+        self._chrX = None          # local copies, read from Redis on first access
+        self._gene_batches = None
         self.N = Variant.objects.using(db).count()
         self.S = Samples.objects.using(db).count()
         self.cache = caches['redis']
-        self.chrX_key = "gen:{}:chrX".format(self.db)
-        self.gene_batches_key = "gen:{}:gene_batches".format(self.db)
-        self.genotypes_key = "gen:{}:genotypes".format(self.db)
+        self.rcache = batched_cache('redis')
+        self.namespace = cache_namespace(db)
+        self.chrX_key = "gen:{}:chrX".format(self.namespace)
+        self.gene_batches_key = "gen:{}:gene_batches".format(self.namespace)
+        self.genotypes_key = "gen:{}:genotypes".format(self.namespace)
         self._init()
 
     @timer
     def _init(self):
-        """Build the array _gt_types_bit containing all the genotypes."""
+        """Build the array _gt_types_bit containing all the genotypes, and whatever is missing in cache.
+        Only one process builds the cache of a db at a time; the others wait, then read the result.
+        If the artifact bundle of the db was built (see `manage.py ingest`), all is read from there instead."""
+        bundle = load_bundle(self.db)
+        if bundle is not None and 'genotypes' in bundle:
+            return self._init_from_bundle(bundle)
+        keys = [self.genotypes_key, self.gene_batches_key, self.chrX_key]
+        exists = self.rcache.exists_many(keys)
+        if not all(exists.values()):
+            with build_lock('gen:{}'.format(self.namespace)):
+                exists = self.rcache.exists_many(keys)  # maybe built by another process meanwhile
+                return self._init_from(exists)
+        return self._init_from(exists)
+
+    def _init_from_bundle(self, bundle):
+        logging.info("[cache] Load genotypes of db '{}' from its artifact bundle".format(self.db))
+        self._gt_types_bit = bundle.load('genotypes')  # read-only memory maps
+        self._chrX = bundle.load('chrX')
+        batches = unpack_gene_batches(bundle.load('gene_batches_genes'), bundle.load('gene_batches_ids'),
+                                      bundle.load('gene_batches_offsets'))
+        for ids in batches.values():
+            ids.flags.writeable = False  # make it immutable
+        self._gene_batches = batches
+        return self
+
+    def _init_from(self, exists):
+        """:param exists: `{key: bool}`, whether each cache key is already set."""
         if self._gt_types_bit is None:
             logging.info("[cache] unset: init genotypes for db '{}'".format(self.db))
-            self._init_genotypes()
-        if not self.gene_batches_key in self.cache:
+            self._init_genotypes(cached=exists[self.genotypes_key])
+        if not exists[self.gene_batches_key]:
             logging.info("[cache] unset: init gene batches for db '{}'".format(self.db))
             self._init_variant_batches_by_gene()
-        if not self.chrX_key in self.cache:
+        if not exists[self.chrX_key]:
             logging.info("[cache] unset: init chrX for db '{}'".format(self.db))
             self._init_chrX()
         return self
 
     def clear_cache(self):
         self._gt_types_bit = None
-        self.cache.delete(self.gene_batches_key)
-        self.cache.delete(self.chrX_key)
-        self.cache.delete(self.genotypes_key)
+        self._chrX = None
+        self._gene_batches = None
+        keys = [self.gene_batches_key, self.chrX_key, self.genotypes_key]
+        self.cache.delete_many(keys)
+        self.rcache.forget(keys)
 
     def reset(self):
         self.clear_cache()
@@ -86,13 +164,20 @@ class GenotypesService:
     @property
     def chrX(self):
         """Return the bitmask for chrX variants."""
-        self.cache.expire(self.chrX_key, GENOTYPES_CACHE_TIMEOUT)
-        return np.fromstring(self.cache.get(self.chrX_key), dtype=np.uint64)
+        if self._chrX is None:
+            chrX = np.frombuffer(self.rcache.get(self.chrX_key, GENOTYPES_CACHE_TIMEOUT), dtype=np.uint64)
+            chrX.flags.writeable = False  # make it immutable
+            self._chrX = chrX
+        return self._chrX
 
     @property
     def variant_ids_batches_by_gene(self):
-        self.cache.expire(self.gene_batches_key, GENOTYPES_CACHE_TIMEOUT)
-        return self.cache.get(self.gene_batches_key)
+        if self._gene_batches is None:
+            batches = self.rcache.get(self.gene_batches_key, GENOTYPES_CACHE_TIMEOUT)
+            for ids in batches.values():
+                ids.flags.writeable = False  # make it immutable
+            self._gene_batches = batches
+        return self._gene_batches
 
     @property
     def genotypes(self):
@@ -102,62 +187,56 @@ class GenotypesService:
 
     def _save_genotypes(self, genotypes):
         """Cache the genotypes binary array, for a week"""
-        self.cache.set(self.genotypes_key, genotypes.flatten().tostring(), timeout=GENOTYPES_CACHE_TIMEOUT)
+        self.rcache.set(self.genotypes_key, genotypes.flatten().tobytes(), timeout=GENOTYPES_CACHE_TIMEOUT)
 
     def _get_genotypes(self):
         """Get genotypes binary array from cache"""
-        gen_bits = self.cache.get(self.genotypes_key)
-        gen_bits = np.fromstring(gen_bits, dtype=np.uint8).reshape(self.N, self.S)
-        self.cache.expire(self.genotypes_key, GENOTYPES_CACHE_TIMEOUT)
+        gen_bits = self.rcache.get(self.genotypes_key, GENOTYPES_CACHE_TIMEOUT)
+        gen_bits = np.frombuffer(gen_bits, dtype=np.uint8).reshape(self.N, self.S)
+        gen_bits.flags.writeable = False  # make it immutable
         return gen_bits
 
     ## Initialization
 
     def _init_chrX(self):
         """Construct an array of variant_ids belonging to chromosome X."""
-        chrX = np.asarray(list(
-            Variant.objects.using(self.db).filter(chrom='chrX').values_list('variant_id', flat=True)),
-            dtype=np.uint64)
-        chrX.flags.writeable = False  # make it immutable
-        self.cache.set(self.chrX_key, chrX.tostring(), timeout=GENOTYPES_CACHE_TIMEOUT)
+        chrX = build_chrX(self.db)
+        self.rcache.set(self.chrX_key, chrX.tobytes(), timeout=GENOTYPES_CACHE_TIMEOUT)
 
     def _init_variant_batches_by_gene(self):
         """Construct a dict `{gene_name: set(variant_ids)}`"""
-        ids_by_gene = {}
-        query = "select variant_id,gene from variants where gene is NOT NULL order by gene"
-        cursor = connections[self.db].cursor()
-        cursor.execute(query)
-        batches = cursor.fetchall()
-        for gene,batch in itertools.groupby(batches, key=itemgetter(1)):
-            ids_by_gene[gene] = np.array([x[0] for x in batch], dtype=np.uint64)
-            ids_by_gene[gene].flags.writeable = False  # make it immutable
-        self.cache.set(self.gene_batches_key, ids_by_gene, timeout=GENOTYPES_CACHE_TIMEOUT)
-
-    def _init_genotypes(self):
+        ids_by_gene = build_gene_batches(self.db)
+        self.rcache.set(self.gene_batches_key, ids_by_gene, timeout=GENOTYPES_CACHE_TIMEOUT)
+
+    def _init_genotypes(self, cached=None):
         """Construct an array of genotype vectors, one per variant.
            If it is found in cache, use the cached version,
            otherwise recompute it and cache the result.
            Either way, store a copy in local process memory.
+        :param cached: whether the genotypes are known to be in cache, if already checked.
         """
-        if self.genotypes_key in self.cache:
+        if cached is None:
+            cached = self.genotypes_key in self.cache
+        if cached:
             # Read cache, store in local memory
             self._gt_types_bit = self._get_genotypes()
         else:
             # Regenerate, cache, and store in local memory
-            gt_types = extract_genotypes(db=self.db)
-            f = np.vectorize(variant_build_gt_type_bit, otypes=[np.uint8])  # apply to all array elements
-            self._gt_types_bit = f(gt_types)
-            self._gt_types_bit.flags.writeable = False  # make it immutable
+            self._gt_types_bit = genotype_bits(extract_genotypes(db=self.db))
             self._save_genotypes(self._gt_types_bit)
 
 
 def genotypes_service(db):
-    """Creates a new GenotypesService, if not already found in local process cache"""
+    """Creates a new GenotypesService, if not already found in local process cache,
+    or if the db or its cache generation changed since it was created (see `cache_namespace`)."""
     gen_cache = caches['genotypes_service']
-    if gen_cache.get(db) is None:
+    key = service_key(db)
+    service = gen_cache.get(key)
+    if service is None or service.namespace != cache_namespace(db):
         logging.info("[cache] Init genotypes cache '{}'".format(db))
-        gen_cache.set(db, GenotypesService(db))
-    return gen_cache.get(db)
+        service = GenotypesService(db)
+        gen_cache.set(key, service)
+    return service
 
 
 
@@ -0,0 +1,109 @@
+"""
+Cached sort service. For each field the variants can be sorted by, it stores the
+permutation of all variant ids in ascending order (None first, as in `filters.sort`,
+and ties broken by variant_id, as in `FiltersCollection.apply`).
+The first variants of any filtered set, in any order, are then found by walking
+the permutation until enough of them pass the filters.
+Permutations are built on first use, and kept in local process memory.
+"""
+
+from django.core.cache import caches
+from django.db import connections
+from varapp.common import masking
+from varapp.common.db_utils import cache_namespace, service_key
+from varapp.common.sidecar import index_db
+from varapp.data_models.variants import Variant, VARIANT_FIELDS
+import numpy as np
+import logging, sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+UNSORTABLE_FIELDS = {'gts_blob', 'gt_types_blob', 'source'}
+SORTABLE_FIELDS = [f for f in VARIANT_FIELDS if f not in UNSORTABLE_FIELDS]
+LOCATION_FIELDS = ['chrom', 'start']  # default ordering
+
+
+def ranks(values):
+    """Return the rank of each element of *values* in ascending order,
+    equal values having the same rank, and None being lower than anything (rank 0)."""
+    uniques, codes = masking.factorize(values)
+    r = codes + 1
+    if uniques and uniques[-1] is None:
+        r[codes == len(uniques)-1] = 0
+    return r
+
+
+class SortService:
+    """Sort permutations of the variants of database *db*."""
+    def __init__(self, db):
+        self.db = db
+        self.namespace = cache_namespace(db)  # the version and cache generation it was built for
+        self._permutations = {}  # {fields tuple: variant ids in ascending order}
+        self._positions = {}     # {fields tuple: position of each variant id in the above}
+
+    @staticmethod
+    def is_sortable(fields):
+        return all(f in SORTABLE_FIELDS for f in fields)
+
+    def permutation(self, fields, reverse=False):
+        """Return the array of all variant ids, sorted wrt. the list of *fields*.
+        The reverse order is a view on the ascending one, not a copy."""
+        key = tuple(fields)
+        if key not in self._permutations:
+            logging.info("[cache] unset: init sort permutation {} for db '{}'".format(key, self.db))
+            self._init_permutation(key)
+        perm = self._permutations[key]
+        return perm[::-1] if reverse else perm
+
+    def position(self, variant_id, fields, reverse=False):
+        """Return the index of *variant_id* in `permutation(fields, reverse)`.
+        Raise a ValueError if it is not a variant of the db."""
+        key = tuple(fields)
+        perm = self.permutation(fields)
+        if key not in self._positions:
+            pos = np.zeros(int(perm.max()) + 1 if len(perm) else 0, dtype=np.uint32)
+            pos[perm] = np.arange(len(perm), dtype=np.uint32)
+            pos.flags.writeable = False
+            self._positions[key] = pos
+        positions = self._positions[key]
+        if not 0 <= variant_id < len(positions) or perm[positions[variant_id]] != variant_id:
+            raise ValueError("Variant {} is not part of db '{}'.".format(variant_id, self.db))
+        p = int(positions[variant_id])
+        return len(perm) - 1 - p if reverse else p
+
+    def first(self, bin_ids, n, fields, reverse=False, offset=0, after_id=None, size=None):
+        """Return the first *n* variant ids set in the binary array *bin_ids*,
+        in the order given by *fields*, skipping the first *offset* ones
+        or starting right after *after_id* (found in constant time, see `position`).
+        :param size: if given, *bin_ids* is packed, of that (unpacked) length.
+        """
+        perm = self.permutation(fields, reverse)
+        if after_id is not None:
+            perm = perm[self.position(after_id, fields, reverse)+1:]
+            offset = 0
+        return masking.first_in_order(perm, bin_ids, offset+n, size=size)[offset:]
+
+    def _init_permutation(self, key):
+        """Read the columns *key* from the db and argsort them."""
+        columns = [Variant._meta.get_field(f).column for f in key]
+        cursor = connections[index_db(self.db)].cursor()
+        cursor.execute("SELECT variant_id,{} FROM variants".format(','.join(columns)))
+        rows = cursor.fetchall()
+        ids = np.fromiter((r[0] for r in rows), dtype=np.uint32, count=len(rows))
+        # np.lexsort uses the last key as the primary one
+        sort_keys = [ids] + [ranks([r[i+1] for r in rows]) for i in reversed(range(len(key)))]
+        perm = ids[np.lexsort(sort_keys)]
+        perm.flags.writeable = False  # make it immutable
+        self._permutations[key] = perm
+
+
+def sort_service(db):
+    """Creates a new SortService, if not already found in local process cache,
+    or if the db or its cache generation changed since it was created (see `cache_namespace`)."""
+    sort_cache = caches['sort_service']
+    key = service_key(db)
+    service = sort_cache.get(key)
+    if service is None or service.namespace != cache_namespace(db):
+        logging.info("[cache] Init sort cache '{}'".format(db))
+        service = SortService(db)
+        sort_cache.set(key, service)
+    return service
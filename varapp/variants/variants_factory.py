@@ -1,8 +1,9 @@
 from varapp.data_models.variants import *
 from varapp.constants.filters import ALL_VARIANT_FILTER_NAMES
+from varapp.common import masking
 from varapp.common.utils import timer
+from django.db import connections
 import numpy as np
-import itertools
 
 
 def variants_collection_factory(db, qs=None):
@@ -13,9 +14,28 @@ def variants_collection_factory(db, qs=None):
     return VariantsCollection(qs, cache_key=db, db=db)
 
 
+def ids_bin_array(qs, size, batch_size=50000):
+    """Return a binary array of length *size*, with 1 at the (1-based) ids of the variants in *qs*.
+    The ids are streamed from the db by batches, so that they are never all in memory at once
+    (Django would read them all at once from a sqlite db). Their order does not matter.
+    :param qs: a QuerySet of variants. Ids greater than *size* are ignored.
+    """
+    z = np.zeros(size, dtype=np.bool_)
+    sql, params = qs.values_list('variant_id', flat=True).query.sql_with_params()
+    cursor = connections[qs.db].cursor()
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        z[ids[ids <= size] - 1] = 1
+    return z
+
+
 #@timer
 def extract_variants_from_ids_bin_array(qs, bin_ids, ordered_qs_indices=None, limit=None, offset=0,
-    batch_size=500, sources=None):
+    batch_size=500, sources=None, after_id=None, size=None):
     """Given a set of variant_ids, return a list of fully annotated
        Variant objects (e.g. for exposition to frontend),
        in the same order as given in *ids*.
@@ -27,26 +47,41 @@ def extract_variants_from_ids_bin_array(qs, bin_ids, ordered_qs_indices=None, li
     :param batch_size: max number of variant ids that can be fetched in one sql query.
     :param sources: to annotate the compounds with a source attribute,
         provide a {variant_id: source} mapping.
+    :param after_id: (cursor pagination) start right after this variant id
+        in *ordered_qs_indices*, instead of skipping the first *offset* ones.
+        It is looked for in the whole list: for a sort permutation, rather use `SortService.first`.
+    :param size: if given, *bin_ids* is packed, of that (unpacked) length.
     """
-    B = batch_size
-    k = 0
-    variants = []
     if ordered_qs_indices is None:
         ordered_qs_indices = list(qs.values_list('variant_id', flat=True))
-    ordered_indices = filter(lambda x:bin_ids[x-1], ordered_qs_indices)
+    ordered_indices = np.asarray(ordered_qs_indices, dtype=np.int64)
+    if after_id is not None:
+        pos = np.flatnonzero(ordered_indices == after_id)
+        if len(pos) == 0 and len(ordered_indices) > 0:
+            raise ValueError("Variant {} of the pagination cursor is not part of the result.".format(after_id))
+        ordered_indices = ordered_indices[pos[0]+1:] if len(pos) else ordered_indices
+        offset = 0
     if limit is None:
-        limit = np.count_nonzero(bin_ids)
-    while k*B < limit:
-        R = min(B, limit-(k*B))  # how many remain to extract
-        ids_to_extract = itertools.islice(ordered_indices, offset, offset+R)
-        sub_qs = qs.filter(variant_id__in=ids_to_extract)
-        k += 1
+        limit = np.count_nonzero(bin_ids) if size is None else masking.popcount(bin_ids)
+    ids_to_extract = masking.first_in_order(ordered_indices, bin_ids, offset+limit, size=size)[offset:]
+    return fetch_variants(qs, ids_to_extract, batch_size, sources)
+
+def fetch_variants(qs, ids, batch_size=500, sources=None):
+    """Return the list of Variant objects of *qs* with these *ids*, in the order of *qs*.
+    :param batch_size: max number of variant ids that can be fetched in one sql query.
+    :param sources: to annotate the compounds with a source attribute,
+        provide a {variant_id: source} mapping.
+    """
+    B = batch_size
+    variants = []
+    for k in range(0, len(ids), B):
+        sub_qs = qs.filter(variant_id__in=ids[k:k+B].tolist())
         #variants = namedtuples(sub_qs)
         variants.extend(list(sub_qs))
-        if sources:
-            for i,v in enumerate(variants):
-                #variants[i] = set_source(v, sources[v.variant_id])
-                v.source = sources[v.variant_id]
+    if sources:
+        for v in variants:
+            #variants[i] = set_source(v, sources[v.variant_id])
+            v.source = sources[v.variant_id]
     return variants
 
 def set_source(v, value):
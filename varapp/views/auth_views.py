@@ -7,6 +7,11 @@ from django.conf import settings
 
 from varapp.data_models.users import VariantsDb, user_factory
 from varapp.common.manage_dbs import deactivate_if_not_found_on_disk, update_if_db_changed
+from varapp.common.db_utils import get_db_hash, set_db_hash
+from varapp.common.generations import generations
+from varapp.common.cache.resident import resident_dbs
+from varapp.common.db_watcher import db_watcher
+from varapp.common.warmup import record_usage
 from varapp.auth import auth
 from jsonview.decorators import json_view
 import logging
@@ -40,38 +45,62 @@ class protected:
         payload,msg = auth.verify_jwt(auth_header, secret)
         if payload is None:
             return HttpResponseForbidden(msg)
-        ## Check that the user exists
         username = payload['username']
         code = payload['code']
-        if not auth.check_user_exists(username, code):
-            return HttpResponseForbidden(
-                "No account was found with username '{}'.".format(payload['username'])
-            )
-        user = auth.find_user(username, code)
+        dbname = kwargs.get('db')
+        # Recently granted: skip the access checks
+        user_id = auth.get_authorization(username, code, dbname)
+        user = auth.find_user_by_id(user_id) if user_id is not None else None
+        authorized = user is not None
+        ## Check that the user exists
+        if not authorized:
+            if not auth.check_user_exists(username, code):
+                return HttpResponseForbidden(
+                    "No account was found with username '{}'.".format(payload['username'])
+                )
+            user = auth.find_user(username, code)
         # Check user role
         if user.role.rank > self.level:
             return HttpResponseForbidden("This action requires higher credentials")
         # Check db access
-        if kwargs.get('db'):
-            dbname = kwargs['db']
-            vdbs = VariantsDb.objects.filter(name=dbname, is_active=1)
-            if not vdbs:
-                return HttpResponseForbidden(
-                    "Database '{}' does not exist or is not active anymore.".format(dbname))
-            vdb = vdbs[0]
-            deac = deactivate_if_not_found_on_disk(vdb)
-            if deac:
-                return HttpResponseForbidden(
-                    "Database '{}' was not found on disk and deactivated.".format(dbname))
-            changed = update_if_db_changed(vdb)
-            if changed:
-                return HttpResponseForbidden(
-                    "Database '{}' has been modified. Please reload.".format(dbname))
-            if not auth.check_can_access_db(user, dbname):
+        if dbname:
+            served = get_db_hash(dbname)
+            # With a watcher, replaced dbs are prepared in the background: the served version is enough
+            watcher = db_watcher()
+            if not authorized or watcher is None or served is None:
+                vdb = VariantsDb.objects.filter(name=dbname, is_active=1).first()
+                if vdb is None:
+                    return HttpResponseForbidden(
+                        "Database '{}' does not exist or is not active anymore.".format(dbname))
+                # Otherwise files on disk are checked in the background
+                if watcher is None:
+                    deac = deactivate_if_not_found_on_disk(vdb)
+                    if deac:
+                        return HttpResponseForbidden(
+                            "Database '{}' was not found on disk and deactivated.".format(dbname))
+                    update_if_db_changed(vdb)
+                if served is None:
+                    set_db_hash(dbname, vdb.hash)
+                elif vdb.hash and vdb.hash != served:
+                    # Replaced, maybe by another process: the current version is served until the new one is ready
+                    generations().prepare(dbname, vdb.filename, vdb.hash)
+            if not authorized and not auth.check_can_access_db(user, dbname):
                 return HttpResponseForbidden(
                     "User '{}' has no database called '{}'.".format(username, dbname))
+            resident_dbs().touch(dbname)
+            record_usage(dbname)
+        if not authorized:
+            auth.set_authorization(user, dbname)
         kwargs['user'] = user
-        return self.view(request, **kwargs)
+        if not dbname:
+            return self.view(request, **kwargs)
+        # The version of the db resolved here is read until the end, and released only after the last request to it
+        with generations().serving(dbname):
+            try:
+                return self.view(request, **kwargs)
+            finally:
+                # Now that the view loaded what it needs, keep the most recently used dbs in memory, within budget
+                resident_dbs().loaded(dbname)
 
 @json_view
 def authenticate(request, **kwargs):
@@ -3,22 +3,55 @@ from django.http import HttpResponse, JsonResponse
 from django.views.decorators.cache import cache_page
 
 from varapp.annotation.location_service import LocationService
+from varapp.common.cache.single_flight import CacheWarming
+from varapp.common.cache.resident import resident_dbs
+from varapp.common.warmup import warmup_scheduler
 from varapp.stats.stats_service import stats_service
 from varapp.common.utils import timer
 from varapp.data_models.variants import Variant, expose_variant_full, annotate_variants
 from varapp.export import export
 from varapp.filters.filters_factory import variant_filters_from_request
-from varapp.filters.pagination import pagination_from_request
+from varapp.filters.pagination import pagination_from_request, InvalidCursor
 from varapp.filters.sort import sort_from_request
 from varapp.samples.samples_service import samples_selection_from_request
 from varapp.views.auth_views import protected
 
 from jsonview.decorators import json_view
+from jsonview.exceptions import BadRequest
+from functools import wraps
 from time import time
 import logging
 logger = logging.getLogger(__name__)
 
 DEBUG = True and settings.DEBUG
+WARMING_RETRY_AFTER = 10  # seconds
+
+
+def unavailable_while_warming(view):
+    """Respond '503 Service Unavailable' if the caches of the db are being built by another
+    request, instead of waiting for it indefinitely. To place under @json_view, which catches everything."""
+    @wraps(view)
+    def wrapped(request, db, **kwargs):
+        try:
+            return view(request, db, **kwargs)
+        except CacheWarming:
+            response = JsonResponse({'error': 503,
+                'message': "Database '{}' is being prepared, please retry in a moment.".format(db)}, status=503)
+            response['Retry-After'] = WARMING_RETRY_AFTER
+            return response
+    return wrapped
+
+
+def bad_request_on_invalid_cursor(view):
+    """Respond '400 Bad Request' if the pagination cursor of the request cannot be used.
+    To place under @json_view, which turns BadRequest into a 400 response."""
+    @wraps(view)
+    def wrapped(request, db, **kwargs):
+        try:
+            return view(request, db, **kwargs)
+        except InvalidCursor as e:
+            raise BadRequest(str(e))
+    return wrapped
 
 
 class AllFilters:
@@ -32,6 +65,7 @@ class AllFilters:
         self.ss = samples_selection_from_request(request, db)
         self.fc = variant_filters_from_request(request, db, self.ss)
         self.stats = stats_service(db)
+        self.with_stats = request.GET.get('stats') != '0'  # '?stats=0' to fetch them separately
 
     #@timer
     def apply_all_filters(self):
@@ -40,9 +74,25 @@ class AllFilters:
         # Else, manage the case when the sorting field is added at expose time, after exposition...
         var = self.fc.apply(db=self.db,
             sort_by=self.sort.key, reverse=self.sort.reverse,
-            limit=self.pg.lim, offset=self.pg.off)
+            limit=self.pg.lim, offset=self.pg.off, cursor=self.pg.cursor)
         return var
 
+    def stats_key(self):
+        """Identifies the filtered set of variants, whatever the sorting and pagination."""
+        return '{}:{}'.format(self.fc.cache_key(), self.ss.cache_key())
+
+    def make_stats(self, filter_result=None):
+        """Return the VariantStats of the filtered set, computed only once for the same filters
+        and samples selection (e.g. when only the page or sorting changes).
+        :param filter_result: a FilterResult, if the filters were already applied.
+        """
+        def compute():
+            result = filter_result if filter_result is not None else self.fc.apply(db=self.db, mask_only=True)
+            if result.mask is not None:
+                return self.stats.make_stats(mask=result.mask)
+            return self.stats.make_stats(result.ids)
+        return self.stats.query_stats(self.stats_key(), compute)
+
     #@timer
     def expose(self):
         """Return a dict exposing variants, filters, stats etc. to be sent to the view."""
@@ -50,7 +100,7 @@ class AllFilters:
         filter_result = self.apply_all_filters()
         t2 = time()
         var = filter_result.variants
-        stat = self.stats.make_stats(filter_result.ids)
+        stat = self.make_stats(filter_result) if self.with_stats else None
         t3 = time()
         var = [expose_variant_full(v, self.ss) for v in var]
         t4 = time()
@@ -62,14 +112,40 @@ class AllFilters:
         #    self.sort.sort_dict(var, inplace=True)
         response = {'variants': var}
         response["filters"] = [str(x) for x in self.fc.list]
-        response["nfound"] = stat.total_count
-        response["stats"] = stat.expose()
+        response["nfound"] = int(filter_result.n_filtered)
+        if stat is not None:
+            response["stats"] = stat.expose()
+        # Opaque pointer to the end of this page, to pass as '?cursor=' to get the next one
+        response["cursor"] = filter_result.cursor.encode() if filter_result.cursor else None
         return response
 
 def index(request):
     """Return the string 'Hello, World !'."""
     return HttpResponse("Hello World !\n")
 
+@json_view
+def ready(request, **kwargs):
+    """Return 200 when the startup warm-up of all dbs is over (some may have failed), 503 before,
+    with the state of each db. For load balancers.
+    Unauthenticated: errors are only logged."""
+    scheduler = warmup_scheduler()
+    done = scheduler.is_done()
+    states = {db: status['state'] for db, status in scheduler.statuses().items()}
+    response = JsonResponse({'ready': done, 'dbs': states},
+                            status=200 if done else 503)
+    if not done:
+        response['Retry-After'] = WARMING_RETRY_AFTER
+    return response
+
+@json_view
+def db_status(request, db, **kwargs):
+    """Return the warm-up state of *db* and its size in the local memory of this process, as last measured.
+    Unauthenticated: errors are only logged."""
+    status = warmup_scheduler().status(db)
+    if status is None:
+        return JsonResponse({'error': 404, 'message': "Database '{}' was not warmed up.".format(db)}, status=404)
+    return JsonResponse({'state': status['state'], 'resident_bytes': resident_dbs().measured_bytes(db)})
+
 @json_view
 def samples(request, db, user=None):
     """Return a JSON with the list of Samples."""
@@ -77,6 +153,8 @@ def samples(request, db, user=None):
     return JsonResponse(ss.expose(), safe=False)
 
 @json_view
+@bad_request_on_invalid_cursor
+@unavailable_while_warming
 def variants(request, db, user=None):
     """Return a JSON with info on the requested Variants."""
     filters = AllFilters(request, db)
@@ -84,9 +162,14 @@ def variants(request, db, user=None):
     return JsonResponse(response, safe=False)
 
 @json_view
+@unavailable_while_warming
 def stats(request, db, user=None):
-    """Return a JSON with stats over the whole db (to query only once at startup)."""
-    stat = stats_service(db).get_global_stats()
+    """Return a JSON with stats over the whole db (to query only once at startup),
+    or over the variants passing the filters if some are given ('?filter=...' or '?expr=...')."""
+    if request.GET.getlist('filter') or request.GET.getlist('expr'):
+        stat = AllFilters(request, db).make_stats()
+    else:
+        stat = stats_service(db).get_global_stats()
     return JsonResponse(stat.expose(), safe=False)
 
 @json_view
@@ -112,6 +195,8 @@ def location_names_autocomplete(request, db, prefix):
     return JsonResponse(ans, safe=False)
 
 @json_view
+@bad_request_on_invalid_cursor
+@unavailable_while_warming
 def export_variants(request, db, **kwargs):
     """Create a TSV file with the variants data and serve it."""
     file_format = request.GET['format']
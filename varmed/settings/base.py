@@ -69,19 +69,83 @@ MIDDLEWARE_CLASSES = (
 
 ROOT_URLCONF = 'varmed.urls'
 
+# Number of processes warming up the caches of all dbs in the background at startup (0: before serving).
+WARMUP_WORKERS = 4
+# Load all the structures of all dbs at startup, before a preforking server forks its workers,
+# so that these share the memory pages (see varapp.common.warmup.preload).
+# With Python < 3.7 (no gc.freeze), only the data of numpy arrays stays shared: the garbage collector
+# of the workers writes to, and thus copies, the pages of the other Python objects.
+PRELOAD_DBS = False
+# Seconds between two scans of GEMINI_DB_PATH for new or changed dbs, in the background
+# (see varapp.common.db_watcher). 0: check the db files at each request instead.
+DB_WATCH_INTERVAL = 10
+# How Gemini dbs are opened, read-only (see varapp.backends.gemini_sqlite).
+# GEMINI_SQLITE_PROFILES can override it for specific dbs: {dbname: {'IN_MEMORY_MAX_BYTES': ...}}.
+GEMINI_SQLITE_PROFILE = {
+    'IMMUTABLE': False,          # only if db files are never rewritten in place while served
+    'MMAP_SIZE': 2**30,          # bytes
+    'CACHE_SIZE_KB': 65536,
+    'IN_MEMORY_MAX_BYTES': 0,    # copy smaller dbs in memory, once per process
+}
+GEMINI_SQLITE_PROFILES = {}
+# Narrow copies of the variants tables with covering indexes, built at warm-up (see varapp.common.sidecar).
+SIDECAR_DBS = True
+SIDECAR_DB_PATH = None  # default: GEMINI_DB_PATH/.sidecars
+# Precomputed structures of each db, built by `manage.py ingest` and loaded by the services (see varapp.common.artifacts).
+ARTIFACTS_PATH = None  # default: GEMINI_DB_PATH/.artifacts
+# Copies of the versions of the dbs being served, so that they keep being served while a new version
+# is prepared (see varapp.common.generations). On the same file system as GEMINI_DB_PATH, they are reflinks
+# where it supports them (btrfs, xfs): then they take no space until a db file is replaced.
+DB_VERSIONS_PATH = None  # default: GEMINI_DB_PATH/.versions
+
+# Memory budget (bytes) for the structures of all dbs loaded in a process (see varapp.common.cache.resident).
+RESIDENT_DBS_MAX_BYTES = 0
+
 # Warning: these caches pickle the data before writing them
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'some-unique-name',
     },
+    # MAX_BYTES: memory budget of a local cache, least recently used dbs are evicted first (0: no limit).
+    # Services never expire (TIMEOUT None): they are dropped when their db changes, or to fit in the budget.
     'genotypes_service': {
         'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
         'LOCATION': 'genotypes_service',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_BYTES': 0},
     },
     'gene_summary': {
         'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
         'LOCATION': 'gene_summary',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_BYTES': 0},
+    },
+    'sort_service': {
+        'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
+        'LOCATION': 'sort_service',
+        'TIMEOUT': None,
+    },
+    'location_index': {
+        'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
+        'LOCATION': 'location_index',
+        'TIMEOUT': None,
+    },
+    'stats_masks': {
+        'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
+        'LOCATION': 'stats_masks',
+        'TIMEOUT': None,
+    },
+    'stats_service': {
+        'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
+        'LOCATION': 'stats_service',
+        'TIMEOUT': None,
+    },
+    # Recent authorization decisions of the `protected` views, in seconds (see varapp.auth.auth).
+    'auth': {
+        'BACKEND': 'varapp.common.cache.locmem_cache.LocMemNoPickleCache',
+        'LOCATION': 'auth',
+        'TIMEOUT': 10,
     },
 
     ## Redis
@@ -19,6 +19,16 @@ EMAIL_FROM = 'varapp@varapp.vital-it.ch'
 GEMINI_DB_PATH = './resources/db'   # Path to Gemini databases container
 WARMUP_STATS_CACHE = True           # Generate stats cache for all active dbs at startup
 WARMUP_GENOTYPES_CACHE = True       # Generate genotypes cache for all active dbs at startup
+WARMUP_WORKERS = 4                  # Number of processes warming up the caches in the background. 0: before serving requests
+PRELOAD_DBS = False                 # Load all dbs before forking workers, to share their memory (with a preforking server, fully from Python 3.7)
+DB_WATCH_INTERVAL = 10              # Seconds between two checks of the dbs directory in the background. 0: check at each request
+# Connection to Gemini dbs (see varapp.backends.gemini_sqlite). Dbs smaller than IN_MEMORY_MAX_BYTES are copied in memory
+GEMINI_SQLITE_PROFILE = {'IMMUTABLE': False, 'MMAP_SIZE': 2**30, 'CACHE_SIZE_KB': 65536, 'IN_MEMORY_MAX_BYTES': 0}
+SIDECAR_DBS = True                  # Build an index db without blobs for each Gemini db, in the background (see varapp.common.sidecar)
+SIDECAR_DB_PATH = None              # Where to store them. Default: GEMINI_DB_PATH/.sidecars
+ARTIFACTS_PATH = None               # Where `manage.py ingest` stores the precomputed structures of dbs. Default: GEMINI_DB_PATH/.artifacts
+DB_VERSIONS_PATH = None             # Where versions of the dbs are pinned while served, on the same file system. Default: GEMINI_DB_PATH/.versions
+RESIDENT_DBS_MAX_BYTES = 0          # Memory budget (bytes) for the dbs loaded by each process; least recently used are unloaded. 0: no limit
 
 ## Users db
 DB_USERS = 'users_db'               # Name of the main database, that stores sessions, db connections etc.
@@ -29,12 +39,13 @@ MYSQL_PORT = '3306'   # cf. docker-compose.yml
 
 ## Adds the users_db to DATABASES
 DATABASES['default'] = {
-    'ENGINE': 'django.db.backends.mysql',
+    'ENGINE': 'varapp.backends.mysql_pool',     # pooled persistent connections ('django.db.backends.mysql' for none)
     'NAME': DB_USERS,
     'USER': MYSQL_USER,
     'PASSWORD': MYSQL_PWD,
     'HOST': MYSQL_HOST,
     'PORT': MYSQL_PORT,
+    'POOL': {'MAX_SIZE': 10, 'MAX_AGE': 600, 'TIMEOUT': 10},   # connections per process, seconds, seconds
 }
 
 # Change the location of the redis service